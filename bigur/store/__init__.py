@@ -1,13 +1,47 @@
-'''Поддержка хранения объектов в БД MongoDB.'''
+'''Поддержка хранения объектов в БД MongoDB.
+
+Подмодули загружаются при первом обращении к их именам, а драйвер
+MongoDB при первом подключении через :meth:`db.configure`.'''
 
 __author__ = 'Gennady Kovalev <gik@bigur.ru>'
 __copyright__ = '(c) 2016-2018 Business group for development management'
 __licence__ = 'For license information see LICENSE'
 
-# flake8: noqa
+from importlib import import_module
+from typing import Any, Dict, List
+
+_exports: Dict[str, str] = {
+    'db': 'database',
+    'tenant': 'database',
+    'Counter': 'document',
+    'Minimum': 'document',
+    'Maximum': 'document',
+    'EmbeddedList': 'document',
+    'EmbeddedDict': 'document',
+    'Embedded': 'document',
+    'Stored': 'document',
+    'LazyRef': 'lazy_ref',
+    'ReadOnly': 'readonly',
+    'migrate': 'migrator',
+    'transition': 'migrator',
+    'IngestionProfile': 'unit_of_work',
+    'UnitOfWork': 'unit_of_work',
+    'WriteBehindQueue': 'write_behind',
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name: str) -> Any:
+    try:
+        module_name = _exports[name]
+    except KeyError:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(
+            __name__, name))
+    value = getattr(import_module('.' + module_name, __name__), name)
+    globals()[name] = value
+    return value
+
 
-from .database import db
-from .document import EmbeddedList, EmbeddedDict, Embedded, Stored
-from .lazy_ref import LazyRef
-from .migrator import migrate, transition
-from .unit_of_work import UnitOfWork
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(__all__))
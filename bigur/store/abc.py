@@ -5,7 +5,7 @@ __copyright__ = '(c) 2016-2018 Business group for development management'
 __licence__ = 'For license information see LICENSE'
 
 
-from abc import ABCMeta
+from abc import ABCMeta, abstractmethod
 
 
 class MetadataType(ABCMeta):
@@ -20,10 +20,10 @@ class MetadataType(ABCMeta):
                     if 'replace_attrs' not in metadata:
                         metadata['replace_attrs'] = {}
                     metadata['replace_attrs'].update(value)
-                elif key == 'picklers':
-                    if 'picklers' not in metadata:
-                        metadata['picklers'] = {}
-                    metadata['picklers'].update(value)
+                elif key in ('picklers', 'references', 'accumulators'):
+                    if key not in metadata:
+                        metadata[key] = {}
+                    metadata[key].update(value)
                 else:
                     metadata[key] = value
         cls.__metadata__ = metadata
@@ -33,3 +33,54 @@ class MetadataType(ABCMeta):
 
 class Document(metaclass=MetadataType):
     '''Абстрактный документ БД.'''
+
+
+class Collection(metaclass=ABCMeta):
+    '''Интерфейс коллекции хранилища. Описывает операции, которые
+    использует пакет, и позволяет подключать разные хранилища.'''
+
+    # pylint: disable=redefined-builtin
+
+    @abstractmethod
+    def find(self, filter=None, *args, **kwargs):
+        '''Возвращает асинхронный курсор по документам.'''
+
+    @abstractmethod
+    async def find_one(self, filter=None, *args, **kwargs):
+        '''Возвращает один документ или `None`.'''
+
+    @abstractmethod
+    async def count_documents(self, filter, **kwargs):
+        '''Возвращает число документов, удовлетворяющих запросу.'''
+
+    @abstractmethod
+    async def insert_one(self, document, **kwargs):
+        '''Вставляет документ.'''
+
+    @abstractmethod
+    async def insert_many(self, documents, **kwargs):
+        '''Вставляет несколько документов.'''
+
+    @abstractmethod
+    async def update_one(self, filter, update, **kwargs):
+        '''Обновляет документ операторами обновления.'''
+
+    @abstractmethod
+    async def update_many(self, filter, update, **kwargs):
+        '''Обновляет все документы, удовлетворяющие запросу.'''
+
+    @abstractmethod
+    async def replace_one(self, filter, replacement, **kwargs):
+        '''Заменяет документ.'''
+
+    @abstractmethod
+    async def delete_one(self, filter, **kwargs):
+        '''Удаляет документ.'''
+
+    @abstractmethod
+    async def delete_many(self, filter, **kwargs):
+        '''Удаляет все документы, удовлетворяющие запросу.'''
+
+    @abstractmethod
+    async def bulk_write(self, requests, **kwargs):
+        '''Выполняет пакет операций записи.'''
@@ -0,0 +1,215 @@
+'''Управление допуском операций к базе данных.
+
+Число одновременных операций с коллекцией ограничивается лимитом из
+:attr:`AdmissionControl.limits` или `__metadata__['concurrency']`
+класса. Коллекции различаются по паре из имени базы данных и имени
+коллекции, поэтому одноимённые коллекции разных баз данных (например,
+разных арендаторов) имеют отдельные очереди. Операции сверх лимита ждут
+в очереди, первыми допускаются операции с более высоким приоритетом (см.
+:data:`PRIORITIES`). Если срок выполнения уже истёк или очередь
+переполнена, операция сразу отклоняется исключением
+:class:`Overloaded`::
+
+    db.admission.limits['events'] = 20
+    db.admission.limits[('audit', 'events')] = 5
+
+    with db.admission.scope(priority='batch', timeout=5.0):
+        await Event.find_one({'name': 'export'})'''
+
+__author__ = 'Gennady Kovalev <gik@bigur.ru>'
+__copyright__ = '(c) 2016-2019 Development management business group'
+__licence__ = 'For license information see LICENSE'
+
+from asyncio import CancelledError, get_running_loop, wait_for
+from asyncio import TimeoutError as WaitTimeoutError
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar  # pylint: disable=E0401
+from dataclasses import dataclass, replace
+from heapq import heapify, heappop, heappush
+from itertools import count
+from time import monotonic
+from typing import (Any, AsyncIterator, Dict, Iterator, List, Optional,
+                    Tuple, Union)
+
+PRIORITIES = {
+    'interactive': 0,
+    'normal': 1,
+    'batch': 2,
+}
+
+current_priority: ContextVar = ContextVar('priority', default='normal')
+current_deadline: ContextVar = ContextVar('deadline', default=None)
+
+
+class Overloaded(RuntimeError):
+    '''Операция отклонена из-за перегрузки.'''
+
+
+@dataclass
+class AdmissionStats:
+    '''Показатели допуска операций к коллекции.'''
+
+    active: int = 0
+    queued: int = 0
+    max_queued: int = 0
+    admitted: int = 0
+    rejected: int = 0
+    wait_time: float = 0.0
+    max_wait_time: float = 0.0
+
+
+class Limiter(object):
+    '''Ограничитель числа одновременных операций с очередью по
+    приоритетам.
+
+    Допуск проходят запросы `find_one`, `count_documents` и операции
+    записи коллекции. Курсоры `find` и `aggregate` возвращаются без
+    ожидания и ограничителем не учитываются.'''
+
+    def __init__(self, limit: int) -> None:
+        if limit < 1:
+            raise ValueError('limit must be positive')
+        self.limit: int = limit
+        self.stats: AdmissionStats = AdmissionStats()
+        self._waiters: List[List[Any]] = []
+        self._counter = count()
+
+    def reject(self, reason: str) -> None:
+        '''Учитывает отказ и выбрасывает :class:`Overloaded`.'''
+        self.stats.rejected += 1
+        raise Overloaded(reason)
+
+    async def acquire(self, level: int = 1,
+                      until: Optional[float] = None,
+                      max_queue: Optional[int] = None) -> None:
+        '''Занимает место. Ждёт в очереди с приоритетом `level` не дольше
+        момента `until` по :func:`time.monotonic`.'''
+        stats = self.stats
+        start = monotonic()
+        if until is not None and until <= start:
+            self.reject('Deadline exceeded before admission')
+        if stats.active < self.limit and not self._waiters:
+            stats.active += 1
+            stats.admitted += 1
+            return
+        if max_queue is not None and len(self._waiters) >= max_queue:
+            self.reject('Admission queue is full')
+
+        future = get_running_loop().create_future()
+        entry = [level, next(self._counter), future]
+        heappush(self._waiters, entry)
+        stats.queued = len(self._waiters)
+        stats.max_queued = max(stats.max_queued, stats.queued)
+        try:
+            await wait_for(future, None if until is None else until - start)
+        except WaitTimeoutError:
+            self._discard(entry)
+            self.reject('Deadline exceeded in admission queue')
+        except CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                self._discard(entry)
+            raise
+        finally:
+            waited = monotonic() - start
+            stats.wait_time += waited
+            stats.max_wait_time = max(stats.max_wait_time, waited)
+
+    def release(self) -> None:
+        '''Освобождает место, передавая его первой операции в очереди.'''
+        while self._waiters:
+            _, _, future = heappop(self._waiters)
+            self.stats.queued = len(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                self.stats.admitted += 1
+                return
+        self.stats.active -= 1
+
+    def _discard(self, entry: List[Any]) -> None:
+        if entry in self._waiters:
+            self._waiters.remove(entry)
+            heapify(self._waiters)
+        self.stats.queued = len(self._waiters)
+
+
+class AdmissionControl(object):
+    '''Допуск операций к коллекциям.
+
+    `limits` задаёт лимиты одновременных операций по паре `(имя базы
+    данных, имя коллекции)` или по имени коллекции во всех базах данных,
+    `default_limit` — для остальных коллекций (без лимита, если не
+    задан). Лимит из `__metadata__['concurrency']` регистрируется при
+    первом обращении класса к коллекции. `max_queue` ограничивает длину
+    очереди, `max_wait` — время ожидания, если срок не задан через
+    :meth:`scope`.'''
+
+    def __init__(self) -> None:
+        self.limits: Dict[Union[str, Tuple[str, str]], int] = {}
+        self.default_limit: Optional[int] = None
+        self.max_queue: Optional[int] = None
+        self.max_wait: Optional[float] = None
+        self._limiters: Dict[Any, Limiter] = {}
+
+    def get_limiter(self, key: Any) -> Optional[Limiter]:
+        '''Возвращает ограничитель для коллекции `key`, обычно пары
+        `(имя базы данных, имя коллекции)`.'''
+        limit = self.limits.get(key)
+        if limit is None and isinstance(key, tuple):
+            limit = self.limits.get(key[1])
+        if limit is None:
+            limit = self.default_limit
+        if limit is None:
+            return None
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            limiter = self._limiters[key] = Limiter(limit)
+        elif limiter.limit != limit:
+            limiter.limit = limit
+        return limiter
+
+    def stats(self, key: Any) -> AdmissionStats:
+        '''Возвращает копию показателей допуска к коллекции `key`.'''
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            return AdmissionStats()
+        return replace(limiter.stats)
+
+    @contextmanager
+    def scope(self, priority: Optional[str] = None,
+              timeout: Optional[float] = None) -> Iterator[None]:
+        '''Задаёт приоритет и срок выполнения операций внутри блока.'''
+        tokens = []
+        if priority is not None:
+            if priority not in PRIORITIES:
+                raise ValueError('Unknown priority {}'.format(priority))
+            tokens.append((current_priority, current_priority.set(priority)))
+        if timeout is not None:
+            until = monotonic() + timeout
+            current = current_deadline.get()
+            if current is not None:
+                until = min(until, current)
+            tokens.append((current_deadline, current_deadline.set(until)))
+        try:
+            yield
+        finally:
+            for var, token in reversed(tokens):
+                var.reset(token)
+
+    @asynccontextmanager
+    async def admit(self, key: Any) -> AsyncIterator[None]:
+        '''Допускает операцию с коллекцией `key`.'''
+        limiter = self.get_limiter(key)
+        if limiter is None:
+            yield
+            return
+        until = current_deadline.get()
+        if until is None and self.max_wait is not None:
+            until = monotonic() + self.max_wait
+        await limiter.acquire(PRIORITIES[current_priority.get()], until,
+                              self.max_queue)
+        try:
+            yield
+        finally:
+            limiter.release()
@@ -0,0 +1,60 @@
+'''Настройки кодирования BSON.
+
+Часть преобразований документов выполняется самим декодером BSON: даты
+возвращаются с часовым поясом UTC, ссылки `DBRef` превращаются в
+:class:`~bigur.store.lazy_ref.LazyRef`. Собственные типы подключаются
+через :func:`register_type` до вызова :meth:`db.configure`.'''
+
+__author__ = 'Gennady Kovalev <gik@bigur.ru>'
+__copyright__ = '(c) 2016-2019 Development management business group'
+__licence__ = 'For license information see LICENSE'
+
+from datetime import timezone
+from typing import Any, Dict, List, Union
+
+from bson import DBRef
+from bson.codec_options import (CodecOptions, TypeCodec, TypeDecoder,
+                                TypeEncoder, TypeRegistry)
+
+from bigur.store.lazy_ref import LazyRef
+
+Codec = Union[TypeCodec, TypeDecoder, TypeEncoder]
+
+codecs: List[Codec] = []
+
+
+class LazyRefCodec(TypeCodec):
+    '''Кодирует :class:`~.LazyRef` как `DBRef` и декодирует обратно.'''
+
+    python_type = LazyRef
+    bson_type = DBRef
+
+    def transform_python(self, value: LazyRef) -> DBRef:
+        return value.dbref
+
+    def transform_bson(self, value: DBRef) -> LazyRef:
+        return LazyRef(value)
+
+
+def register_type(codec: Codec) -> Codec:
+    '''Регистрирует преобразователь собственного типа. Действует на
+    подключения, настроенные после регистрации.'''
+    codecs.append(codec)
+    return codec
+
+
+def get_codec_options() -> CodecOptions:
+    '''Возвращает настройки кодирования для подключения.'''
+    return CodecOptions(tz_aware=True, tzinfo=timezone.utc,
+                        type_registry=TypeRegistry([LazyRefCodec()] +
+                                                   codecs))
+
+
+def get_client_options() -> Dict[str, Any]:
+    '''Возвращает настройки кодирования в виде параметров клиента.'''
+    options = get_codec_options()
+    return {
+        'tz_aware': options.tz_aware,
+        'tzinfo': options.tzinfo,
+        'type_registry': options.type_registry,
+    }
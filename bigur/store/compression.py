@@ -0,0 +1,144 @@
+'''Сжатие крупных полей документов.
+
+:func:`compressed` возвращает преобразователь для
+`__metadata__['picklers']`. Значения больше порога сжимаются и
+сохраняются как `Binary` с подтипом :data:`COMPRESSED_SUBTYPE`, первые
+байты которого указывают алгоритм и тип значения. Сжатые поля
+распаковываются при первом обращении к атрибуту, а неизменённые поля
+сохраняются обратно без повторного сжатия::
+
+    class Article(Stored):
+        __metadata__ = {
+            'picklers': {
+                'text': compressed(threshold=4096),
+            }
+        }
+
+Размеры и время сжатия учитываются в
+:attr:`~bigur.store.unit_of_work.UnitOfWork.stats`.'''
+
+__author__ = 'Gennady Kovalev <gik@bigur.ru>'
+__copyright__ = '(c) 2016-2019 Development management business group'
+__licence__ = 'For license information see LICENSE'
+
+import bz2
+import lzma
+import zlib
+from time import perf_counter
+from typing import Any, Callable, Dict, Tuple
+
+from bson import Binary, decode, encode
+
+from bigur.store.codec import get_codec_options
+from bigur.store.document import pickle, unpickle
+from bigur.store.unit_of_work import context
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# Пользовательский подтип BSON для сжатых значений
+COMPRESSED_SUBTYPE = 0x80
+
+BYTES, TEXT, DOCUMENT = 0, 1, 2
+
+Compressor = Tuple[int, Callable[[bytes, int], bytes],
+                   Callable[[bytes], bytes]]
+
+ALGORITHMS: Dict[str, Compressor] = {
+    'zlib': (1, zlib.compress, zlib.decompress),
+    'bz2': (2, lambda x, level: bz2.compress(x, level if level > 0 else 9),
+            bz2.decompress),
+    'lzma': (3, lambda x, level: lzma.compress(
+        x, preset=level if level >= 0 else None), lzma.decompress),
+}
+
+if zstandard is not None:
+    ALGORITHMS['zstd'] = (
+        4,
+        lambda x, level: zstandard.ZstdCompressor(
+            level=level if level > 0 else 3).compress(x),
+        lambda x: zstandard.ZstdDecompressor().decompress(x))
+
+DECOMPRESSORS = {v[0]: v[2] for v in ALGORITHMS.values()}
+
+
+def is_compressed(value: Any) -> bool:
+    '''Проверяет, является ли значение сжатым полем.'''
+    return isinstance(value, Binary) and value.subtype == COMPRESSED_SUBTYPE
+
+
+def compress(value: Any, algorithm: str = 'zlib', level: int = -1,
+             threshold: int = 1024) -> Any:
+    '''Сжимает значение, подготовленное для сохранения в БД, если его
+    размер не меньше `threshold` байт.'''
+    if isinstance(value, bytes):
+        kind, data = BYTES, value
+    elif isinstance(value, str):
+        kind, data = TEXT, value.encode('utf-8')
+    elif isinstance(value, (dict, list)):
+        kind, data = DOCUMENT, encode({'v': value},
+                                      codec_options=get_codec_options())
+    else:
+        return value
+    if len(data) < threshold:
+        return value
+
+    try:
+        code, compressor, _ = ALGORITHMS[algorithm]
+    except KeyError:
+        raise ValueError('Unknown compression algorithm {}'.format(
+            algorithm))
+    start = perf_counter()
+    result = Binary(bytes((code, kind)) + compressor(data, level),
+                    COMPRESSED_SUBTYPE)
+
+    uow = context.get()
+    if uow is not None:
+        uow.stats.bytes_uncompressed += len(data)
+        uow.stats.bytes_compressed += len(result)
+        uow.stats.compress_time += perf_counter() - start
+    return result
+
+
+def decompress(value: Any) -> Any:
+    '''Распаковывает значение, сжатое :func:`compress`. Остальные значения
+    возвращаются без изменений.'''
+    if not is_compressed(value):
+        return value
+    start = perf_counter()
+    try:
+        decompressor = DECOMPRESSORS[value[0]]
+    except KeyError:
+        raise ValueError('Unknown compression algorithm code {}'.format(
+            value[0]))
+    kind, data = value[1], decompressor(bytes(value[2:]))
+    if kind == TEXT:
+        result: Any = data.decode('utf-8')
+    elif kind == DOCUMENT:
+        result = decode(data, get_codec_options())['v']
+    else:
+        result = data
+
+    uow = context.get()
+    if uow is not None:
+        uow.stats.decompress_time += perf_counter() - start
+    return result
+
+
+def compressed(threshold: int = 1024, algorithm: str = 'zlib',
+               level: int = -1) -> Dict[str, Any]:
+    '''Возвращает преобразователь поля для `__metadata__['picklers']`,
+    сжимающий значения от `threshold` байт алгоритмом `algorithm`.'''
+    if algorithm not in ALGORITHMS:
+        raise ValueError('Unknown compression algorithm {}'.format(
+            algorithm))
+
+    def pickle_value(obj, value):  # pylint: disable=unused-argument
+        return compress(pickle(value), algorithm, level, threshold)
+
+    def unpickle_value(obj, state, value):  # pylint: disable=W0613
+        return unpickle(decompress(value))
+
+    return {'pickle': pickle_value, 'unpickle': unpickle_value, 'lazy': True}
@@ -4,114 +4,414 @@ __author__ = 'Gennady Kovalev <gik@bigur.ru>'
 __copyright__ = '(c) 2016-2018 Business group for development management'
 __licence__ = 'For license information see LICENSE'
 
+from asyncio import get_running_loop
+from collections import deque
+from concurrent.futures import Executor
+from contextvars import ContextVar, copy_context  # pylint: disable=E0401
 from importlib import import_module
-from typing import Union, Optional
+from importlib.util import find_spec
+from typing import (TYPE_CHECKING, Any, Deque, Dict, List, Tuple, Union,
+                    Optional)
 from sys import modules
-from urllib.parse import urlparse
+from urllib.parse import parse_qs, urlparse
 
-from motor.core import AgnosticBaseProperties
-from motor.motor_asyncio import (AsyncIOMotorClient, AsyncIOMotorCursor,
-                                 AsyncIOMotorDatabase, AsyncIOMotorCollection)
+from bson import decode_all
 
+from bigur.store.admission import AdmissionControl, Overloaded  # noqa
 from bigur.store.typing import DatabaseDict, Document
 from bigur.store.unit_of_work import context
 
+if TYPE_CHECKING:
+    from bigur.store.mongo import Database  # noqa: F401
+
 DocumentOrObject = Union[Document, DatabaseDict]
 
+# Код ошибки MongoDB при нарушении уникального индекса
+DUPLICATE_KEY = 11000
+
+READ_PREFERENCES = {
+    'primary': 'PRIMARY',
+    'primaryPreferred': 'PRIMARY_PREFERRED',
+    'secondary': 'SECONDARY',
+    'secondaryPreferred': 'SECONDARY_PREFERRED',
+    'nearest': 'NEAREST',
+}
+
+# Классы, перенесённые в :mod:`bigur.store.mongo`, загружаются при первом
+# обращении, чтобы импорт модуля не загружал motor.
+MONGO_CLASSES = ('Client', 'Database', 'Collection', 'Cursor',
+                 'CommandCursor')
+
 
-def compile_object(document: DatabaseDict) -> DocumentOrObject:
-    '''Превращает документ, полученный из базы в объект python.'''
-    if document is not None and '_class' in document:
-        splitted = document['_class'].split('.')
-        class_name = splitted.pop()
-        module_name = '.'.join(splitted)
+def read_preference(value: Any) -> Any:
+    '''Возвращает объект настройки чтения pymongo по его имени. Объекты
+    настроек возвращаются без изменений.'''
+    if isinstance(value, str):
         try:
-            module = modules[module_name]
+            name = READ_PREFERENCES[value]
         except KeyError:
-            module = import_module(module_name)
-        cls = getattr(module, class_name)
+            raise ValueError('Unknown read preference {}'.format(value))
+        # pylint: disable=import-outside-toplevel
+        from pymongo.read_preferences import ReadPreference
+        return getattr(ReadPreference, name)
+    return value
+
+
+def track(collection: str, operation: str) -> None:
+    '''Учитывает обращение к серверу в статистике текущей единицы
+    работы.'''
+    uow = context.get()
+    if uow is not None:
+        uow.stats.add_round_trip(collection, operation)
+
+
+class SessionOptions(object):
+    '''Примесь коллекции, добавляющая к параметрам запросов сессию
+    текущей единицы работы. Коллекция должна иметь атрибуты `database`
+    и `write_concern`.'''
+
+    def read_options(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        '''Добавляет к параметрам чтения сессию текущей единицы работы,
+        если в ней уже выполнялась запись.'''
+        uow = context.get()
+        if uow is not None and kwargs.get('session') is None:
+            session = uow.get_session(self.database.client)
+            if session is not None:
+                kwargs['session'] = session
+        return kwargs
+
+    async def write_options(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        '''Добавляет к параметрам записи причинно-согласованную сессию
+        текущей единицы работы.'''
+        uow = context.get()
+        if uow is not None and kwargs.get('session') is None \
+                and self.write_concern.acknowledged:
+            kwargs['session'] = await uow.start_session(self.database.client)
+        return kwargs
+
+
+def resolve_class(name: str) -> type:
+    '''Возвращает класс по полному имени из поля `_class` документа,
+    импортируя модуль при необходимости.'''
+    module_name, _, class_name = name.rpartition('.')
+    try:
+        module = modules[module_name]
+    except KeyError:
+        module = import_module(module_name)
+    return getattr(module, class_name)
+
+
+def compile_object(document: DatabaseDict,
+                   readonly: bool = False,
+                   count_loaded: bool = True) -> DocumentOrObject:
+    '''Превращает документ, полученный из базы в объект python. Объект
+    только для чтения не связывается с единицей работы. Без
+    `count_loaded` объект не учитывается в статистике единицы работы,
+    например при разборе пакета в другом потоке.'''
+    if isinstance(document, dict) and '_class' in document:
+        cls = resolve_class(document['_class'])
         obj = cls.__new__(cls)
+        if readonly:
+            obj.__setstate__(document, readonly=True)
+            return obj
         obj.__setstate__(document)
-        obj.__unit_of_work__ = context.get()
+        uow = context.get()
+        obj.__unit_of_work__ = uow
+        if uow is not None and count_loaded:
+            uow.stats.loaded += 1
         document = obj
 
     return document
 
 
-class Client(AsyncIOMotorClient):
-    '''Обёртка вокруг :class:`~AsyncIOMotorClient`. Нужна для возвращения
-    нашего объекта с базой данных.'''
-
-    def __getitem__(self, name: str) -> 'Database':
-        return Database(self, name)
-
-
-class Database(AsyncIOMotorDatabase):
-    '''Обёртка вокруг :class:`~AsyncIOMotorDatabase`. Нужна для возвращения
-    нашего объекта с коллекцией.'''
-
-    def __init__(self, client: Client, name: str, _delegate=None) -> None:
-        self._client: Client = client
-        delegate = _delegate or self.__delegate_class__(client.delegate, name)
-        super(AgnosticBaseProperties, self).__init__(delegate)
-
-    def __getitem__(self, name: str) -> 'Collection':
-        return Collection(self, name)
-
-
-class Collection(AsyncIOMotorCollection):
-    '''Обёртка вокруг коллекции.'''
-
-    def __init__(self, database: Database, name: str, _delegate=None) -> None:
-        self.database: Database = database
-        delegate = _delegate or self.__delegate_class__(
-            database.delegate, name)
-        super(AgnosticBaseProperties, self).__init__(delegate)
-
-    async def find_one(self, *args, **kwargs) -> DocumentOrObject:
-        '''Получение одного объекта.'''
-        return compile_object((await super().find_one(*args, **kwargs)))
+def compile_row(document: DatabaseDict) -> DocumentOrObject:
+    '''Превращает строку результата агрегации в объект python. Ссылки,
+    найденные на сервере через `$lookup` (см. :meth:`Stored.lookup`),
+    подставляются в соответствующие :class:`~.LazyRef`.'''
+    lookups = None
+    if isinstance(document, dict):
+        lookups = document.pop('_lookup', None)
+    obj = compile_object(document)
+    if lookups:
+        # pylint: disable=import-outside-toplevel
+        from bigur.store.lazy_ref import LazyRef
+        for attr, found in lookups.items():
+            ref = getattr(obj, attr)
+            if isinstance(ref, LazyRef) and isinstance(found, list) \
+                    and found:
+                ref.obj = compile_object(found[0])
+    return obj
+
+
+def decode_batch(batch: bytes, codec_options: Any) -> List[DatabaseDict]:
+    '''Декодирует пакет документов BSON.'''
+    return decode_all(batch, codec_options)
+
+
+def compile_batch(batch: bytes, codec_options: Any,
+                  readonly: bool = False,
+                  count_loaded: bool = True) -> List[DocumentOrObject]:
+    '''Декодирует пакет документов BSON и превращает их в объекты.'''
+    return [compile_object(x, readonly, count_loaded)
+            for x in decode_all(batch, codec_options)]
+
+
+class DecodingCursor(object):
+    '''Курсор, разбирающий крупные пакеты документов вне цикла событий.
+
+    Пакеты меньше `threshold` байт декодируются в цикле событий. Крупные
+    пакеты в пуле потоков декодируются и превращаются в объекты
+    целиком, а в пуле процессов только декодируются, поскольку объекты
+    передаются между процессами через своё состояние в БД.'''
+
+    def __init__(self, cursor: Any, executor: Optional[Executor],
+                 threshold: int, readonly: bool = False) -> None:
+        self._cursor = cursor
+        self._executor = executor
+        self._threshold = threshold
+        self._readonly = readonly
+        self._buffer: Deque[DocumentOrObject] = deque()
+
+    def sort(self, *args, **kwargs) -> 'DecodingCursor':
+        '''Задаёт сортировку.'''
+        self._cursor.sort(*args, **kwargs)
+        return self
+
+    def skip(self, skip: int) -> 'DecodingCursor':
+        '''Пропускает первые `skip` документов.'''
+        self._cursor.skip(skip)
+        return self
+
+    def limit(self, limit: int) -> 'DecodingCursor':
+        '''Ограничивает число документов.'''
+        self._cursor.limit(limit)
+        return self
+
+    def batch_size(self, batch_size: int) -> 'DecodingCursor':
+        '''Задаёт размер пакета.'''
+        self._cursor.batch_size(batch_size)
+        return self
+
+    def __aiter__(self) -> 'DecodingCursor':
+        return self
+
+    async def __anext__(self) -> DocumentOrObject:
+        while not self._buffer:
+            batch = await self._cursor.next()
+            self._buffer.extend(await self._decode(batch))
+        return self._buffer.popleft()
+
+    async def _decode(self, batch: bytes) -> List[DocumentOrObject]:
+        codec_options = self._cursor.collection.codec_options
+        if self._executor is None or len(batch) < self._threshold:
+            return compile_batch(batch, codec_options, self._readonly)
+
+        loop = get_running_loop()
+        # The process pool module is loaded only by its users
+        process = modules.get('concurrent.futures.process')
+        if process is not None \
+                and isinstance(self._executor, process.ProcessPoolExecutor):
+            documents = await loop.run_in_executor(
+                self._executor, decode_batch, batch, codec_options)
+            return [compile_object(x, self._readonly) for x in documents]
+
+        # Run with current context to bind objects to the unit of work,
+        # statistics are updated here in the event loop thread
+        objects = await loop.run_in_executor(self._executor,
+                                             copy_context().run,
+                                             compile_batch, batch,
+                                             codec_options, self._readonly,
+                                             False)
+        uow = context.get()
+        if uow is not None and not self._readonly:
+            uow.stats.loaded += sum(1 for x in objects
+                                    if isinstance(x, Document))
+        return objects
+
+    async def to_list(self, length: Optional[int] = None) -> list:
+        '''Получение списка объектов.'''
+        result = []
+        async for obj in self:
+            result.append(obj)
+            if length is not None and len(result) >= length:
+                break
+        return result
+
+
+BACKENDS: Dict[str, str] = {
+    'mongodb': 'bigur.store.mongo:Client',
+    'mongodb+srv': 'bigur.store.mongo:Client',
+    'memory': 'bigur.store.memory:MemoryClient',
+}
+
+
+# Алгоритмы сжатия трафика в порядке предпочтения и нужные для них модули
+WIRE_COMPRESSORS = (
+    ('zstd', 'zstandard'),
+    ('snappy', 'snappy'),
+    ('zlib', 'zlib'),
+)
+
+
+def available_compressors() -> List[str]:
+    '''Возвращает алгоритмы сжатия трафика, доступные в окружении.'''
+    return [
+        name for name, module in WIRE_COMPRESSORS
+        if find_spec(module) is not None
+    ]
+
+
+def get_backend(uri: str, **options) -> Any:
+    '''Возвращает клиент хранилища для `uri` по схеме адреса. Клиент
+    настраивается на декодирование BSON из :mod:`bigur.store.codec`.
+    Параметры `options` передаются клиенту MongoDB.'''
+    # pylint: disable=import-outside-toplevel
+    from bigur.store.codec import get_client_options, get_codec_options
+    scheme = urlparse(uri).scheme
+    try:
+        module_name, class_name = BACKENDS[scheme].split(':')
+    except KeyError:
+        raise ValueError('Unknown storage backend {}'.format(scheme))
+    client_class = getattr(import_module(module_name), class_name)
+    if scheme in ('mongodb', 'mongodb+srv'):
+        return client_class(uri, **get_client_options(), **options)
+    return client_class(codec_options=get_codec_options())
 
-    async def count_documents(self, *args, **kwargs) -> int:
-        '''Получение числа документов, которое будет возвращенго запросом.'''
-        return await super().count_documents(*args, **kwargs)
 
-    def find(self, *args, **kwargs) -> 'Cursor':
-        '''Возвращает :class:`~.Cursor` для итерации.'''
-        return Cursor(self.delegate.find(*args, **kwargs), self)
-
-
-class Cursor(AsyncIOMotorCursor):
-    '''Обёртка вокруг курсора.'''
-
-    def next_object(self) -> DocumentOrObject:
-        '''Получение документа из курсора.'''
-        return compile_object(super().next_object())
+class DBProxy(object):
+    '''Точка доступа к базам данных.
 
+    Основное подключение задаётся через :meth:`configure` без имени,
+    дополнительные кластеры регистрируются под именами и выбираются
+    классами через `__metadata__['connection']`. Имя базы данных можно
+    переопределить через `__metadata__['database']` или, для классов без
+    этой настройки, через контекстную переменную :data:`tenant`.'''
 
-class DBProxy(object):
     def __init__(self):
-        self._db: Optional[Database] = None
-
-    def configure(self, uri: str) -> None:
-        db_name = urlparse(uri).path.strip('/')
-        self._db = Client(uri)[db_name]
+        self._db: Optional['Database'] = None
+        self._connections: Dict[str, 'Database'] = {}
+        self._routes: Dict[str, Optional[str]] = {}
+        self._databases: Dict[Tuple[Optional[str], str], 'Database'] = {}
+        self._compressors: Dict[Optional[str], List[str]] = {}
+        self.compressors: Optional[List[str]] = None
+        self.zlib_compression_level: Optional[int] = None
+        self.admission: AdmissionControl = AdmissionControl()
+
+    def configure(self, uri: str,
+                  connection: Optional[str] = None,
+                  compressors: Optional[List[str]] = None,
+                  zlib_compression_level: Optional[int] = None) -> None:
+        '''Настраивает подключение по `uri`. Если указано `connection`, то
+        подключение регистрируется под этим именем. Хранилище выбирается по
+        схеме адреса, см. :data:`BACKENDS`, например `memory://test`
+        подключает хранилище в памяти.
+
+        `compressors` задаёт алгоритмы сжатия трафика с сервером MongoDB в
+        порядке предпочтения, пустой список отключает сжатие. По умолчанию
+        используются :attr:`compressors` и :attr:`zlib_compression_level`
+        прокси, а если они не заданы, то сжатие выключено. Включить все
+        установленные алгоритмы можно, передав результат
+        :func:`available_compressors`. Параметры, указанные в `uri`, имеют
+        приоритет.'''
+        parsed = urlparse(uri)
+        db_name = parsed.path.strip('/')
+        if compressors is None:
+            compressors = self.compressors or []
+        if zlib_compression_level is None:
+            zlib_compression_level = self.zlib_compression_level
+
+        options: Dict[str, Any] = {}
+        if parsed.scheme.startswith('mongodb'):
+            query = {k.lower(): v for k, v in parse_qs(parsed.query).items()}
+            if 'compressors' in query:
+                compressors = query['compressors'][-1].split(',')
+            elif compressors:
+                options['compressors'] = ','.join(compressors)
+            if zlib_compression_level is not None \
+                    and 'zlibcompressionlevel' not in query:
+                options['zlibCompressionLevel'] = zlib_compression_level
+        else:
+            compressors = []
+        self._compressors[connection] = list(compressors)
+
+        database = get_backend(uri, **options)[db_name]
+        if connection is None:
+            self._db = database
+        else:
+            self._connections[connection] = database
+        self._routes.setdefault(db_name, connection)
+        self._databases = {
+            k: v for k, v in self._databases.items() if k[0] != connection
+        }
+
+    def get_compressors(self, connection: Optional[str] = None) -> List[str]:
+        '''Возвращает алгоритмы сжатия трафика подключения.'''
+        self.get_connection(connection)
+        return self._compressors[connection]
 
     @property
-    def origin(self) -> Optional[Database]:
+    def origin(self) -> Optional['Database']:
         if self._db is None:
             raise RuntimeError('Database is not configured')
         return self._db
 
+    def get_connection(self, connection: Optional[str] = None) -> 'Database':
+        '''Возвращает базу данных по умолчанию для подключения.'''
+        if connection is None:
+            return self.origin
+        try:
+            return self._connections[connection]
+        except KeyError:
+            raise RuntimeError(
+                'Connection {} is not configured'.format(connection))
+
+    def get_database(self,
+                     connection: Optional[str] = None,
+                     database: Optional[str] = None) -> 'Database':
+        '''Возвращает базу данных `database` из подключения `connection`.
+        Если база не указана, то используется :data:`tenant`, а затем
+        база данных подключения по умолчанию.'''
+        if database is None:
+            database = tenant.get()
+        if database is None:
+            return self.get_connection(connection)
+        key = (connection, database)
+        result = self._databases.get(key)
+        if result is None:
+            origin = self.get_connection(connection)
+            if origin.name == database:
+                result = origin
+            else:
+                result = origin.client[database]
+            self._databases[key] = result
+            self._routes.setdefault(database, connection)
+        return result
+
+    def resolve_database(self, database: Optional[str] = None) -> 'Database':
+        '''Возвращает базу данных по имени, например из `DBRef.database`,
+        через подключение, в котором эта база уже использовалась.'''
+        if database is None:
+            return self.get_database()
+        return self.get_database(self._routes.get(database), database)
+
     def __getattr__(self, key):
         if self._db is None:
             raise RuntimeError('Database is not configured')
-        return getattr(self._db, key)
+        return getattr(self.get_database(), key)
 
     def __getitem__(self, key):
         if self._db is None:
             raise RuntimeError('Database is not configured')
-        return self._db[key]
+        return self.get_database()[key]
+
+
+def __getattr__(name: str) -> Any:
+    if name in MONGO_CLASSES:
+        return getattr(import_module('bigur.store.mongo'), name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(
+        __name__, name))
+
 
+tenant: ContextVar = ContextVar('tenant', default=None)
 
 db = DBProxy()
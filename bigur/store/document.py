@@ -4,26 +4,46 @@ __author__ = 'Gennady Kovalev <gik@bigur.ru>'
 __copyright__ = '(c) 2016-2018 Business group for development management'
 __licence__ = 'For license information see LICENSE'
 
+from concurrent.futures import Executor
+from copy import copy
 from dataclasses import dataclass
 from datetime import datetime, timezone
-from importlib import import_module
 from logging import getLogger
-from sys import modules
-from typing import Dict, Any, Set, Optional, List, TypeVar, Iterable
+from typing import (TYPE_CHECKING, Dict, Any, AsyncIterator, Set, Optional,
+                    List, TypeVar, Iterable, Tuple, Union)
 
-from bson import DBRef, ObjectId
-from pymongo.results import InsertOneResult, UpdateResult, DeleteResult
+from bson import DBRef, ObjectId, encode
 
 from bigur.store.typing import Document as DocumentType
-from bigur.store.database import Collection, Cursor
-from bigur.store.database import db
+from bigur.store.codec import get_codec_options
+from bigur.store.database import (DUPLICATE_KEY, DecodingCursor,
+                                  resolve_class)
+from bigur.store.database import db, read_preference as get_read_preference
 from bigur.store.lazy_ref import LazyRef
-from bigur.store.unit_of_work import context
+from bigur.store.readonly import SCALARS, ReadOnly, freeze
+from bigur.store.unit_of_work import context, IngestionProfile, SetOperation
+
+if TYPE_CHECKING:
+    # pylint: disable=ungrouped-imports
+    from pymongo import DeleteOne, InsertOne, ReplaceOne, UpdateOne
+    from pymongo.results import (BulkWriteResult, DeleteResult,
+                                 InsertOneResult, UpdateResult)
+    from bigur.store.mongo import Collection, CommandCursor, Cursor
+    from bigur.store.pagination import Page
 
 logger = getLogger(__name__)
 
 T = TypeVar('T')
 
+_classes: Dict[str, type] = {}
+
+# Параметры коллекции временных рядов из `__metadata__['timeseries']`
+TIMESERIES_OPTIONS = {
+    'time_field': 'timeField',
+    'meta_field': 'metaField',
+    'granularity': 'granularity',
+}
+
 
 def pickle(obj: Any) -> Any:
     '''Transform object to MongoDB document.'''
@@ -45,12 +65,21 @@ def pickle(obj: Any) -> Any:
     elif isinstance(obj, LazyRef):
         pickled = obj.dbref
 
+    elif isinstance(obj, Accumulator):
+        pickled = obj.value
+
     elif isinstance(obj, Embedded):
         pickled = obj.__getstate__()
 
     elif isinstance(obj, Stored):
-        collection = type(obj).get_collection().name
-        pickled = DBRef(collection, obj.id)
+        cls = type(obj)
+        collection = cls.get_collection()
+        database = None
+        if 'database' in cls.__metadata__:
+            database = collection.database.name
+        # Shard key values let the reference be resolved on one shard
+        pickled = DBRef(collection.name, obj.id, database,
+                        **cls.get_shard_filter(obj))
 
     else:
         pickled = obj
@@ -58,12 +87,38 @@ def pickle(obj: Any) -> Any:
     return pickled
 
 
+def pickle_reference(obj: Any, fields: Iterable[str]) -> Any:
+    '''Transform reference to `DBRef` with a snapshot of referenced object
+    `fields`. Unresolved :class:`~.LazyRef` keeps its stored snapshot.'''
+    if isinstance(obj, LazyRef):
+        if obj.obj is None:
+            return obj.dbref
+        obj = obj.obj
+    pickled = pickle(obj)
+    if not isinstance(pickled, DBRef):
+        return pickled
+    snapshot = {
+        k: v for k, v in pickled.as_doc().items() if not k.startswith('$')
+    }
+    for field in fields:
+        value = pickle(getattr(obj, field))
+        if value is not None:
+            snapshot[field] = value
+    return DBRef(pickled.collection, pickled.id, pickled.database,
+                 **snapshot)
+
+
 def unpickle(obj: Any) -> Any:
-    '''Transform MongoDB document to object.'''
+    '''Transform MongoDB document to object. Dates and references are
+    converted by the BSON decoder (see :mod:`bigur.store.codec`), here
+    they are handled only for documents decoded with other options.'''
 
     unpickled: Any
 
-    if isinstance(obj, datetime) and obj.tzinfo is None:
+    if type(obj) in SCALARS:  # pylint: disable=unidiomatic-typecheck
+        unpickled = obj
+
+    elif isinstance(obj, datetime) and obj.tzinfo is None:
         unpickled = obj.replace(tzinfo=timezone.utc)
 
     elif isinstance(obj, list):
@@ -72,14 +127,7 @@ def unpickle(obj: Any) -> Any:
             unpickled.append(unpickle(value))
 
     elif isinstance(obj, dict) and '_class' in obj:
-        splitted = obj['_class'].split('.')
-        class_name = splitted.pop()
-        module_name = '.'.join(splitted)
-        try:
-            module = modules[module_name]
-        except KeyError:
-            module = import_module(module_name)
-        cls = getattr(module, class_name)
+        cls = resolve_class(obj['_class'])
         unpickled = cls.__new__(cls)
         unpickled.__setstate__(obj)
 
@@ -97,6 +145,70 @@ def unpickle(obj: Any) -> Any:
     return unpickled
 
 
+def count_bytes(state: Dict[str, Any]) -> None:
+    '''Учитывает размер сериализованного документа в статистике текущей
+    единицы работы, если она измеряет размер записи.'''
+    uow = context.get()
+    if uow is not None and uow.measure_bytes:
+        uow.stats.bytes_serialized += len(
+            encode(state, codec_options=get_codec_options()))
+
+
+def copy_value(value: Any, parent: Any = None) -> Any:
+    '''Returns a copy of embedded value for a savepoint. Referenced
+    documents are not copied. Copied nodes which belonged to `parent`
+    are attached to it.'''
+    copied: Any
+
+    if type(value) in SCALARS:  # pylint: disable=unidiomatic-typecheck
+        return value
+
+    if isinstance(value, (Stored, LazyRef)):
+        return value
+
+    if isinstance(value, Accumulator):
+        copied = copy(value)
+
+    elif isinstance(value, Document):
+        copied = type(value).__new__(type(value))
+        copied.__dict__.update(copy_state(value.__dict__, copied))
+
+    elif isinstance(value, list):
+        copied = type(value)()
+        list.extend(copied, (copy_value(x, copied) for x in value))
+
+    elif isinstance(value, dict):
+        copied = type(value)()
+        dict.update(copied,
+                    ((k, copy_value(v, copied)) for k, v in value.items()))
+
+    else:
+        return value
+
+    if isinstance(value, Node):
+        if getattr(value, '__node_parent__', None) is None:
+            parent = None
+        copied.__dict__['__node_parent__'] = parent
+        copied.__dict__['__node_name__'] = getattr(value, '__node_name__',
+                                                   None)
+    return copied
+
+
+def copy_state(state: Dict[str, Any], parent: Any) -> Dict[str, Any]:
+    '''Returns a copy of object `__dict__` for a savepoint. Loaded but
+    not materialized values are never changed in place, so they are not
+    copied.'''
+    copied = {}
+    for key, value in state.items():
+        if key in ('__node_parent__', '__node_name__'):
+            continue
+        if key == '__raw__':
+            copied[key] = dict(value)
+        else:
+            copied[key] = copy_value(value, parent)
+    return copied
+
+
 @dataclass(init=False)
 class Node:
     '''Abstract node for recursivity support.'''
@@ -115,6 +227,12 @@ class Node:
             parent_keys = {'{}.{}'.format(name, x) for x in keys}
             parent.mark_dirty(parent_keys)
 
+    def touch(self) -> None:
+        '''Notify root node that it is about to change.'''
+        parent = getattr(self, '__node_parent__', None)
+        if parent is not None:
+            parent.touch()
+
 
 @dataclass(init=False)
 class EmbeddedList(Node, List[T]):
@@ -131,20 +249,222 @@ class EmbeddedDict(Node, Dict[str, Any]):
     '''Dict that stored in database'''
 
 
+class Accumulator(Node):
+    '''Поле, изменения которого накапливаются в единице работы и
+    сохраняются оператором :attr:`operator` без чтения документа.
+    Поля объявляются в `__metadata__['accumulators']`::
+
+        class Page(Stored):
+            __metadata__ = {
+                'accumulators': {
+                    'views': Counter,
+                }
+            }
+
+        page.views += 1
+
+    Базовый класс записывает последнее значение оператором `$set`,
+    наследники переопределяют :attr:`operator` и :meth:`merge`.
+    Накопленные изменения отправляются вместе с остальными полями
+    документа. Новое поле, ещё не сохранённое в базе данных,
+    записывается целиком. В сравнениях и арифметике поле ведёт себя как
+    его значение :attr:`value`, но изменяется только через `+=` или
+    :meth:`record`.'''
+
+    operator: str = '$set'
+
+    def __init__(self, value: Any = None) -> None:
+        # pylint: disable=super-init-not-called
+        super().__post_init__()
+        self.value: Any = value
+        self.pending: Any = None
+        self.base: Any = value
+        self.saved: bool = False
+
+    def merge(self, first: Any, second: Any) -> Any:
+        '''Объединяет два изменения поля. Для оператора `$set` остаётся
+        последнее записанное значение.'''
+        # pylint: disable=unused-argument
+        return second
+
+    def record(self, value: Any) -> None:
+        '''Учитывает изменение `value` и помечает поле изменённым.'''
+        self.touch()
+        if self.pending is None:
+            self.base = self.value
+            self.pending = value
+        else:
+            self.pending = self.merge(self.pending, value)
+        if self.value is None:
+            self.value = value
+        else:
+            self.value = self.merge(self.value, value)
+        parent = self.__node_parent__
+        if parent is not None:
+            parent.mark_dirty({self.__node_name__})
+
+    def discard(self) -> None:
+        '''Отменяет изменения, не записанные в базу данных.'''
+        if self.pending is not None:
+            self.value = self.base
+            self.pending = None
+
+    def __eq__(self, other: Any) -> bool:
+        return self.value == _value(other)
+
+    def __lt__(self, other: Any) -> bool:
+        return self.value < _value(other)
+
+    def __le__(self, other: Any) -> bool:
+        return self.value <= _value(other)
+
+    def __gt__(self, other: Any) -> bool:
+        return self.value > _value(other)
+
+    def __ge__(self, other: Any) -> bool:
+        return self.value >= _value(other)
+
+    __hash__ = None  # type: ignore
+
+    def __bool__(self) -> bool:
+        return bool(self.value)
+
+    def __str__(self) -> str:
+        return str(self.value)
+
+    def __format__(self, spec: str) -> str:
+        return format(self.value, spec)
+
+    def __repr__(self) -> str:
+        return '{}({!r})'.format(type(self).__name__, self.value)
+
+
+def _value(obj: Any) -> Any:
+    if isinstance(obj, Accumulator):
+        return obj.value
+    return obj
+
+
+class Counter(Accumulator):
+    '''Счётчик, изменяемый оператором `$inc`.'''
+
+    operator = '$inc'
+
+    def __init__(self, value: Any = 0) -> None:
+        super().__init__(value)
+
+    def merge(self, first: Any, second: Any) -> Any:
+        return first + second
+
+    def add(self, delta: Any = 1) -> None:
+        '''Увеличивает счётчик на `delta`.'''
+        self.record(delta)
+
+    def __iadd__(self, delta: Any) -> 'Counter':
+        self.record(delta)
+        return self
+
+    def __isub__(self, delta: Any) -> 'Counter':
+        self.record(-delta)
+        return self
+
+    # Арифметика возвращает обычные числа и не изменяет счётчик
+    def __add__(self, other: Any) -> Any:
+        return self.value + _value(other)
+
+    def __radd__(self, other: Any) -> Any:
+        return other + self.value
+
+    def __sub__(self, other: Any) -> Any:
+        return self.value - _value(other)
+
+    def __rsub__(self, other: Any) -> Any:
+        return other - self.value
+
+    def __mul__(self, other: Any) -> Any:
+        return self.value * _value(other)
+
+    def __rmul__(self, other: Any) -> Any:
+        return other * self.value
+
+    def __truediv__(self, other: Any) -> Any:
+        return self.value / _value(other)
+
+    def __rtruediv__(self, other: Any) -> Any:
+        return other / self.value
+
+    def __floordiv__(self, other: Any) -> Any:
+        return self.value // _value(other)
+
+    def __rfloordiv__(self, other: Any) -> Any:
+        return other // self.value
+
+    def __mod__(self, other: Any) -> Any:
+        return self.value % _value(other)
+
+    def __rmod__(self, other: Any) -> Any:
+        return other % self.value
+
+    def __neg__(self) -> Any:
+        return -self.value
+
+    def __pos__(self) -> Any:
+        return +self.value
+
+    def __abs__(self) -> Any:
+        return abs(self.value)
+
+    def __int__(self) -> int:
+        return int(self.value)
+
+    def __float__(self) -> float:
+        return float(self.value)
+
+    def __index__(self) -> int:
+        return self.value.__index__()
+
+
+class Minimum(Accumulator):
+    '''Наименьшее из записанных значений, сохраняется оператором
+    `$min`.'''
+
+    operator = '$min'
+
+    def merge(self, first: Any, second: Any) -> Any:
+        return min(first, second)
+
+
+class Maximum(Accumulator):
+    '''Наибольшее из записанных значений, сохраняется оператором
+    `$max`.'''
+
+    operator = '$max'
+
+    def merge(self, first: Any, second: Any) -> Any:
+        return max(first, second)
+
+
 @dataclass(init=False)
 class Document(DocumentType, Node):
     '''Abstract database document.'''
 
-    def __getstate__(self) -> Dict[str, Any]:
+    def __getstate__(self, attrs: Optional[Set[str]] = None
+                     ) -> Dict[str, Any]:
+        '''Returns document state for MongoDB. If `attrs` is given, only
+        these attributes are pickled, e.g. the ones being updated, so
+        unchanged compressed fields are not compressed again.'''
         metadata = type(self).__metadata__
         include = metadata.get('include_attrs', [])
         exclude = metadata.get('exclude_attrs', [])
         replace = metadata.get('replace_attrs', {})
         picklers = metadata.get('picklers', {})
+        references = metadata.get('references', {})
 
         cls = type(self)
         state = {'_class': '{}.{}'.format(cls.__module__, cls.__name__)}
         for attr in self.__dict__:
+            if attrs is not None and attr not in attrs:
+                continue
             key = attr
             if key in replace:
                 key = replace[key]
@@ -154,35 +474,107 @@ class Document(DocumentType, Node):
                 continue
             if attr in picklers:
                 value = picklers[attr]['pickle'](self, getattr(self, attr))
+            elif attr in references:
+                value = pickle_reference(getattr(self, attr),
+                                         references[attr])
             else:
                 value = pickle(getattr(self, attr))
             if value is not None:
                 state[key] = value
+
+        # Untouched sub-trees are passed as they were loaded
+        for attr, value in self.__dict__.get('__raw__', {}).items():
+            if attrs is not None and attr not in attrs:
+                continue
+            key = replace.get(attr, attr)
+            if key not in exclude:
+                state[key] = value
+
         return state
 
-    def __setstate__(self, data: Dict[str, Any], recurse=True):
+    def __setstate__(self, data: Dict[str, Any], recurse=True,
+                     readonly=False):
         replace = self.__metadata__.get('replace_attrs', {})
         replaced = dict([(v, k) for k, v in replace.items()])
         picklers = self.__metadata__.get('picklers', {})
+        accumulators = self.__metadata__.get('accumulators', {})
+        cls = type(self)
 
-        state = {'_saved': True}
+        state: Dict[str, Any] = {'_saved': True}
+        if readonly:
+            state['__readonly__'] = True
+        raw: Dict[str, Any] = {}
         for key, value in data.items():
             if key in replaced:
                 key = replaced[key]
+            if key in picklers:
+                deferred = picklers[key].get('lazy', False)
+            else:
+                deferred = isinstance(value, (dict, list))
+            if deferred and not hasattr(cls, key):
+                # Embedded and compressed values are materialized on
+                # first access
+                raw[key] = value
+                continue
             if key in picklers:
                 obj = picklers[key]['unpickle'](self, state, value)
+                if readonly:
+                    obj = freeze(obj)
+            elif readonly:
+                obj = freeze(value)
+            elif key in accumulators:
+                obj = accumulators[key](value)
+                obj.saved = True
             else:
                 obj = unpickle(value)
             state[key] = obj
-            if isinstance(obj, Node):
+            if not readonly and isinstance(obj, Node):
                 obj.__node_parent__ = self
                 obj.__node_name__ = key
 
+        if raw:
+            state['__raw__'] = raw
+
         self.__dict__.update(state)
 
+    def __materialize__(self, key: str) -> Any:
+        '''Builds embedded value `key` from loaded data and attaches it
+        to the document.'''
+        raw = self.__dict__['__raw__']
+        readonly = self.__dict__.get('__readonly__', False)
+        pickler = self.__metadata__.get('picklers', {}).get(key)
+        if pickler is not None:
+            value = pickler['unpickle'](self, self.__dict__, raw.pop(key))
+            if readonly:
+                value = freeze(value)
+        elif readonly:
+            value = freeze(raw.pop(key))
+        else:
+            value = unpickle(raw.pop(key))
+        if not raw:
+            del self.__dict__['__raw__']
+        if not readonly and isinstance(value, Node):
+            value.__node_parent__ = self
+            value.__node_name__ = key
+        self.__dict__[key] = value
+        return value
+
     def __setattr__(self, key: str, value: Any) -> None:
         logger.debug('Document.__setattr__ (%s) set %s=%s', self, key, value)
 
+        if '__readonly__' in self.__dict__:
+            raise ReadOnly('{} is read-only'.format(type(self).__name__))
+
+        if key not in ('__unit_of_work__', '__node_parent__',
+                       '__node_name__'):
+            self.touch()
+
+        raw = self.__dict__.get('__raw__')
+        if raw is not None and key in raw:
+            del raw[key]
+            if not raw:
+                del self.__dict__['__raw__']
+
         super().__setattr__(key, value)
 
         if key not in ('__node_parent__', '__node_name__'):
@@ -197,6 +589,8 @@ class Document(DocumentType, Node):
     def __getattr__(self, key: str) -> Any:
         if key in self.__dict__:
             return self.__dict__[key]
+        if key in self.__dict__.get('__raw__', ()):
+            return self.__materialize__(key)
 
 
 @dataclass(init=False)
@@ -256,82 +650,704 @@ class Stored(Document):
                     'Changing object without database context.',
                     stack_info=True)
 
+    def mark_upsert(self) -> None:
+        '''Mark document to be inserted or replaced if it exists.'''
+        if '__readonly__' in self.__dict__:
+            raise ReadOnly('{} is read-only'.format(type(self).__name__))
+        uow = context.get()
+        if uow is not None:
+            logger.debug('Mark object %s for upsert', self)
+            uow.register_upsert(self)
+        else:
+            logger.warning(
+                'Merging object without database context.', stack_info=True)
+
     def mark_removed(self) -> None:
         '''Mark document for removal.'''
+        if '__readonly__' in self.__dict__:
+            raise ReadOnly('{} is read-only'.format(type(self).__name__))
         if getattr(self, '_id', None) is not None:
             logger.debug('Marking object %s for deletion', self)
             uow = context.get()
             if uow is not None:
                 uow.register_removed(self)
 
+    # Точки сохранения
+    def touch(self) -> None:
+        '''Saves object state in the current nested unit of work before
+        the first change, see :meth:`UnitOfWork.save_point`.'''
+        if getattr(self, '_id', None) is not None:
+            uow = context.get()
+            if uow is not None:
+                uow.save_point(self)
+
+    def save_state(self) -> Dict[str, Any]:
+        '''Returns a copy of object state for :meth:`restore_state`.
+        Embedded values are copied, referenced documents are kept as
+        they are.'''
+        state = copy_state(self.__dict__, self)
+        for key in ('__node_parent__', '__node_name__'):
+            if key in self.__dict__:
+                state[key] = self.__dict__[key]
+        return state
+
+    def restore_state(self, state: Dict[str, Any]) -> None:
+        '''Returns object to the state saved by :meth:`save_state`.'''
+        self.__dict__.clear()
+        self.__dict__.update(state)
+
     # Collection
     @classmethod
-    def get_collection(cls) -> Collection:
-        '''Returns MongoDB collection for this class.'''
+    def get_collection_name(cls) -> str:
+        '''Returns MongoDB collection name for this class.'''
         name = cls.__metadata__.get('collection')
         if name is None:
             name = str(cls.__name__).lower()
-        return db[name]
+        return name
+
+    @classmethod
+    def get_collection(cls, read_preference: Any = None) -> 'Collection':
+        '''Returns MongoDB collection for this class. Concurrency limit
+        from `__metadata__['concurrency']` is registered in
+        `db.admission`.'''
+        metadata = cls.__metadata__
+        name = cls.get_collection_name()
+        collection = db.get_database(
+            metadata.get('connection'),
+            metadata.get('database'))[name]
+        if 'concurrency' in metadata:
+            db.admission.limits.setdefault((collection.database.name, name),
+                                           metadata['concurrency'])
+        if read_preference is not None:
+            collection = collection.with_options(
+                read_preference=get_read_preference(read_preference))
+        return collection
+
+    @classmethod
+    def get_collection_options(cls) -> Dict[str, Any]:
+        '''Returns options for collection creation. Time series collection
+        is described by `__metadata__['timeseries']` with `time_field`,
+        `meta_field`, `granularity` and `expire_after` (in seconds) keys,
+        field names are given as attribute names.'''
+        timeseries = cls.__metadata__.get('timeseries')
+        if timeseries is None:
+            return {}
+        replace = cls.__metadata__.get('replace_attrs', {})
+        options: Dict[str, Any] = {'timeseries': {}}
+        for key, value in timeseries.items():
+            if key == 'expire_after':
+                options['expireAfterSeconds'] = value
+            elif key in TIMESERIES_OPTIONS:
+                if key != 'granularity':
+                    value = replace.get(value, value)
+                options['timeseries'][TIMESERIES_OPTIONS[key]] = value
+            else:
+                raise ValueError('Unknown time series option {}'.format(key))
+        if 'timeField' not in options['timeseries']:
+            raise ValueError('Time series requires time_field')
+        return options
+
+    @classmethod
+    async def create_collection(cls) -> bool:
+        '''Creates collection for this class with options from
+        :meth:`get_collection_options`. Returns False if collection
+        already exists.'''
+        # pylint: disable=import-outside-toplevel
+        from pymongo.errors import CollectionInvalid
+        metadata = cls.__metadata__
+        database = db.get_database(metadata.get('connection'),
+                                   metadata.get('database'))
+        try:
+            await database.create_collection(cls.get_collection_name(),
+                                             **cls.get_collection_options())
+        except CollectionInvalid:
+            return False
+        return True
+
+    @classmethod
+    def for_collection(cls, name: str) -> Optional[type]:
+        '''Returns class stored in collection `name` or None.'''
+        if name not in _classes:
+            stack = [Stored]
+            while stack:
+                klass = stack.pop()
+                _classes.setdefault(klass.get_collection_name(), klass)
+                stack.extend(klass.__subclasses__())
+        return _classes.get(name)
+
+    @classmethod
+    def get_read_preference(cls, read_preference: Any = None) -> Any:
+        '''Returns read preference for queries: explicitly passed one,
+        then unit of work one, then `__metadata__['read_preference']`.'''
+        if read_preference is None:
+            uow = context.get()
+            if uow is not None:
+                read_preference = uow.read_preference
+        if read_preference is None:
+            read_preference = cls.__metadata__.get('read_preference')
+        return read_preference
 
     # Запрос объектов из базы данных
     @classmethod
-    def find(cls, query: dict) -> Cursor:
-        '''Возвращает курсор для перебора объектов.'''
-        return cls.get_collection().find(query)
+    def find(cls,
+             query: dict,
+             read_preference: Any = None,
+             executor: Optional[Executor] = None,
+             threshold: int = 1 << 20,
+             readonly: bool = False) -> Union['Cursor', DecodingCursor]:
+        '''Возвращает курсор для перебора объектов. Если указан пул
+        `executor`, то пакеты документов размером от `threshold` байт
+        декодируются в нём, а не в цикле событий. С `readonly` объекты
+        загружаются только для чтения (см. :mod:`bigur.store.readonly`).'''
+        collection = cls.get_collection(
+            cls.get_read_preference(read_preference))
+        if executor is not None:
+            return collection.find_decoded(
+                query, executor=executor, threshold=threshold,
+                readonly=readonly)
+        return collection.find(query, readonly=readonly)
 
     @classmethod
-    async def find_one(cls, query: dict) -> Cursor:
+    async def find_one(cls, query: dict,
+                       read_preference: Any = None,
+                       readonly: bool = False) -> 'Cursor':
         '''Возвращает один объект из БД, удовлетворяющий условиям
-        поиска `query`, или None.'''
-        return await cls.get_collection().find_one(query)
+        поиска `query`, или None. С `readonly` объект загружается только
+        для чтения.'''
+        collection = cls.get_collection(
+            cls.get_read_preference(read_preference))
+        uow = context.get()
+        if uow is not None:
+            uow.track_lookup(collection.name)
+        return await collection.find_one(query, readonly=readonly)
+
+    @classmethod
+    def find_range(cls,
+                   start: datetime,
+                   end: datetime,
+                   meta: Any = None,
+                   query: Optional[dict] = None,
+                   read_preference: Any = None,
+                   readonly: bool = False) -> 'Cursor':
+        '''Возвращает курсор по документам временного ряда (см.
+        `__metadata__['timeseries']`) со временем в интервале
+        [`start`, `end`), отсортированным по времени. Если указано `meta`,
+        выбираются только документы с таким значением поля метаданных.'''
+        options = cls.get_collection_options().get('timeseries')
+        if options is None:
+            raise ValueError('{} is not a time series'.format(cls.__name__))
+        time_field = options['timeField']
+        condition = dict(query or {})
+        condition[time_field] = {'$gte': start, '$lt': end}
+        if meta is not None:
+            if 'metaField' not in options:
+                raise ValueError('{} has no meta field'.format(cls.__name__))
+            condition[options['metaField']] = meta
+        return cls.find(condition, read_preference,
+                        readonly=readonly).sort(time_field, 1)
+
+    @classmethod
+    async def paginate(cls,
+                       query: dict,
+                       sort: List[Tuple[str, int]],
+                       limit: int,
+                       token: Optional[str] = None,
+                       read_preference: Any = None) -> 'Page':
+        '''Возвращает страницу из `limit` объектов, отсортированных по
+        `sort`, и маркер для запроса следующей страницы. Следующая страница
+        выбирается условием по значениям ключей сортировки последнего
+        объекта, поэтому стоимость запроса не зависит от номера
+        страницы.'''
+        # pylint: disable=import-outside-toplevel
+        from bigur.store.pagination import (Page, decode_token, encode_token,
+                                            keyset_filter, normalize_sort,
+                                            sort_values)
+        sort = normalize_sort(sort)
+        if token is not None:
+            query = {'$and': [query, keyset_filter(sort, decode_token(token))]}
+        cursor = cls.find(query, read_preference).sort(sort).limit(limit + 1)
+
+        page = Page([x async for x in cursor])
+        if len(page.items) > limit:
+            del page.items[limit:]
+            last = page.items[-1]
+            if isinstance(last, Document):
+                last = last.__getstate__()
+            page.token = encode_token(sort_values(last, sort))
+        return page
+
+    @classmethod
+    async def segment_cursors(cls,
+                              query: dict,
+                              segments: int,
+                              oversample: int = 20,
+                              read_preference: Any = None,
+                              executor: Optional[Executor] = None
+                              ) -> List['Cursor']:
+        '''Делит коллекцию на `segments` диапазонов `_id` примерно равного
+        размера по случайной выборке (`$sample`) и возвращает курсоры по
+        каждому из них. Пул `executor` передаётся в :meth:`find`.'''
+        # pylint: disable=import-outside-toplevel
+        from bigur.store.scan import range_query, split_ranges
+        ranges = [(None, None)]
+        if segments > 1:
+            sample = cls.aggregate([{
+                '$sample': {'size': segments * oversample}
+            }, {
+                '$project': {'_id': 1}
+            }, {
+                '$sort': {'_id': 1}
+            }], read_preference=read_preference)
+            ids = [x['_id'] for x in await sample.to_list(None)]
+            ranges = split_ranges(ids, segments)
+        return [cls.find(range_query(query, x), read_preference, executor)
+                for x in ranges]
+
+    @classmethod
+    async def parallel_scan(cls,
+                            query: dict,
+                            segments: int = 4,
+                            buffer: int = 1000,
+                            read_preference: Any = None,
+                            executor: Optional[Executor] = None
+                            ) -> AsyncIterator:
+        '''Просматривает объекты, удовлетворяющие `query`, одновременно
+        по `segments` курсорам и возвращает их в одном потоке. Порядок
+        объектов не определён. Для раздельной обработки сегментов
+        используйте :meth:`segment_cursors`.'''
+        from bigur.store.scan import merge  # pylint: disable=C0415
+        cursors = await cls.segment_cursors(
+            query, segments, read_preference=read_preference,
+            executor=executor)
+        async for obj in merge(cursors, buffer):
+            yield obj
+
+    @classmethod
+    def aggregate(cls,
+                  pipeline: List[Dict[str, Any]],
+                  allow_disk_use: bool = False,
+                  batch_size: Optional[int] = None,
+                  read_preference: Any = None,
+                  **kwargs) -> 'CommandCursor':
+        '''Выполняет конвейер агрегации над коллекцией класса. Возвращает
+        курсор, из которого строки с `_class` выходят объектами, а
+        остальные словарями.'''
+        if allow_disk_use:
+            kwargs['allowDiskUse'] = True
+        if batch_size is not None:
+            kwargs['batchSize'] = batch_size
+        collection = cls.get_collection(
+            cls.get_read_preference(read_preference))
+        return collection.aggregate(pipeline, **kwargs)
+
+    @classmethod
+    def lookup(cls, attr: str, target: type) -> List[Dict[str, Any]]:
+        '''Возвращает стадии агрегации, подгружающие на сервере объект
+        класса `target` по ссылке в атрибуте `attr`. Курсор
+        :meth:`aggregate` подставляет найденный объект в
+        :class:`~.LazyRef`, поэтому его :meth:`~.LazyRef.resolve` уже не
+        обращается к базе данных.'''
+        key = cls.__metadata__.get('replace_attrs', {}).get(attr, attr)
+        field = '_lookup.{}'.format(attr)
+        return [{
+            '$addFields': {
+                # DBRef is stored as {$ref, $id}, so take the second field
+                field: {
+                    '$arrayElemAt': [{
+                        '$objectToArray': '${}'.format(key)
+                    }, 1]
+                }
+            }
+        }, {
+            '$lookup': {
+                'from': target.get_collection_name(),
+                'localField': '{}.v'.format(field),
+                'foreignField': '_id',
+                'as': field
+            }
+        }]
+
+    # Выгрузка и загрузка
+    @classmethod
+    async def export(cls,
+                     path: str,
+                     query: Optional[dict] = None,
+                     format: str = 'bson',  # pylint: disable=W0622
+                     compression: Optional[str] = None,
+                     **kwargs) -> int:
+        '''Выгружает документы класса, удовлетворяющие `query`, в файл
+        `path` в формате `bson` или `ndjson`. Сжатие определяется по
+        расширению файла, если не указано явно.'''
+        # pylint: disable=import-outside-toplevel
+        from bigur.store.transfer import export, guess_compression, open_file
+        if compression is None:
+            compression = guess_compression(path)
+        with open_file(path, 'w', compression) as stream:
+            return await export(cls.get_collection(), stream, query, format,
+                                **kwargs)
+
+    @classmethod
+    async def import_from(cls,
+                          path: str,
+                          format: str = 'bson',  # pylint: disable=W0622
+                          compression: Optional[str] = None,
+                          **kwargs) -> int:
+        '''Загружает документы класса из файла `path`, созданного
+        :meth:`export`.'''
+        from bigur.store.transfer import load  # pylint: disable=C0415
+        return await load(cls.get_collection(), path, format, compression,
+                          **kwargs)
 
     # Изменение объектов
     @classmethod
-    async def insert_one(cls, document: 'Stored') -> InsertOneResult:
+    def get_shard_filter(cls, document: 'Stored') -> Dict[str, Any]:
+        '''Возвращает значения ключа шардирования документа из
+        `__metadata__['shard_key']` (списка имён атрибутов). Значения
+        ключа считаются неизменными после сохранения документа.'''
+        shard_key = cls.__metadata__.get('shard_key')
+        if not shard_key:
+            return {}
+        replace = cls.__metadata__.get('replace_attrs', {})
+        values: Dict[str, Any] = {}
+        for attr in shard_key:
+            key = replace.get(attr, attr)
+            if key != '_id':
+                values[key] = pickle(getattr(document, attr))
+        return values
+
+    @classmethod
+    def get_id_filter(cls, document: 'Stored') -> Dict[str, Any]:
+        '''Возвращает условие поиска документа в базе данных. Значения
+        ключа шардирования добавляются, чтобы mongos направил запрос на
+        один шард.'''
+        query = {'_id': document.id}
+        query.update(cls.get_shard_filter(document))
+        return query
+
+    @classmethod
+    def get_operators(cls, document: 'Stored',
+                      keys: Optional[Set[str]] = None
+                      ) -> Dict[str, Dict[str, Any]]:
+        '''Возвращает операторы обновления для изменений, накопленных в
+        полях из `__metadata__['accumulators']`, если указаны `keys`, то
+        только в изменённых полях из `keys`. Поля, ещё не сохранённые в
+        базе данных, записываются целиком. Изменения сбрасываются только
+        после успешной записи, см. :meth:`reset_accumulators`.'''
+        accumulators = cls.__metadata__.get('accumulators')
+        if not accumulators:
+            return {}
+        replace = cls.__metadata__.get('replace_attrs', {})
+        operators: Dict[str, Dict[str, Any]] = {}
+        for attr in accumulators:
+            if keys is not None and attr not in keys:
+                continue
+            value = document.__dict__.get(attr)
+            if not isinstance(value, Accumulator):
+                continue
+            if value.saved and value.pending is not None:
+                key = replace.get(attr, attr)
+                operators.setdefault(value.operator, {})[key] = value.pending
+        return operators
+
+    @classmethod
+    def reset_accumulators(cls, document: 'Stored') -> None:
+        '''Отмечает изменения накопительных полей документа сохранёнными.
+        Вызывается после записи документа в базу данных или постановки
+        записи в очередь отложенной записи.'''
+        for attr in cls.__metadata__.get('accumulators', ()):
+            value = document.__dict__.get(attr)
+            if isinstance(value, Accumulator):
+                value.pending = None
+                value.saved = True
+
+    @classmethod
+    def discard_accumulators(cls, document: 'Stored') -> None:
+        '''Отменяет незаписанные изменения накопительных полей документа
+        при откате единицы работы.'''
+        for attr in cls.__metadata__.get('accumulators', ()):
+            value = document.__dict__.get(attr)
+            if isinstance(value, Accumulator):
+                value.discard()
+
+    @classmethod
+    def get_update(cls, state: Dict[str, Any],
+                   keys: Set[str],
+                   operators: Optional[Dict[str, Dict[str, Any]]] = None
+                   ) -> Dict[str, Any]:
+        '''Возвращает запрос на обновление ключей `keys` документа с
+        состоянием `state`. Ключи из `operators` (см.
+        :meth:`get_operators`) обновляются своими операторами.'''
+        update: Dict[str, Any] = {}
+        remove: Dict[str, None] = {}
+        if operators:
+            accumulated = {k for x in operators.values() for k in x}
+            keys = keys - accumulated
+        for key in keys:
+            path = key.split('.')
+            obj: Any = state
+            for index, attr in enumerate(path):
+                if obj is None:
+                    break
+                if not isinstance(obj, dict):
+                    # Value is stored as a whole, e.g. compressed field
+                    key = '.'.join(path[:index])
+                    break
+                obj = obj.get(attr)
+            if obj is None:
+                remove[key] = obj
+            else:
+                update[key] = obj
+
+        # Nested keys are covered by their updated parents
+        for fields in (update, remove):
+            for key in [x for x in fields if '.' in x]:
+                path = key.split('.')
+                if any('.'.join(path[:i]) in update or
+                       '.'.join(path[:i]) in remove
+                       for i in range(1, len(path))):
+                    del fields[key]
+
+        query: dict = {}
+        if update:
+            query['$set'] = update
+        if remove:
+            query['$unset'] = remove
+        for operator, fields in (operators or {}).items():
+            query[operator] = fields
+        logger.debug('Запрос на обновление: %s', query)
+        return query
+
+    @classmethod
+    def insert_operation(cls, document: 'Stored') -> 'InsertOne':
+        '''Возвращает операцию вставки документа для `bulk_write`.'''
+        from pymongo import InsertOne  # pylint: disable=C0415
+        state = document.__getstate__()
+        count_bytes(state)
+        return InsertOne(state)
+
+    @classmethod
+    def update_operation(cls, document: 'Stored',
+                         keys: Optional[Set[str]] = None
+                         ) -> Union['UpdateOne', 'ReplaceOne']:
+        '''Возвращает операцию обновления документа для `bulk_write`.'''
+        from pymongo import ReplaceOne, UpdateOne  # pylint: disable=C0415
+        operators = cls.get_operators(document, keys)
+        if keys:
+            state = document.__getstate__({x.split('.')[0] for x in keys})
+            query = cls.get_update(state, keys, operators)
+            count_bytes(query)
+            return UpdateOne(cls.get_id_filter(document), query)
+        state = document.__getstate__()
+        count_bytes(state)
+        return ReplaceOne(cls.get_id_filter(document), state)
+
+    @classmethod
+    def upsert_operation(cls, document: 'Stored'
+                         ) -> Union['UpdateOne', 'ReplaceOne']:
+        '''Возвращает операцию вставки или замены документа для
+        `bulk_write`. Поля из `__metadata__['create_only']` записываются
+        только при вставке через `$setOnInsert`, накопительные поля
+        записываются целиком.'''
+        from pymongo import ReplaceOne, UpdateOne  # pylint: disable=C0415
+        state = document.__getstate__()
+        count_bytes(state)
+        metadata = cls.__metadata__
+        create_only = metadata.get('create_only')
+        if not create_only:
+            return ReplaceOne(cls.get_id_filter(document), state, upsert=True)
+
+        replace = metadata.get('replace_attrs', {})
+        on_insert = {}
+        for attr in create_only:
+            key = replace.get(attr, attr)
+            if key in state:
+                on_insert[key] = state.pop(key)
+        state.pop('_id', None)
+        query: Dict[str, Any] = {'$set': state}
+        if on_insert:
+            query['$setOnInsert'] = on_insert
+        return UpdateOne(cls.get_id_filter(document), query, upsert=True)
+
+    @classmethod
+    def delete_operation(cls, document: 'Stored') -> 'DeleteOne':
+        '''Возвращает операцию удаления документа для `bulk_write`.'''
+        from pymongo import DeleteOne  # pylint: disable=C0415
+        return DeleteOne(cls.get_id_filter(document))
+
+    @classmethod
+    async def insert_one(cls, document: 'Stored') -> 'InsertOneResult':
         '''Вставляет документ в базу данных.'''
         collection = cls.get_collection()
         state = document.__getstate__()
-        return await collection.insert_one(state)
+        count_bytes(state)
+        result = await collection.insert_one(state)
+        cls.reset_accumulators(document)
+        return result
+
+    @classmethod
+    async def insert_many(cls,
+                          documents: List['Stored'],
+                          profile: Optional[IngestionProfile] = None
+                          ) -> List['Stored']:
+        '''Вставляет документы в базу данных одним запросом с учётом
+        профиля вставки. Возвращает документы, не вставленные из-за
+        дубликата ключа.'''
+        # pylint: disable=import-outside-toplevel
+        from pymongo.errors import BulkWriteError
+        from pymongo.write_concern import WriteConcern
+        if profile is None:
+            profile = IngestionProfile(ordered=True)
+        collection = cls.get_collection()
+        if profile.write_concern is not None:
+            collection = collection.with_options(
+                write_concern=WriteConcern(**profile.write_concern))
+
+        states = [x.__getstate__() for x in documents]
+        for state in states:
+            count_bytes(state)
+
+        try:
+            await collection.insert_many(
+                states,
+                ordered=profile.ordered,
+                bypass_document_validation=profile.bypass_document_validation)
+        except BulkWriteError as exc:
+            errors = exc.details.get('writeErrors', [])
+            if profile.ordered or exc.details.get('writeConcernErrors') \
+                    or any(x.get('code') != DUPLICATE_KEY for x in errors):
+                raise
+            logger.warning('%d documents were not inserted into %s: '
+                           'duplicate key', len(errors), collection.name)
+            failed = {x['index'] for x in errors}
+            for index, document in enumerate(documents):
+                if index not in failed:
+                    cls.reset_accumulators(document)
+            return [documents[x['index']] for x in errors]
+        for document in documents:
+            cls.reset_accumulators(document)
+        return []
 
     @classmethod
     async def update_one(cls,
                          document: 'Stored',
-                         keys: Optional[Set[str]] = None) -> UpdateResult:
+                         keys: Optional[Set[str]] = None) -> 'UpdateResult':
         '''Обновляет документ в базу данных. Если указаны keys, то
         обновление происходит через `update_one`, иначе через
         `replace_one`.'''
         collection = cls.get_collection()
 
-        state = document.__getstate__()
+        operators = cls.get_operators(document, keys)
 
         if keys:
-            update: Dict[str, Any] = {}
-            remove: Dict[str, None] = {}
-            for key in keys:
-                path = key.split('.')
-                obj: Any = state
-                for attr in path:
-                    obj = obj.get(attr)
-                if obj is None:
-                    remove[key] = obj
-                else:
-                    update[key] = obj
-
-            query: dict = {}
-            if update:
-                query['$set'] = update
-            if remove:
-                query['$unset'] = remove
-            logger.debug('Запрос на обновление: %s', query)
-
-            return await collection.update_one({'_id': document.id}, query)
+            state = document.__getstate__({x.split('.')[0] for x in keys})
+            query = cls.get_update(state, keys, operators)
+            count_bytes(query)
+            result = await collection.update_one(
+                cls.get_id_filter(document), query)
         else:
-            return collection.replace_one({'_id': document.id}, state)
+            state = document.__getstate__()
+            count_bytes(state)
+            result = await collection.replace_one(
+                cls.get_id_filter(document), state)
+        cls.reset_accumulators(document)
+        return result
 
     @classmethod
-    async def delete_one(cls, document: 'Stored') -> DeleteResult:
+    async def delete_one(cls, document: 'Stored') -> 'DeleteResult':
         '''Удаляет `document` из базы данных.'''
-        return await cls.get_collection().delete_one({'_id': document.id})
+        return await cls.get_collection().delete_one(
+            cls.get_id_filter(document))
+
+    @classmethod
+    async def refresh_snapshots(cls, target: 'Stored') -> int:
+        '''Обновляет поля `target`, скопированные в ссылки на него (см.
+        `__metadata__['references']`), в документах класса и его
+        наследников. Обновляются ссылки в атрибутах верхнего уровня, а
+        поиск по ним идёт через `<атрибут>.$id`. Возвращает число
+        изменённых документов.'''
+        ref_collection = type(target).get_collection_name()
+        modified = 0
+        stack = [cls]
+        seen: Set[type] = set()
+        while stack:
+            klass = stack.pop()
+            stack.extend(klass.__subclasses__())
+            if klass in seen:
+                continue
+            seen.add(klass)
+
+            metadata = klass.__metadata__
+            replace = metadata.get('replace_attrs', {})
+            for attr, fields in metadata.get('references', {}).items():
+                key = replace.get(attr, attr)
+                update: Dict[str, Any] = {}
+                remove: Dict[str, Any] = {}
+                for field in fields:
+                    value = pickle(getattr(target, field))
+                    path = '{}.{}'.format(key, field)
+                    if value is None:
+                        remove[path] = ''
+                    else:
+                        update[path] = value
+                query: Dict[str, Any] = {}
+                if update:
+                    query['$set'] = update
+                if remove:
+                    query['$unset'] = remove
+                if not query:
+                    continue
+                result = await klass.get_collection().update_many({
+                    '_class': '{}.{}'.format(klass.__module__,
+                                             klass.__name__),
+                    '{}.$ref'.format(key): ref_collection,
+                    '{}.$id'.format(key): target.id,
+                }, query)
+                modified += result.modified_count
+        return modified
+
+    @classmethod
+    async def upsert_many(cls, documents: List['Stored']) -> 'BulkWriteResult':
+        '''Вставляет документы или заменяет существующие одним
+        запросом.'''
+        result = await cls.get_collection().bulk_write(
+            [cls.upsert_operation(x) for x in documents],
+            ordered=False)
+        for document in documents:
+            cls.reset_accumulators(document)
+        return result
+
+    @classmethod
+    async def update_where(cls, query: Dict[str, Any],
+                           update: Dict[str, Any]) -> SetOperation:
+        '''Обновляет все документы, удовлетворяющие запросу, операторами
+        `update` без загрузки документов. В единице работы операция
+        ставится в очередь и выполняется при сохранении, иначе сразу.
+        Возвращает :class:`~.SetOperation` с числом документов.'''
+        if not isinstance(update, dict) or not update \
+                or not all(x.startswith('$') for x in update):
+            raise ValueError('update must contain only update operators')
+        return await cls._queue_operation(SetOperation(cls, query, update))
+
+    @classmethod
+    async def delete_where(cls, query: Dict[str, Any]) -> SetOperation:
+        '''Удаляет все документы, удовлетворяющие запросу, без загрузки.
+        В единице работы операция ставится в очередь и выполняется при
+        сохранении, иначе сразу.'''
+        return await cls._queue_operation(SetOperation(cls, query))
+
+    @classmethod
+    async def _queue_operation(cls, operation: SetOperation) -> SetOperation:
+        uow = context.get()
+        if uow is None:
+            return await operation.execute()
+        uow.register_operation(operation)
+        return operation
+
+    # Слияние с существующим объектом
+    async def merge(self):
+        '''Помечает объект на вставку или замену существующего документа с
+        тем же ИД без предварительного чтения из базы данных.'''
+        self.mark_upsert()
 
     # Удаление объекта
     async def remove(self):
@@ -4,7 +4,8 @@ __author__ = 'Gennady Kovalev <gik@bigur.ru>'
 __copyright__ = '(c) 2016-2018 Business group for development management'
 __licence__ = 'For license information see LICENSE'
 
-from bigur.store.database import db
+from bigur.store.database import db, read_preference as get_read_preference
+from bigur.store.unit_of_work import context
 
 
 class IntegrityError(Exception):
@@ -17,7 +18,10 @@ class NotResolved(Exception):
 
 class LazyRef(object):
     '''Ленивая ссылка. Автоматически подгружает объект из базы данных при
-    обращении к нему.'''
+    обращении к нему.
+
+    Поля объекта, скопированные в ссылку при сохранении (см.
+    `__metadata__['references']`), доступны и до загрузки объекта.'''
     __own_keys__ = ('dbref', 'obj')
 
     def __init__(self, dbref):
@@ -32,13 +36,53 @@ class LazyRef(object):
     def id(self):
         return self.dbref.id
 
-    async def resolve(self):
-        if self.obj is None:
-            dbase = self.dbref.database
-            if dbase is None:
-                dbase = db
-            collection = dbase[self.dbref.collection]
-            obj = await collection.find_one({'_id': self.dbref.id})
+    @property
+    def snapshot(self):
+        '''Поля объекта, сохранённые в ссылке.'''
+        return {
+            k: v for k, v in self.dbref.as_doc().items()
+            if not k.startswith('$')
+        }
+
+    async def resolve(self, read_preference=None, readonly=False):
+        '''Загружает объект из базы данных. Коллекция и настройка чтения
+        определяются классом, хранящимся в коллекции ссылки, а явно
+        указанная в ссылке база данных имеет приоритет. С `readonly`
+        объект загружается только для чтения, такой объект загружается
+        заново при запросе изменяемого.'''
+        if self.obj is None or (
+                not readonly and getattr(self.obj, '__readonly__', False)):
+            # pylint: disable=import-outside-toplevel
+            from bigur.store.document import Stored
+            uow = context.get()
+            cls = Stored.for_collection(self.dbref.collection)
+            if cls is not None:
+                read_preference = cls.get_read_preference(read_preference)
+            elif read_preference is None and uow is not None:
+                read_preference = uow.read_preference
+
+            if self.dbref.database is None and cls is not None:
+                collection = cls.get_collection(read_preference)
+            else:
+                dbase = db.resolve_database(self.dbref.database)
+                collection = dbase[self.dbref.collection]
+                if read_preference is not None:
+                    collection = collection.with_options(
+                        read_preference=get_read_preference(read_preference))
+
+            if uow is not None:
+                uow.track_lookup(self.dbref.collection)
+            query = {'_id': self.dbref.id}
+            if cls is not None:
+                # Target one shard with shard key values stored in the
+                # reference
+                snapshot = self.snapshot
+                replace = cls.__metadata__.get('replace_attrs', {})
+                for attr in cls.__metadata__.get('shard_key', ()):
+                    key = replace.get(attr, attr)
+                    if key in snapshot:
+                        query[key] = snapshot[key]
+            obj = await collection.find_one(query, readonly=readonly)
             if obj is None:
                 raise IntegrityError(
                     'не смог подгрузить объект из коллекции {} с ИД {}'.format(
@@ -47,7 +91,12 @@ class LazyRef(object):
         return self.obj
 
     def __getattr__(self, key):
+        if key in self.__own_keys__:
+            raise AttributeError(key)
         if self.obj is None:
+            snapshot = self.snapshot
+            if key in snapshot:
+                return snapshot[key]
             raise NotResolved('загрузите объект из базы с помощью .resolve()')
         return getattr(self.obj, key)
 
@@ -0,0 +1,1064 @@
+'''Хранилище в памяти процесса.
+
+Реализует подмножество операций MongoDB, которое использует пакет:
+поиск с основными операторами запросов, вставку, обновление основными
+операторами, удаление, подсчёт, пакетную запись и простые конвейеры
+агрегации. Подходит для быстрых тестов и как основа для кэширующих
+уровней. Подключается через `db.configure('memory://<имя базы>')`.'''
+
+__author__ = 'Gennady Kovalev <gik@bigur.ru>'
+__copyright__ = '(c) 2016-2019 Development management business group'
+__licence__ = 'For license information see LICENSE'
+
+from datetime import datetime
+from functools import cmp_to_key
+from logging import getLogger
+from random import sample as random_sample
+from re import compile as re_compile, IGNORECASE, MULTILINE, DOTALL, VERBOSE
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from bson import DBRef, ObjectId, decode, encode
+from bson.codec_options import (DEFAULT_CODEC_OPTIONS, CodecOptions,
+                                TypeDecoder, TypeRegistry)
+from bson.raw_bson import RawBSONDocument
+from bson.regex import Regex
+from pymongo import (DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany,
+                     UpdateOne)
+from pymongo.errors import (BulkWriteError, CollectionInvalid,
+                            DuplicateKeyError, OperationFailure)
+from pymongo.results import (BulkWriteResult, DeleteResult, InsertManyResult,
+                             InsertOneResult, UpdateResult)
+from pymongo.write_concern import WriteConcern
+
+from bigur.store import abc
+from bigur.store.database import (DUPLICATE_KEY, DocumentOrObject,
+                                  SessionOptions, compile_object, db,
+                                  compile_row, track)
+
+logger = getLogger(__name__)
+
+_MISSING = object()
+
+_REGEX_FLAGS = {'i': IGNORECASE, 'm': MULTILINE, 's': DOTALL, 'x': VERBOSE}
+
+
+class DBRefDecoder(TypeDecoder):
+    '''Хранит ссылки как обычные вложенные документы, чтобы запросы и
+    обновления могли обращаться к их полям.'''
+
+    bson_type = DBRef
+
+    def transform_bson(self, value: DBRef) -> Dict[str, Any]:
+        return dict(value.as_doc())
+
+
+STORAGE_CODEC_OPTIONS = CodecOptions(
+    type_registry=TypeRegistry([DBRefDecoder()]))
+
+
+# Сравнение значений
+def _type_rank(value: Any) -> int:
+    if value is None or value is _MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, bytes):
+        return 6
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime):
+        return 9
+    return 10
+
+
+def compare(left: Any, right: Any) -> int:
+    '''Сравнивает значения в порядке сортировки BSON.'''
+    left_rank, right_rank = _type_rank(left), _type_rank(right)
+    if left_rank != right_rank:
+        return -1 if left_rank < right_rank else 1
+    if left_rank == 1:
+        return 0
+    if left_rank == 4:
+        left, right = list(left.items()), list(right.items())
+    if left_rank == 9:
+        left, right = _naive(left), _naive(right)
+    try:
+        if left == right:
+            return 0
+        return -1 if left < right else 1
+    except TypeError:
+        left, right = repr(left), repr(right)
+        if left == right:
+            return 0
+        return -1 if left < right else 1
+
+
+def _naive(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    return value
+
+
+def _equal(left: Any, right: Any) -> bool:
+    return _type_rank(left) == _type_rank(right) and compare(left, right) == 0
+
+
+# Доступ к полям
+def get_values(document: Any, path: str) -> List[Any]:
+    '''Возвращает значения поля по пути с точками. Если на пути встречается
+    список, то возвращаются значения из всех его элементов.'''
+    values = [document]
+    for attr in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                found.append(value.get(attr, _MISSING))
+            elif isinstance(value, list):
+                if attr.isdigit():
+                    index = int(attr)
+                    found.append(
+                        value[index] if index < len(value) else _MISSING)
+                else:
+                    for item in value:
+                        if isinstance(item, dict):
+                            found.append(item.get(attr, _MISSING))
+            else:
+                found.append(_MISSING)
+        values = found
+    return values
+
+
+def get_value(document: Any, path: str) -> Any:
+    '''Возвращает значение поля по пути с точками без обхода списков.'''
+    value = document
+    for attr in path.split('.'):
+        if isinstance(value, dict):
+            value = value.get(attr, _MISSING)
+        elif isinstance(value, list) and attr.isdigit() \
+                and int(attr) < len(value):
+            value = value[int(attr)]
+        else:
+            return _MISSING
+    return value
+
+
+def _expand(values: List[Any]) -> List[Any]:
+    result = []
+    for value in values:
+        result.append(value)
+        if isinstance(value, list):
+            result.extend(value)
+    return result
+
+
+# Запросы
+def match(document: Dict[str, Any], query: Optional[Dict[str, Any]]) -> bool:
+    '''Проверяет, удовлетворяет ли документ запросу.'''
+    if not query:
+        return True
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(match(document, x) for x in condition):
+                return False
+        elif key == '$or':
+            if not any(match(document, x) for x in condition):
+                return False
+        elif key == '$nor':
+            if any(match(document, x) for x in condition):
+                return False
+        elif key.startswith('$'):
+            raise OperationFailure('Unsupported query operator {}'.format(key))
+        elif not _match_field(get_values(document, key), condition):
+            return False
+    return True
+
+
+def _is_operator(condition: Any) -> bool:
+    return isinstance(condition, dict) and bool(condition) \
+        and '$ref' not in condition \
+        and all(x.startswith('$') for x in condition)
+
+
+def _match_field(values: List[Any], condition: Any) -> bool:
+    if _is_operator(condition):
+        return all(
+            _match_operator(values, operator, argument, condition)
+            for operator, argument in condition.items())
+    return _match_eq(values, condition)
+
+
+def _match_eq(values: List[Any], argument: Any) -> bool:
+    if argument is None:
+        return any(x is None or x is _MISSING for x in _expand(values))
+    return any(_equal(x, argument) for x in _expand(values))
+
+
+def _match_compare(values: List[Any], argument: Any, check) -> bool:
+    return any(
+        x is not _MISSING and _type_rank(x) == _type_rank(argument)
+        and check(compare(x, argument)) for x in _expand(values))
+
+
+def _match_operator(values: List[Any], operator: str, argument: Any,
+                    condition: Dict[str, Any]) -> bool:
+    # pylint: disable=too-many-return-statements,too-many-branches
+    if operator == '$eq':
+        return _match_eq(values, argument)
+    if operator == '$ne':
+        return not _match_eq(values, argument)
+    if operator == '$gt':
+        return _match_compare(values, argument, lambda x: x > 0)
+    if operator == '$gte':
+        return _match_compare(values, argument, lambda x: x >= 0)
+    if operator == '$lt':
+        return _match_compare(values, argument, lambda x: x < 0)
+    if operator == '$lte':
+        return _match_compare(values, argument, lambda x: x <= 0)
+    if operator == '$in':
+        return any(_match_eq(values, x) for x in argument)
+    if operator == '$nin':
+        return not any(_match_eq(values, x) for x in argument)
+    if operator == '$exists':
+        exists = any(x is not _MISSING for x in values)
+        return exists == bool(argument)
+    if operator == '$not':
+        return not _match_field(values, argument)
+    if operator == '$regex':
+        flags = 0
+        for option in condition.get('$options', ''):
+            flags |= _REGEX_FLAGS.get(option, 0)
+        pattern = argument
+        if isinstance(pattern, Regex):
+            pattern = pattern.try_compile()
+        if isinstance(pattern, str):
+            pattern = re_compile(pattern, flags)
+        return any(
+            isinstance(x, str) and pattern.search(x) is not None
+            for x in _expand(values))
+    if operator == '$options':
+        return True
+    if operator == '$size':
+        return any(isinstance(x, list) and len(x) == argument for x in values)
+    if operator == '$all':
+        return all(_match_eq(values, x) for x in argument)
+    if operator == '$elemMatch':
+        return any(
+            isinstance(x, list) and any(
+                match(item, argument) if isinstance(item, dict) and
+                not _is_operator(argument) else _match_field([item], argument)
+                for item in x) for x in values)
+    raise OperationFailure('Unsupported query operator {}'.format(operator))
+
+
+# Обновление
+def _set_path(document: Dict[str, Any], path: str, value: Any) -> None:
+    parts = path.split('.')
+    target: Any = document
+    for attr in parts[:-1]:
+        if isinstance(target, list):
+            target = target[int(attr)]
+        else:
+            if not isinstance(target.get(attr), (dict, list)):
+                target[attr] = {}
+            target = target[attr]
+    if isinstance(target, list):
+        index = int(parts[-1])
+        while len(target) <= index:
+            target.append(None)
+        target[index] = value
+    else:
+        target[parts[-1]] = value
+
+
+def _unset_path(document: Dict[str, Any], path: str) -> None:
+    parts = path.split('.')
+    target = get_value(document, '.'.join(parts[:-1])) \
+        if len(parts) > 1 else document
+    if isinstance(target, dict):
+        target.pop(parts[-1], None)
+    elif isinstance(target, list) and parts[-1].isdigit() \
+            and int(parts[-1]) < len(target):
+        target[int(parts[-1])] = None
+
+
+def apply_update(document: Dict[str, Any], update: Dict[str, Any],
+                 inserting: bool = False) -> None:
+    '''Применяет к документу операторы обновления.'''
+    # pylint: disable=too-many-branches
+    for operator, fields in update.items():
+        for path, argument in fields.items():
+            current = get_value(document, path)
+            if operator == '$set':
+                _set_path(document, path, argument)
+            elif operator == '$setOnInsert':
+                if inserting:
+                    _set_path(document, path, argument)
+            elif operator == '$unset':
+                _unset_path(document, path)
+            elif operator == '$inc':
+                base = 0 if current is _MISSING else current
+                _set_path(document, path, base + argument)
+            elif operator == '$mul':
+                base = 0 if current is _MISSING else current
+                _set_path(document, path, base * argument)
+            elif operator == '$min':
+                if current is _MISSING or compare(argument, current) < 0:
+                    _set_path(document, path, argument)
+            elif operator == '$max':
+                if current is _MISSING or compare(argument, current) > 0:
+                    _set_path(document, path, argument)
+            elif operator in ('$push', '$addToSet'):
+                items = current if isinstance(current, list) else []
+                if isinstance(argument, dict) and '$each' in argument:
+                    new = list(argument['$each'])
+                else:
+                    new = [argument]
+                for item in new:
+                    if operator == '$push' \
+                            or not any(_equal(x, item) for x in items):
+                        items.append(item)
+                _set_path(document, path, items)
+            elif operator == '$pull':
+                if isinstance(current, list):
+                    _set_path(document, path, [
+                        x for x in current if not _match_field([x], argument)
+                    ])
+            elif operator == '$rename':
+                if current is not _MISSING:
+                    _unset_path(document, path)
+                    _set_path(document, argument, current)
+            else:
+                raise OperationFailure(
+                    'Unsupported update operator {}'.format(operator))
+
+
+def _is_update(update: Dict[str, Any]) -> bool:
+    return bool(update) and all(x.startswith('$') for x in update)
+
+
+def _upsert_base(query: Dict[str, Any]) -> Dict[str, Any]:
+    document: Dict[str, Any] = {}
+    for key, value in query.items():
+        if key.startswith('$'):
+            continue
+        if _is_operator(value):
+            if '$eq' in value:
+                _set_path(document, key, value['$eq'])
+        else:
+            _set_path(document, key, value)
+    return document
+
+
+# Сортировка и агрегация
+def sort_documents(documents: List[Dict[str, Any]],
+                   sort: List[Tuple[str, int]]) -> List[Dict[str, Any]]:
+    '''Сортирует документы по списку пар (поле, направление).'''
+    def cmp(left, right):
+        for key, direction in sort:
+            result = compare(get_value(left, key), get_value(right, key))
+            if result:
+                return result * direction
+        return 0
+
+    return sorted(documents, key=cmp_to_key(cmp))
+
+
+def _normalize_sort(key_or_list: Any, direction: Optional[int] = None
+                    ) -> List[Tuple[str, int]]:
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction or 1)]
+    if isinstance(key_or_list, dict):
+        return list(key_or_list.items())
+    return list(key_or_list)
+
+
+def project(document: Dict[str, Any],
+            projection: Optional[Any]) -> Dict[str, Any]:
+    '''Применяет к документу проекцию.'''
+    if not projection:
+        return document
+    if isinstance(projection, (list, tuple)):
+        projection = {x: 1 for x in projection}
+    include = {k for k, v in projection.items() if v and k != '_id'}
+    # Projection {'_id': 1} includes nothing but the identifier
+    if include or all(projection.values()):
+        result: Dict[str, Any] = {}
+        if projection.get('_id', 1) and '_id' in document:
+            result['_id'] = document['_id']
+        for key in include:
+            value = get_value(document, key)
+            if value is not _MISSING:
+                _set_path(result, key, value)
+        return result
+    result = dict(document)
+    for key, value in projection.items():
+        if not value:
+            _unset_path(result, key)
+    return result
+
+
+def evaluate(document: Dict[str, Any], expression: Any) -> Any:
+    '''Вычисляет простое выражение агрегации.'''
+    if isinstance(expression, str) and expression.startswith('$'):
+        value = get_value(document, expression[1:])
+        return None if value is _MISSING else value
+    if isinstance(expression, dict) and len(expression) == 1:
+        operator, argument = next(iter(expression.items()))
+        if operator == '$arrayElemAt':
+            array, index = (evaluate(document, x) for x in argument)
+            if isinstance(array, list) and -len(array) <= index < len(array):
+                return array[index]
+            return None
+        if operator == '$objectToArray':
+            value = evaluate(document, argument)
+            if isinstance(value, DBRef):
+                value = value.as_doc()
+            if isinstance(value, dict):
+                return [{'k': k, 'v': v} for k, v in value.items()]
+            return None
+        if operator == '$literal':
+            return argument
+    if isinstance(expression, dict):
+        return {k: evaluate(document, v) for k, v in expression.items()}
+    return expression
+
+
+def _group(documents: List[Dict[str, Any]],
+           spec: Dict[str, Any]) -> List[Dict[str, Any]]:
+    groups: List[Dict[str, Any]] = []
+    for document in documents:
+        key = evaluate(document, spec['_id'])
+        for group in groups:
+            if _equal(group['_id'], key):
+                break
+        else:
+            group = {'_id': key}
+            groups.append(group)
+        for field, accumulator in spec.items():
+            if field == '_id':
+                continue
+            operator, argument = next(iter(accumulator.items()))
+            value = evaluate(document, argument)
+            if operator == '$sum':
+                group[field] = group.get(field, 0) + (value or 0)
+            elif operator == '$push':
+                group.setdefault(field, []).append(value)
+            elif operator == '$first':
+                group.setdefault(field, value)
+            elif operator == '$last':
+                group[field] = value
+            elif operator in ('$min', '$max'):
+                if field not in group or (compare(value, group[field]) < 0) \
+                        == (operator == '$min'):
+                    group[field] = value
+            else:
+                raise OperationFailure(
+                    'Unsupported accumulator {}'.format(operator))
+    return groups
+
+
+# Объекты хранилища
+class MemorySession(object):
+    '''Сессия хранилища в памяти. Ничего не делает.'''
+
+    def __init__(self, client: 'MemoryClient') -> None:
+        self.client = client
+
+    async def end_session(self) -> None:
+        '''Завершает сессию.'''
+
+
+class MemoryClient(object):
+    '''Клиент хранилища в памяти.'''
+
+    def __init__(self, codec_options: Any = DEFAULT_CODEC_OPTIONS) -> None:
+        self.codec_options = codec_options
+        self._databases: Dict[str, 'MemoryDatabase'] = {}
+
+    def __getitem__(self, name: str) -> 'MemoryDatabase':
+        if name not in self._databases:
+            self._databases[name] = MemoryDatabase(self, name)
+        return self._databases[name]
+
+    async def start_session(self, **kwargs) -> MemorySession:
+        '''Возвращает сессию.'''
+        return MemorySession(self)
+
+    async def drop_database(self, name: str) -> None:
+        '''Удаляет базу данных.'''
+        self._databases.pop(name, None)
+
+    def close(self) -> None:
+        '''Закрывает клиент.'''
+
+
+class MemoryDatabase(object):
+    '''База данных в памяти.'''
+
+    def __init__(self, client: MemoryClient, name: str) -> None:
+        self.client = client
+        self.name = name
+        self._collections: Dict[str, 'MemoryCollection'] = {}
+        self._options: Dict[str, Dict[str, Any]] = {}
+
+    def __getitem__(self, name: str) -> 'MemoryCollection':
+        if name not in self._collections:
+            self._collections[name] = MemoryCollection(
+                self, name, codec_options=self.client.codec_options)
+        return self._collections[name]
+
+    def __getattr__(self, name: str) -> 'MemoryCollection':
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    async def create_collection(self, name: str,
+                                **kwargs) -> 'MemoryCollection':
+        '''Создаёт коллекцию с параметрами.'''
+        # pylint: disable=protected-access
+        existing = self._collections.get(name)
+        if name in self._options or (existing is not None and
+                                     existing._storage):
+            raise CollectionInvalid(
+                'Collection {} already exists'.format(name))
+        self._options[name] = kwargs
+        return self[name]
+
+    async def list_collection_names(self) -> List[str]:
+        '''Возвращает имена коллекций.'''
+        return list(self._collections)
+
+    async def drop_collection(self, name: str) -> None:
+        '''Удаляет коллекцию.'''
+        self._collections.pop(name, None)
+        self._options.pop(name, None)
+
+    def collection_options(self, name: str) -> Dict[str, Any]:
+        '''Возвращает параметры, с которыми была создана коллекция.'''
+        return self._options.get(name, {})
+
+
+class MemoryCollection(SessionOptions, abc.Collection):
+    '''Коллекция в памяти. Документы хранятся в BSON-совместимом виде и
+    копируются при каждом чтении и записи.'''
+
+    # pylint: disable=too-many-public-methods
+
+    def __init__(self, database: MemoryDatabase, name: str,
+                 _storage: Optional[Dict[bytes, Dict[str, Any]]] = None,
+                 codec_options: Any = DEFAULT_CODEC_OPTIONS,
+                 write_concern: Optional[WriteConcern] = None,
+                 read_preference: Any = None) -> None:
+        self.database = database
+        self.name = name
+        self._storage: Dict[bytes, Dict[str, Any]] = \
+            {} if _storage is None else _storage
+        self.codec_options = codec_options
+        self.write_concern = write_concern or WriteConcern()
+        self.read_preference = read_preference
+
+    def with_options(self, **kwargs) -> 'MemoryCollection':
+        '''Возвращает копию коллекции с другими настройками.'''
+        options = {
+            'codec_options': self.codec_options,
+            'write_concern': self.write_concern,
+            'read_preference': self.read_preference,
+        }
+        options.update(kwargs)
+        return MemoryCollection(self.database, self.name,
+                                _storage=self._storage, **options)
+
+    # Хранение
+    def _key(self, id_: Any) -> bytes:
+        return encode({'_id': id_}, codec_options=self.codec_options)
+
+    def _store(self, document: Any) -> Dict[str, Any]:
+        if isinstance(document, RawBSONDocument):
+            data = document.raw
+        else:
+            data = encode(document, codec_options=self.codec_options)
+        return decode(data, STORAGE_CODEC_OPTIONS)
+
+    def _load(self, document: Dict[str, Any]) -> Dict[str, Any]:
+        return decode(encode(document), self.codec_options)
+
+    def _select(self, query: Optional[Dict[str, Any]]
+                ) -> Iterator[Tuple[bytes, Dict[str, Any]]]:
+        if query:
+            query = self._store(query)
+        for key, document in list(self._storage.items()):
+            if match(document, query):
+                yield key, document
+
+    def _insert(self, document: Any) -> Any:
+        if not isinstance(document, RawBSONDocument) \
+                and '_id' not in document:
+            document['_id'] = ObjectId()
+        stored = self._store(document)
+        key = self._key(stored['_id'])
+        if key in self._storage:
+            raise DuplicateKeyError(
+                'E11000 duplicate key error collection: {} index: _id_ '
+                'dup key: {}'.format(self.name, stored['_id']),
+                DUPLICATE_KEY)
+        self._storage[key] = stored
+        return stored['_id']
+
+    def _update(self, query: Dict[str, Any], update: Dict[str, Any],
+                upsert: bool, multi: bool, replace: bool) -> Dict[str, Any]:
+        if replace and _is_update(update):
+            raise ValueError('replacement can not include $ operators')
+        if not replace and not _is_update(update):
+            raise ValueError('update only works with $ operators')
+
+        matched = modified = 0
+        for key, document in self._select(query):
+            matched += 1
+            if replace:
+                new = self._store(update)
+                new['_id'] = document['_id']
+            else:
+                new = self._store(document)
+                apply_update(new, update)
+            if new.get('_id') != document['_id']:
+                raise OperationFailure('_id field can not be changed')
+            if new != document:
+                modified += 1
+                self._storage[key] = new
+            if not multi:
+                break
+
+        result: Dict[str, Any] = {'n': matched, 'nModified': modified}
+        if not matched and upsert:
+            if replace:
+                new = self._store(update)
+                base = _upsert_base(query)
+                if '_id' not in new and '_id' in base:
+                    new['_id'] = base['_id']
+            else:
+                new = _upsert_base(query)
+                apply_update(new, update, inserting=True)
+            result['upserted'] = self._insert(new)
+            result['n'] = 1
+        return result
+
+    def _delete(self, query: Dict[str, Any], multi: bool) -> int:
+        deleted = 0
+        for key, _ in self._select(query):
+            del self._storage[key]
+            deleted += 1
+            if not multi:
+                break
+        return deleted
+
+    @property
+    def _acknowledged(self) -> bool:
+        return self.write_concern.acknowledged
+
+    # Чтение
+    def find(self, filter: Optional[Dict[str, Any]] = None,
+             projection: Any = None,
+             readonly: bool = False,
+             **kwargs) -> 'MemoryCursor':
+        '''Возвращает :class:`~.MemoryCursor` для итерации.'''
+        # pylint: disable=redefined-builtin
+        track(self.name, 'find')
+        self.read_options(kwargs)
+        cursor = MemoryCursor(self, filter, projection, readonly=readonly)
+        if kwargs.get('sort'):
+            cursor.sort(kwargs['sort'])
+        cursor.skip(kwargs.get('skip', 0))
+        cursor.limit(kwargs.get('limit', 0))
+        return cursor
+
+    def find_raw_batches(self, filter: Optional[Dict[str, Any]] = None,
+                         projection: Any = None,
+                         **kwargs) -> 'MemoryCursor':
+        '''Возвращает курсор, отдающий пакеты документов в виде BSON.'''
+        # pylint: disable=redefined-builtin
+        track(self.name, 'find_raw_batches')
+        cursor = MemoryCursor(self, filter, projection, raw=True)
+        if kwargs.get('batch_size'):
+            cursor.batch_size(kwargs['batch_size'])
+        return cursor
+
+    def find_decoded(self, *args, **kwargs) -> 'MemoryCursor':
+        '''Декодирование на месте: документы в памяти уже разобраны.'''
+        kwargs.pop('executor', None)
+        kwargs.pop('threshold', None)
+        return self.find(*args, **kwargs)
+
+    async def find_one(self, filter: Optional[Any] = None, *args,
+                       readonly: bool = False,
+                       **kwargs) -> DocumentOrObject:
+        '''Получение одного объекта.'''
+        # pylint: disable=redefined-builtin,keyword-arg-before-vararg
+        track(self.name, 'find_one')
+        self.read_options(kwargs)
+        async with db.admission.admit((self.database.name, self.name)):
+            if filter is not None and not isinstance(filter, dict):
+                filter = {'_id': filter}
+            cursor = MemoryCursor(self, filter, kwargs.get('projection'),
+                                  compile_=False)
+            if kwargs.get('sort'):
+                cursor.sort(kwargs['sort'])
+            for document in cursor.documents():
+                return compile_object(document, readonly)
+            return None
+
+    async def count_documents(self, filter: Dict[str, Any],
+                              **kwargs) -> int:
+        '''Получение числа документов, удовлетворяющих запросу.'''
+        # pylint: disable=redefined-builtin
+        track(self.name, 'count_documents')
+        self.read_options(kwargs)
+        async with db.admission.admit((self.database.name, self.name)):
+            count = sum(1 for _ in self._select(filter))
+            count = max(count - kwargs.get('skip', 0), 0)
+            if kwargs.get('limit'):
+                count = min(count, kwargs['limit'])
+            return count
+
+    async def estimated_document_count(self, **kwargs) -> int:
+        '''Получение числа документов в коллекции.'''
+        return len(self._storage)
+
+    def aggregate(self, pipeline: List[Dict[str, Any]],
+                  **kwargs) -> 'MemoryCursor':
+        '''Выполняет конвейер агрегации.'''
+        track(self.name, 'aggregate')
+        return MemoryCursor(self, pipeline=pipeline)
+
+    def _aggregate(self,
+                   pipeline: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # pylint: disable=too-many-branches
+        documents = [x for _, x in self._select(None)]
+        for stage in pipeline:
+            operator, argument = next(iter(stage.items()))
+            if operator == '$match':
+                documents = [x for x in documents if match(x, argument)]
+            elif operator == '$sort':
+                documents = sort_documents(documents,
+                                           _normalize_sort(argument))
+            elif operator == '$skip':
+                documents = documents[argument:]
+            elif operator == '$limit':
+                documents = documents[:argument]
+            elif operator == '$project':
+                documents = [project(x, argument) for x in documents]
+            elif operator == '$sample':
+                size = min(argument['size'], len(documents))
+                documents = random_sample(documents, size)
+            elif operator in ('$addFields', '$set'):
+                result = []
+                for document in documents:
+                    document = self._store(document)
+                    for key, expression in argument.items():
+                        _set_path(document, key, evaluate(document,
+                                                          expression))
+                    result.append(document)
+                documents = result
+            elif operator == '$lookup':
+                target = self.database[argument['from']]
+                result = []
+                for document in documents:
+                    document = self._store(document)
+                    values = [
+                        x for x in get_values(document,
+                                              argument['localField'])
+                        if x is not _MISSING
+                    ]
+                    found = [
+                        x for _, x in target._select(None)
+                        if any(_match_eq(
+                            get_values(x, argument['foreignField']), v)
+                            for v in values)
+                    ]
+                    _set_path(document, argument['as'], found)
+                    result.append(document)
+                documents = result
+            elif operator == '$group':
+                documents = _group(documents, argument)
+            elif operator == '$count':
+                documents = [{argument: len(documents)}]
+            else:
+                raise OperationFailure(
+                    'Unsupported pipeline stage {}'.format(operator))
+        return documents
+
+    # Запись
+    async def insert_one(self, document: Any, **kwargs) -> InsertOneResult:
+        '''Вставка одного документа.'''
+        track(self.name, 'insert_one')
+        await self.write_options(kwargs)
+        async with db.admission.admit((self.database.name, self.name)):
+            return InsertOneResult(self._insert(document), self._acknowledged)
+
+    async def insert_many(self, documents: List[Any], ordered: bool = True,
+                          **kwargs) -> InsertManyResult:
+        '''Вставка нескольких документов.'''
+        track(self.name, 'insert_many')
+        await self.write_options(kwargs)
+        async with db.admission.admit((self.database.name, self.name)):
+            inserted = []
+            errors = []
+            for index, document in enumerate(documents):
+                try:
+                    inserted.append(self._insert(document))
+                except DuplicateKeyError as exc:
+                    errors.append({
+                        'index': index,
+                        'code': DUPLICATE_KEY,
+                        'errmsg': str(exc),
+                        'op': document
+                    })
+                    if ordered:
+                        break
+            if errors and self._acknowledged:
+                raise BulkWriteError({
+                    'writeErrors': errors,
+                    'writeConcernErrors': [],
+                    'nInserted': len(inserted),
+                    'nUpserted': 0,
+                    'nMatched': 0,
+                    'nModified': 0,
+                    'nRemoved': 0,
+                    'upserted': []
+                })
+            return InsertManyResult(inserted, self._acknowledged)
+
+    async def update_one(self, filter: Dict[str, Any],
+                         update: Dict[str, Any], upsert: bool = False,
+                         **kwargs) -> UpdateResult:
+        '''Обновление одного документа.'''
+        # pylint: disable=redefined-builtin
+        track(self.name, 'update_one')
+        await self.write_options(kwargs)
+        async with db.admission.admit((self.database.name, self.name)):
+            return UpdateResult(
+                self._update(filter, update, upsert, False, False),
+                self._acknowledged)
+
+    async def update_many(self, filter: Dict[str, Any],
+                          update: Dict[str, Any], upsert: bool = False,
+                          **kwargs) -> UpdateResult:
+        '''Обновление всех документов, удовлетворяющих запросу.'''
+        # pylint: disable=redefined-builtin
+        track(self.name, 'update_many')
+        await self.write_options(kwargs)
+        async with db.admission.admit((self.database.name, self.name)):
+            return UpdateResult(
+                self._update(filter, update, upsert, True, False),
+                self._acknowledged)
+
+    async def replace_one(self, filter: Dict[str, Any],
+                          replacement: Dict[str, Any], upsert: bool = False,
+                          **kwargs) -> UpdateResult:
+        '''Замена одного документа.'''
+        # pylint: disable=redefined-builtin
+        track(self.name, 'replace_one')
+        await self.write_options(kwargs)
+        async with db.admission.admit((self.database.name, self.name)):
+            return UpdateResult(
+                self._update(filter, replacement, upsert, False, True),
+                self._acknowledged)
+
+    async def delete_one(self, filter: Dict[str, Any],
+                         **kwargs) -> DeleteResult:
+        '''Удаление одного документа.'''
+        # pylint: disable=redefined-builtin
+        track(self.name, 'delete_one')
+        await self.write_options(kwargs)
+        async with db.admission.admit((self.database.name, self.name)):
+            return DeleteResult({'n': self._delete(filter, False)},
+                                self._acknowledged)
+
+    async def delete_many(self, filter: Dict[str, Any],
+                          **kwargs) -> DeleteResult:
+        '''Удаление всех документов, удовлетворяющих запросу.'''
+        # pylint: disable=redefined-builtin
+        track(self.name, 'delete_many')
+        await self.write_options(kwargs)
+        async with db.admission.admit((self.database.name, self.name)):
+            return DeleteResult({'n': self._delete(filter, True)},
+                                self._acknowledged)
+
+    async def bulk_write(self, requests: List[Any], ordered: bool = True,
+                         **kwargs) -> BulkWriteResult:
+        '''Пакетное выполнение операций записи.'''
+        track(self.name, 'bulk_write')
+        await self.write_options(kwargs)
+        async with db.admission.admit((self.database.name, self.name)):
+            return self._bulk_write(requests, ordered)
+
+    def _bulk_write(self, requests: List[Any],
+                    ordered: bool) -> BulkWriteResult:
+        # pylint: disable=protected-access
+        result: Dict[str, Any] = {
+            'writeErrors': [],
+            'writeConcernErrors': [],
+            'nInserted': 0,
+            'nUpserted': 0,
+            'nMatched': 0,
+            'nModified': 0,
+            'nRemoved': 0,
+            'upserted': []
+        }
+        for index, request in enumerate(requests):
+            try:
+                if isinstance(request, InsertOne):
+                    self._insert(request._doc)
+                    result['nInserted'] += 1
+                elif isinstance(request, (UpdateOne, UpdateMany, ReplaceOne)):
+                    raw = self._update(request._filter, request._doc,
+                                       request._upsert,
+                                       isinstance(request, UpdateMany),
+                                       isinstance(request, ReplaceOne))
+                    if 'upserted' in raw:
+                        result['nUpserted'] += 1
+                        result['upserted'].append({
+                            'index': index,
+                            '_id': raw['upserted']
+                        })
+                    else:
+                        result['nMatched'] += raw['n']
+                        result['nModified'] += raw['nModified']
+                elif isinstance(request, (DeleteOne, DeleteMany)):
+                    result['nRemoved'] += self._delete(
+                        request._filter, isinstance(request, DeleteMany))
+                else:
+                    raise TypeError('{!r} is not a valid request'.format(
+                        request))
+            except DuplicateKeyError as exc:
+                result['writeErrors'].append({
+                    'index': index,
+                    'code': DUPLICATE_KEY,
+                    'errmsg': str(exc),
+                    'op': request
+                })
+                if ordered:
+                    break
+        if result['writeErrors'] and self._acknowledged:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, self._acknowledged)
+
+    async def create_index(self, keys: Any, **kwargs) -> str:
+        '''Индексы в памяти не поддерживаются, имя индекса возвращается для
+        совместимости.'''
+        keys = _normalize_sort(keys)
+        return '_'.join('{}_{}'.format(k, v) for k, v in keys)
+
+    async def drop(self) -> None:
+        '''Удаляет все документы коллекции.'''
+        self._storage.clear()
+
+
+class MemoryCursor(object):
+    '''Курсор по документам коллекции в памяти. Запрос выполняется при
+    первом чтении.'''
+
+    def __init__(self, collection: MemoryCollection,
+                 query: Optional[Dict[str, Any]] = None,
+                 projection: Any = None,
+                 pipeline: Optional[List[Dict[str, Any]]] = None,
+                 raw: bool = False,
+                 compile_: bool = True,
+                 readonly: bool = False) -> None:
+        self.collection = collection
+        self._query = query
+        self._projection = projection
+        self._pipeline = pipeline
+        self._raw = raw
+        self._compile = compile_
+        self._readonly = readonly
+        self._sort: List[Tuple[str, int]] = []
+        self._skip = 0
+        self._limit = 0
+        self._batch_size = 101
+        self._iterator: Optional[Iterator[Any]] = None
+
+    def sort(self, key_or_list: Any,
+             direction: Optional[int] = None) -> 'MemoryCursor':
+        '''Задаёт сортировку.'''
+        self._sort = _normalize_sort(key_or_list, direction)
+        return self
+
+    def skip(self, skip: int) -> 'MemoryCursor':
+        '''Пропускает первые `skip` документов.'''
+        self._skip = skip
+        return self
+
+    def limit(self, limit: int) -> 'MemoryCursor':
+        '''Ограничивает число документов.'''
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size: int) -> 'MemoryCursor':
+        '''Задаёт размер пакета для курсора пакетов BSON.'''
+        self._batch_size = batch_size
+        return self
+
+    def documents(self) -> Iterator[Dict[str, Any]]:
+        '''Возвращает документы без превращения в объекты.'''
+        collection = self.collection
+        if self._pipeline is not None:
+            # pylint: disable=protected-access
+            documents = collection._aggregate(self._pipeline)
+        else:
+            documents = [x for _, x in collection._select(self._query)]
+        if self._sort:
+            documents = sort_documents(documents, self._sort)
+        documents = documents[self._skip:]
+        if self._limit:
+            documents = documents[:self._limit]
+        for document in documents:
+            # pylint: disable=protected-access
+            yield collection._load(project(document, self._projection))
+
+    def _batches(self) -> Iterator[bytes]:
+        batch: List[bytes] = []
+        for document in self.documents():
+            batch.append(encode(
+                document, codec_options=self.collection.codec_options))
+            if len(batch) >= self._batch_size:
+                yield b''.join(batch)
+                batch = []
+        if batch:
+            yield b''.join(batch)
+
+    def __aiter__(self) -> 'MemoryCursor':
+        return self
+
+    async def next(self) -> DocumentOrObject:
+        '''Получение следующего документа.'''
+        if self._iterator is None:
+            self._iterator = self._batches() if self._raw \
+                else self.documents()
+        try:
+            document = next(self._iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+        if self._raw or not self._compile:
+            return document
+        if self._pipeline is not None:
+            return compile_row(document)
+        return compile_object(document, self._readonly)
+
+    __anext__ = next
+
+    async def to_list(self, length: Optional[int] = None) -> list:
+        '''Получение списка документов.'''
+        result = []
+        async for document in self:
+            result.append(document)
+            if length is not None and len(result) >= length:
+                break
+        return result
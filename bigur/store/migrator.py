@@ -5,9 +5,10 @@ __licence__ = 'For license information see LICENSE'
 from datetime import datetime
 from logging import getLogger
 from re import sub
-from typing import Callable, Dict, List, Optional, Tuple
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
 
-from pymongo.database import Database
+if TYPE_CHECKING:
+    from pymongo.database import Database
 
 logger = getLogger(__name__)
 
@@ -15,7 +16,7 @@ migrators: Dict[str, Dict[str, Tuple[str, Callable]]] = {}
 
 
 def transition(component: str, from_version: str, to_version: str
-               ) -> Callable[[Callable[[Database], None]], None]:
+               ) -> Callable[[Callable[['Database'], None]], None]:
     def wrap(func):
         if component not in migrators:
             migrators[component] = {}
@@ -49,7 +50,7 @@ def compare_versions(left: str, right: str) -> Optional[bool]:
     return normal_left > normal_right
 
 
-def migrate(db: Database, component: str, version: str):
+def migrate(db: 'Database', component: str, version: str):
     logger.debug('Migration for %s to version %s started', component, version)
 
     db_version = db.versions.find_one({'component': component})
@@ -62,7 +63,7 @@ def migrate(db: Database, component: str, version: str):
 
     transitions = migrators.get(component, {})
 
-    path: List[Tuple[str, Callable[[Database], None]]] = []
+    path: List[Tuple[str, Callable[['Database'], None]]] = []
 
     while True:
         if from_version in transitions:
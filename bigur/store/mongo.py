@@ -0,0 +1,200 @@
+'''Хранилище MongoDB на основе motor.
+
+Модуль импортируется при первом подключении к MongoDB через
+:meth:`~bigur.store.database.DBProxy.configure`, поэтому motor и
+клиентская часть pymongo не загружаются программами, которым нужны
+только классы документов.'''
+
+__author__ = 'Gennady Kovalev <gik@bigur.ru>'
+__copyright__ = '(c) 2016-2019 Development management business group'
+__licence__ = 'For license information see LICENSE'
+
+from concurrent.futures import Executor
+from typing import Any, Optional
+
+from motor.core import AgnosticBaseProperties
+from motor.metaprogramming import unwrap_kwargs_session
+from motor.motor_asyncio import (AsyncIOMotorClient, AsyncIOMotorCursor,
+                                 AsyncIOMotorDatabase, AsyncIOMotorCollection,
+                                 AsyncIOMotorLatentCommandCursor)
+
+from bigur.store import abc
+from bigur.store.database import (DecodingCursor, DocumentOrObject,
+                                  SessionOptions, compile_object,
+                                  compile_row, db, track)
+
+
+class Client(AsyncIOMotorClient):
+    '''Обёртка вокруг :class:`~AsyncIOMotorClient`. Нужна для возвращения
+    нашего объекта с базой данных.'''
+
+    def __getitem__(self, name: str) -> 'Database':
+        return Database(self, name)
+
+
+class Database(AsyncIOMotorDatabase):
+    '''Обёртка вокруг :class:`~AsyncIOMotorDatabase`. Нужна для возвращения
+    нашего объекта с коллекцией.'''
+
+    def __init__(self, client: Client, name: str, _delegate=None) -> None:
+        self._client: Client = client
+        delegate = _delegate
+        if delegate is None:
+            delegate = self.__delegate_class__(client.delegate, name)
+        super(AgnosticBaseProperties, self).__init__(delegate)
+
+    def __getitem__(self, name: str) -> 'Collection':
+        return Collection(self, name)
+
+
+class Collection(SessionOptions, AsyncIOMotorCollection):
+    '''Обёртка вокруг коллекции.'''
+
+    def __init__(self, database: Database, name: str, _delegate=None) -> None:
+        self.database: Database = database
+        delegate = _delegate
+        if delegate is None:
+            delegate = self.__delegate_class__(database.delegate, name)
+        super(AgnosticBaseProperties, self).__init__(delegate)
+
+    def with_options(self, **kwargs) -> 'Collection':
+        '''Возвращает копию коллекции с другими настройками.'''
+        return Collection(self.database, self.name,
+                          _delegate=self.delegate.with_options(**kwargs))
+
+    async def find_one(self, *args, readonly: bool = False,
+                       **kwargs) -> DocumentOrObject:
+        '''Получение одного объекта.'''
+        track(self.name, 'find_one')
+        async with db.admission.admit((self.database.name, self.name)):
+            return compile_object((await super().find_one(
+                *args, **self.read_options(kwargs))), readonly)
+
+    async def count_documents(self, *args, **kwargs) -> int:
+        '''Получение числа документов, которое будет возвращенго запросом.'''
+        track(self.name, 'count_documents')
+        async with db.admission.admit((self.database.name, self.name)):
+            return await super().count_documents(
+                *args, **self.read_options(kwargs))
+
+    def find(self, *args, readonly: bool = False, **kwargs) -> 'Cursor':
+        '''Возвращает :class:`~.Cursor` для итерации.'''
+        track(self.name, 'find')
+        kwargs = unwrap_kwargs_session(self.read_options(kwargs))
+        return Cursor(self.delegate.find(*args, **kwargs), self, readonly)
+
+    def find_raw_batches(self, *args, **kwargs):
+        '''Возвращает курсор, отдающий пакеты документов в виде BSON.'''
+        track(self.name, 'find_raw_batches')
+        return super().find_raw_batches(*args, **kwargs)
+
+    def find_decoded(self, *args,
+                     executor: Optional[Executor] = None,
+                     threshold: int = 1 << 20,
+                     readonly: bool = False,
+                     **kwargs) -> 'DecodingCursor':
+        '''Возвращает :class:`~.DecodingCursor`, который декодирует пакеты
+        документов размером от `threshold` байт в пуле `executor`.'''
+        return DecodingCursor(self.find_raw_batches(*args, **kwargs),
+                              executor, threshold, readonly)
+
+    def aggregate(self, pipeline, *args, **kwargs) -> 'CommandCursor':
+        '''Возвращает :class:`~.CommandCursor` с результатами агрегации.'''
+        track(self.name, 'aggregate')
+        kwargs = unwrap_kwargs_session(self.read_options(kwargs))
+        return CommandCursor(self, self._async_aggregate, pipeline, *args,
+                             **kwargs)
+
+    async def insert_one(self, *args, **kwargs):
+        '''Вставка одного документа.'''
+        track(self.name, 'insert_one')
+        async with db.admission.admit((self.database.name, self.name)):
+            return await super().insert_one(
+                *args, **(await self.write_options(kwargs)))
+
+    async def insert_many(self, *args, **kwargs):
+        '''Вставка нескольких документов.'''
+        track(self.name, 'insert_many')
+        async with db.admission.admit((self.database.name, self.name)):
+            return await super().insert_many(
+                *args, **(await self.write_options(kwargs)))
+
+    async def update_one(self, *args, **kwargs):
+        '''Обновление одного документа.'''
+        track(self.name, 'update_one')
+        async with db.admission.admit((self.database.name, self.name)):
+            return await super().update_one(
+                *args, **(await self.write_options(kwargs)))
+
+    async def update_many(self, *args, **kwargs):
+        '''Обновление всех документов, удовлетворяющих запросу.'''
+        track(self.name, 'update_many')
+        async with db.admission.admit((self.database.name, self.name)):
+            return await super().update_many(
+                *args, **(await self.write_options(kwargs)))
+
+    async def replace_one(self, *args, **kwargs):
+        '''Замена одного документа.'''
+        track(self.name, 'replace_one')
+        async with db.admission.admit((self.database.name, self.name)):
+            return await super().replace_one(
+                *args, **(await self.write_options(kwargs)))
+
+    async def delete_one(self, *args, **kwargs):
+        '''Удаление одного документа.'''
+        track(self.name, 'delete_one')
+        async with db.admission.admit((self.database.name, self.name)):
+            return await super().delete_one(
+                *args, **(await self.write_options(kwargs)))
+
+    async def delete_many(self, *args, **kwargs):
+        '''Удаление всех документов, удовлетворяющих запросу.'''
+        track(self.name, 'delete_many')
+        async with db.admission.admit((self.database.name, self.name)):
+            return await super().delete_many(
+                *args, **(await self.write_options(kwargs)))
+
+    async def bulk_write(self, *args, **kwargs):
+        '''Пакетное выполнение операций записи.'''
+        track(self.name, 'bulk_write')
+        async with db.admission.admit((self.database.name, self.name)):
+            return await super().bulk_write(
+                *args, **(await self.write_options(kwargs)))
+
+
+abc.Collection.register(Collection)
+
+
+class Cursor(AsyncIOMotorCursor):
+    '''Обёртка вокруг курсора. С `readonly` документы превращаются в
+    объекты только для чтения.'''
+
+    def __init__(self, cursor: Any, collection: Collection,
+                 readonly: bool = False) -> None:
+        super().__init__(cursor, collection)
+        self.readonly = readonly
+
+    async def next(self) -> DocumentOrObject:
+        '''Получение следующего документа при асинхронной итерации.'''
+        return compile_object(await super().next(), self.readonly)
+
+    __anext__ = next
+
+    def next_object(self) -> DocumentOrObject:
+        '''Получение документа из курсора.'''
+        return compile_object(super().next_object(), self.readonly)
+
+
+class CommandCursor(AsyncIOMotorLatentCommandCursor):
+    '''Обёртка вокруг курсора агрегации. Документы с `_class`
+    превращаются в объекты, остальные строки возвращаются как есть.'''
+
+    async def next(self) -> DocumentOrObject:
+        '''Получение следующей строки при асинхронной итерации.'''
+        return compile_row(await super().next())
+
+    __anext__ = next
+
+    async def to_list(self, length: Optional[int] = None) -> list:
+        '''Получение списка строк.'''
+        return [compile_row(x) for x in await super().to_list(length)]
@@ -0,0 +1,90 @@
+'''Постраничный вывод по ключу (keyset pagination).'''
+
+__author__ = 'Gennady Kovalev <gik@bigur.ru>'
+__copyright__ = '(c) 2016-2019 Development management business group'
+__licence__ = 'For license information see LICENSE'
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from bson import decode, encode
+from bson.errors import BSONError
+
+from bigur.store.codec import get_codec_options
+
+SortSpec = List[Tuple[str, int]]
+
+
+class InvalidToken(ValueError):
+    '''Неверный маркер продолжения.'''
+
+
+@dataclass
+class Page:
+    '''Страница результатов. Если `token` равен None, то страница
+    последняя.'''
+
+    items: List[Any] = field(default_factory=list)
+    token: Optional[str] = None
+
+
+def normalize_sort(sort: Sequence[Tuple[str, int]]) -> SortSpec:
+    '''Дополняет сортировку ключом `_id`, чтобы порядок был однозначным.'''
+    result = [(key, direction) for key, direction in sort]
+    if all(key != '_id' for key, _ in result):
+        direction = result[-1][1] if result else 1
+        result.append(('_id', direction))
+    return result
+
+
+def keyset_filter(sort: SortSpec, values: Sequence[Any]) -> Dict[str, Any]:
+    '''Возвращает условие выборки документов, следующих в порядке `sort`
+    за документом со значениями ключей сортировки `values`. Пустые и
+    отсутствующие значения учитываются так же, как их сортирует MongoDB:
+    раньше всех остальных.'''
+    if len(sort) != len(values):
+        raise InvalidToken('Token does not match sort specification')
+    clauses = []
+    for index, (key, direction) in enumerate(sort):
+        clause = {k: v for (k, _), v in zip(sort[:index], values[:index])}
+        value = values[index]
+        if value is None:
+            if direction < 0:
+                # Nothing follows null in descending order
+                continue
+            clause[key] = {'$ne': None}
+        elif direction > 0:
+            clause[key] = {'$gt': value}
+        elif key == '_id':
+            clause[key] = {'$lt': value}
+        else:
+            clause['$or'] = [{key: {'$lt': value}}, {key: None}]
+        clauses.append(clause)
+    return {'$or': clauses}
+
+
+def sort_values(document: Dict[str, Any], sort: SortSpec) -> List[Any]:
+    '''Возвращает значения ключей сортировки документа.'''
+    values = []
+    for key, _ in sort:
+        value: Any = document
+        for attr in key.split('.'):
+            value = value.get(attr) if isinstance(value, dict) else None
+        values.append(value)
+    return values
+
+
+def encode_token(values: Sequence[Any]) -> str:
+    '''Упаковывает значения ключей сортировки в непрозрачный маркер.'''
+    data = encode({'v': list(values)}, codec_options=get_codec_options())
+    return urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_token(token: str) -> List[Any]:
+    '''Распаковывает маркер, полученный от :func:`encode_token`.'''
+    try:
+        return decode(urlsafe_b64decode(token.encode('ascii')),
+                      get_codec_options())['v']
+    except (BSONError, ValueError, KeyError, TypeError):
+        raise InvalidToken('Invalid continuation token')
@@ -0,0 +1,85 @@
+'''Объекты только для чтения.
+
+Запросы с параметром `readonly=True` (см. :meth:`Stored.find`,
+:meth:`Stored.find_one`, :meth:`LazyRef.resolve`) возвращают объекты,
+которые не связываются с единицей работы, не отслеживают изменения и не
+хранят ссылок на родительские узлы. Вложенные списки и словари
+заменяются на :class:`FrozenList` и :class:`FrozenDict`, а любая попытка
+изменить объект приводит к исключению :class:`ReadOnly`::
+
+    async for event in Event.find({'name': 'export'}, readonly=True):
+        report.append(event.payload)'''
+
+__author__ = 'Gennady Kovalev <gik@bigur.ru>'
+__copyright__ = '(c) 2016-2019 Development management business group'
+__licence__ = 'For license information see LICENSE'
+
+from datetime import datetime, timezone
+from typing import Any, NoReturn
+
+from bson import DBRef, ObjectId
+
+from bigur.store.database import resolve_class
+from bigur.store.lazy_ref import LazyRef
+
+# Типы, которые не требуют преобразования при загрузке
+SCALARS = frozenset((str, int, float, bool, bytes, ObjectId, type(None)))
+
+
+class ReadOnly(Exception):
+    '''Попытка изменить объект, загруженный только для чтения.'''
+
+
+def refuse(self, *args, **kwargs) -> NoReturn:
+    '''Запрещает изменение объекта.'''
+    # pylint: disable=unused-argument
+    raise ReadOnly('{} is read-only'.format(type(self).__name__))
+
+
+class FrozenList(list):
+    '''Неизменяемый список документа, загруженного только для чтения.'''
+
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = refuse
+    append = extend = insert = pop = remove = clear = refuse
+    sort = reverse = refuse
+
+
+class FrozenDict(dict):
+    '''Неизменяемый словарь документа, загруженного только для чтения.'''
+
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __ior__ = refuse
+    pop = popitem = clear = setdefault = update = refuse
+
+
+def freeze(obj: Any) -> Any:
+    '''Transform MongoDB document to read-only object.'''
+    frozen: Any
+
+    if type(obj) in SCALARS:  # pylint: disable=unidiomatic-typecheck
+        frozen = obj
+
+    elif isinstance(obj, datetime) and obj.tzinfo is None:
+        frozen = obj.replace(tzinfo=timezone.utc)
+
+    elif isinstance(obj, list):
+        frozen = FrozenList([freeze(x) for x in obj])
+
+    elif isinstance(obj, dict) and '_class' in obj:
+        cls = resolve_class(obj['_class'])
+        frozen = cls.__new__(cls)
+        frozen.__setstate__(obj, readonly=True)
+
+    elif isinstance(obj, dict):
+        frozen = FrozenDict([(k, freeze(v)) for k, v in obj.items()])
+
+    elif isinstance(obj, DBRef):
+        frozen = LazyRef(obj)
+
+    else:
+        frozen = obj
+
+    return frozen
@@ -0,0 +1,75 @@
+'''Параллельный просмотр коллекции по сегментам.'''
+
+__author__ = 'Gennady Kovalev <gik@bigur.ru>'
+__copyright__ = '(c) 2016-2019 Development management business group'
+__licence__ = 'For license information see LICENSE'
+
+from asyncio import CancelledError, Queue, ensure_future, gather
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+Range = Tuple[Optional[Any], Optional[Any]]
+
+_DONE = object()
+
+
+def split_ranges(sample: Sequence[Any], segments: int) -> List[Range]:
+    '''Делит пространство ИД на `segments` диапазонов примерно равного
+    размера по отсортированной выборке ИД `sample`. Первый диапазон не
+    ограничен снизу, последний сверху.'''
+    bounds: List[Any] = []
+    if sample and segments > 1:
+        step = len(sample) / segments
+        for index in range(1, segments):
+            bound = sample[int(index * step)]
+            if not bounds or bound != bounds[-1]:
+                bounds.append(bound)
+    lower = [None] + bounds
+    upper = bounds + [None]
+    return list(zip(lower, upper))
+
+
+def range_query(query: Dict[str, Any], range_: Range) -> Dict[str, Any]:
+    '''Ограничивает запрос диапазоном ИД `[lower, upper)`.'''
+    lower, upper = range_
+    condition = {}
+    if lower is not None:
+        condition['$gte'] = lower
+    if upper is not None:
+        condition['$lt'] = upper
+    if not condition:
+        return query
+    return {'$and': [query, {'_id': condition}]}
+
+
+async def merge(cursors: Sequence[Any], buffer: int = 1000) -> AsyncIterator:
+    '''Одновременно читает все курсоры и возвращает их документы в одном
+    потоке в порядке поступления. Если перебор прерван, чтение курсоров
+    останавливается.'''
+    queue: Queue = Queue(buffer)
+
+    async def read(cursor):
+        try:
+            async for item in cursor:
+                await queue.put(item)
+        except CancelledError:
+            # The consumer has stopped, nobody waits for the end marker
+            raise
+        except Exception as exc:  # pylint: disable=broad-except
+            await queue.put(exc)
+        await queue.put(_DONE)
+
+    tasks = [ensure_future(read(x)) for x in cursors]
+    try:
+        running = len(tasks)
+        while running:
+            item = await queue.get()
+            if item is _DONE:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+        await gather(*tasks, return_exceptions=True)
@@ -2,10 +2,16 @@ __author__ = 'Gennady Kovalev <gik@bigur.ru>'
 __copyright__ = '(c) 2016-2018 Business group for development management'
 __licence__ = 'For license information see LICENSE'
 
+from importlib.util import find_spec
 from os import environ
+from urllib.parse import urlparse
+
 from pytest import fixture, mark
 
 from bigur.store import db
+from bigur.store.database import BACKENDS
+
+TEST_DB = environ.get('BIGUR_TEST_DB', 'memory://test')
 
 
 @fixture
@@ -17,12 +23,26 @@ def debug(caplog):
 
 
 @fixture
-async def database():
+def database():
     '''Database connection.'''
-    db.configure(environ.get('BIGUR_TEST_DB'))
+    db.configure(TEST_DB)
     yield db
 
 
+def backend_available(uri: str) -> bool:
+    '''Проверяет, что для адреса `uri` есть хранилище и его драйвер.'''
+    scheme = urlparse(uri).scheme
+    if scheme not in BACKENDS:
+        return False
+    return scheme == 'memory' or find_spec('motor') is not None
+
+
+# Тесты с базой данных по умолчанию выполняются в памяти, для проверки на
+# сервере MongoDB задайте BIGUR_TEST_DB.
 mark.db_configured = mark.skipif(
-    environ.get('BIGUR_TEST_DB') is None,
-    reason='Please define BIGUR_TEST_DB with test database uri')
+    not backend_available(TEST_DB),
+    reason='No storage backend for BIGUR_TEST_DB {}'.format(TEST_DB))
+
+mark.mongodb = mark.skipif(
+    not environ.get('BIGUR_TEST_DB', '').startswith('mongodb'),
+    reason='Please define BIGUR_TEST_DB with MongoDB database uri')
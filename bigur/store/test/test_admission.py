@@ -0,0 +1,137 @@
+'''Тестирование допуска операций к базе данных.'''
+
+__author__ = 'Gennady Kovalev <gik@bigur.ru>'
+__copyright__ = '(c) 2016-2019 Development management business group'
+__licence__ = 'For license information see LICENSE'
+
+from asyncio import Event, ensure_future, gather, sleep
+
+from pytest import mark, raises
+
+from bigur.store import Stored, UnitOfWork
+from bigur.store.admission import AdmissionControl, Overloaded
+
+
+class Ticket(Stored):
+    '''Билет.'''
+
+    __metadata__ = {
+        'concurrency': 2,
+    }
+
+    def __init__(self, number: int) -> None:
+        self.number: int = number
+        super().__init__()
+
+
+class TestAdmission:
+    '''Тесты допуска операций.'''
+
+    @mark.asyncio
+    async def test_priority(self):
+        '''Операции сверх лимита допускаются по приоритетам.'''
+        control = AdmissionControl()
+        control.limits['tickets'] = 1
+        order = []
+        release = Event()
+
+        async def operation(name, priority):
+            with control.scope(priority=priority):
+                async with control.admit('tickets'):
+                    order.append(name)
+                    await release.wait()
+
+        first = ensure_future(operation('first', 'normal'))
+        await sleep(0)
+        rest = [
+            ensure_future(operation('batch', 'batch')),
+            ensure_future(operation('normal', 'normal')),
+            ensure_future(operation('interactive', 'interactive')),
+        ]
+        await sleep(0)
+        assert control.stats('tickets').queued == 3
+        release.set()
+        await gather(first, *rest)
+
+        assert order == ['first', 'interactive', 'normal', 'batch']
+        stats = control.stats('tickets')
+        assert stats.admitted == 4
+        assert stats.max_queued == 3
+        assert stats.active == 0
+        assert stats.wait_time > 0
+
+    @mark.asyncio
+    async def test_reject(self):
+        '''Отказ при истёкшем сроке и переполненной очереди.'''
+        control = AdmissionControl()
+        control.default_limit = 1
+        control.max_queue = 1
+        release = Event()
+
+        async def hold():
+            async with control.admit('tickets'):
+                await release.wait()
+
+        holder = ensure_future(hold())
+        await sleep(0)
+
+        with control.scope(timeout=0.01):
+            with raises(Overloaded):
+                async with control.admit('tickets'):
+                    pass
+
+        waiter = ensure_future(hold())
+        await sleep(0)
+        with raises(Overloaded):
+            async with control.admit('tickets'):
+                pass
+
+        with control.scope(timeout=-1):
+            with raises(Overloaded):
+                async with control.admit('other'):
+                    pass
+
+        release.set()
+        await gather(holder, waiter)
+        assert control.stats('tickets').rejected == 2
+        assert control.stats('tickets').queued == 0
+
+    @mark.asyncio
+    async def test_databases(self):
+        '''Одноимённые коллекции разных баз данных ограничиваются
+        отдельно.'''
+        control = AdmissionControl()
+        control.limits['tickets'] = 1
+        release = Event()
+
+        async def hold():
+            async with control.admit(('first', 'tickets')):
+                await release.wait()
+
+        holder = ensure_future(hold())
+        await sleep(0)
+        with control.scope(timeout=0.01):
+            async with control.admit(('second', 'tickets')):
+                pass
+            with raises(Overloaded):
+                async with control.admit(('first', 'tickets')):
+                    pass
+        release.set()
+        await holder
+        assert control.stats(('first', 'tickets')).rejected == 1
+        assert control.stats(('second', 'tickets')).admitted == 1
+
+    @mark.asyncio
+    @mark.db_configured
+    async def test_class_limit(self, database):
+        '''Лимит класса из метаданных.'''
+        async with UnitOfWork():
+            ticket = Ticket(1)
+
+        async with UnitOfWork():
+            await gather(*[Ticket.find_one({'_id': ticket.id})
+                           for _ in range(5)])
+        key = (Ticket.get_collection().database.name, 'ticket')
+        assert database.admission.limits[key] == 2
+        assert database.admission.stats(key).admitted >= 5
+        assert database.admission.stats(('other', 'ticket')).admitted == 0
@@ -0,0 +1,112 @@
+'''Тестирование настроек кодирования BSON.'''
+
+__author__ = 'Gennady Kovalev <gik@bigur.ru>'
+__copyright__ = '(c) 2016-2019 Development management business group'
+__licence__ = 'For license information see LICENSE'
+
+from datetime import datetime, timezone
+from decimal import Decimal
+from io import BytesIO
+
+from bson import DBRef, decode, encode
+from bson.codec_options import TypeEncoder
+from pytest import mark
+
+from bigur.store import LazyRef, Stored, UnitOfWork, db
+from bigur.store import codec
+from bigur.store.codec import get_codec_options, register_type
+from bigur.store.test.conftest import TEST_DB
+from bigur.store.transfer import export
+
+
+class Parcel(Stored):
+    '''Посылка.'''
+
+    def __init__(self, sent: datetime, sender: Stored = None) -> None:
+        self.sent: datetime = sent
+        self.sender = sender
+        super().__init__()
+
+
+class DecimalEncoder(TypeEncoder):
+    '''Сохраняет числа Decimal строкой.'''
+
+    python_type = Decimal
+
+    def transform_python(self, value: Decimal) -> str:
+        return str(value)
+
+
+class TestCodec:
+    '''Тесты настроек кодирования.'''
+
+    def test_decode(self):
+        '''Даты и ссылки преобразуются декодером.'''
+        data = encode({
+            'sent': datetime(2019, 1, 1),
+            'refs': [DBRef('parcels', 1)],
+        })
+        document = decode(data, get_codec_options())
+        assert document['sent'] == datetime(2019, 1, 1, tzinfo=timezone.utc)
+        assert isinstance(document['refs'][0], LazyRef)
+        assert document['refs'][0].id == 1
+
+        data = encode({'ref': document['refs'][0]},
+                      codec_options=get_codec_options())
+        assert decode(data) == {'ref': DBRef('parcels', 1)}
+
+    def test_register_type(self):
+        '''Регистрация собственного типа.'''
+        encoder = register_type(DecimalEncoder())
+        try:
+            data = encode({'price': Decimal('1.10')},
+                          codec_options=get_codec_options())
+            assert decode(data) == {'price': '1.10'}
+        finally:
+            codec.codecs.remove(encoder)
+
+    @mark.asyncio
+    @mark.db_configured
+    async def test_load(self, database):
+        '''Загрузка объекта с датой и ссылкой.'''
+        sent = datetime(2019, 5, 1, 12, tzinfo=timezone.utc)
+        async with UnitOfWork():
+            sender = Parcel(sent)
+            parcel = Parcel(sent, sender)
+
+        async with UnitOfWork():
+            loaded = await Parcel.find_one({'_id': parcel.id})
+            assert loaded.sent == sent
+            assert isinstance(loaded.sender, LazyRef)
+            assert (await loaded.sender.resolve()).id == sender.id
+            found = await Parcel.find_one({'sender': loaded.sender})
+            assert found.id == parcel.id
+
+    @mark.asyncio
+    @mark.db_configured
+    async def test_encode(self, database):
+        '''Собственные типы и ссылки при подсчёте размера, слиянии и
+        выгрузке.'''
+        encoder = register_type(DecimalEncoder())
+        try:
+            db.configure(TEST_DB)
+            sent = datetime(2019, 5, 1, tzinfo=timezone.utc)
+            async with UnitOfWork(measure_bytes=True) as uow:
+                sender = Parcel(sent)
+                sender.price = Decimal('1.10')
+                parcel = Parcel(sent, sender)
+                parcel.route = {'from': sender}
+            assert uow.stats.bytes_serialized > 0
+
+            async with UnitOfWork(measure_bytes=True):
+                loaded = await Parcel.find_one({'_id': parcel.id})
+                assert 'route' in loaded.__raw__
+                await loaded.merge()
+
+            stream = BytesIO()
+            assert await export(Parcel.get_collection(), stream,
+                                {'_id': parcel.id}, 'ndjson') == 1
+            assert str(sender.id) in stream.getvalue().decode('utf-8')
+        finally:
+            codec.codecs.remove(encoder)
+            db.configure(TEST_DB)
@@ -0,0 +1,75 @@
+'''Тестирование сжатия полей.'''
+
+__author__ = 'Gennady Kovalev <gik@bigur.ru>'
+__copyright__ = '(c) 2016-2019 Development management business group'
+__licence__ = 'For license information see LICENSE'
+
+from pytest import mark, raises
+
+from bigur.store import Stored, UnitOfWork
+from bigur.store.compression import (compress, compressed, decompress,
+                                     is_compressed)
+
+
+class Article(Stored):
+    '''Статья.'''
+
+    __metadata__ = {
+        'picklers': {
+            'text': compressed(threshold=100),
+            'meta': compressed(threshold=100, algorithm='lzma'),
+        }
+    }
+
+    def __init__(self, title: str, text: str, meta: dict) -> None:
+        self.title: str = title
+        self.text: str = text
+        self.meta: dict = meta
+        super().__init__()
+
+
+class TestCompression:
+    '''Тесты сжатия полей.'''
+
+    def test_compress(self):
+        '''Сжатие значений разных типов.'''
+        for value in ('текст ' * 100, b'x' * 1000, {'a': ['b' * 500]}):
+            packed = compress(value, threshold=100)
+            assert is_compressed(packed)
+            assert len(packed) < 200
+            assert decompress(packed) == value
+        assert compress('short', threshold=100) == 'short'
+        assert decompress('short') == 'short'
+        with raises(ValueError):
+            compressed(algorithm='unknown')
+
+    @mark.asyncio
+    @mark.db_configured
+    async def test_lazy(self, database):
+        '''Поле распаковывается при первом обращении.'''
+        text = 'Lorem ipsum dolor sit amet. ' * 100
+        async with UnitOfWork() as uow:
+            article = Article('Lorem', text, {'tags': ['a' * 200]})
+        assert uow.stats.bytes_uncompressed > 3000
+        assert uow.stats.compression_ratio > 10
+
+        async with UnitOfWork():
+            document = await Article.get_collection().find_one(
+                {'_id': article.id}, projection={'text': 1})
+            assert is_compressed(document['text'])
+
+        async with UnitOfWork() as uow:
+            loaded = await Article.find_one({'_id': article.id})
+            assert set(loaded.__dict__['__raw__']) == {'text', 'meta'}
+            assert loaded.text == text
+            assert set(loaded.__dict__['__raw__']) == {'meta'}
+            assert uow.stats.decompress_time > 0
+            loaded.meta = {'tags': ['a' * 200, 'b']}
+
+        async with UnitOfWork() as uow:
+            loaded = await Article.find_one({'_id': article.id})
+            assert loaded.meta['tags'] == ['a' * 200, 'b']
+            assert loaded.text == text
+            loaded.title = 'Ipsum'
+
+        assert uow.stats.bytes_compressed == 0
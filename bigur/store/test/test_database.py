@@ -0,0 +1,114 @@
+'''Тестирование подключений к базам данных.'''
+
+__author__ = 'Gennady Kovalev <gik@bigur.ru>'
+__copyright__ = '(c) 2016-2018 Business group for development management'
+__licence__ = 'For license information see LICENSE'
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from types import SimpleNamespace
+
+from bson import encode
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from pytest import mark
+
+from bigur.store.database import DBProxy, DecodingCursor, tenant
+from bigur.store.unit_of_work import UnitOfWork
+
+
+class RawCursor:
+    '''Курсор, отдающий заранее заданные пакеты BSON.'''
+
+    def __init__(self, *batches):
+        self.batches = list(batches)
+        self.collection = SimpleNamespace(codec_options=DEFAULT_CODEC_OPTIONS)
+
+    async def next(self):
+        if not self.batches:
+            raise StopAsyncIteration
+        return self.batches.pop(0)
+
+
+class TestDBProxy:
+    '''Тесты выбора базы данных.'''
+
+    def test_connections(self):
+        '''Выбор именованного подключения и базы данных.'''
+        proxy = DBProxy()
+        proxy.configure('mongodb://localhost/main')
+        proxy.configure('mongodb://localhost/events', connection='events')
+
+        assert proxy.get_database().name == 'main'
+        assert proxy.get_database('events').name == 'events'
+        assert proxy.get_database('events', 'archive').name == 'archive'
+        assert proxy.resolve_database('archive').client \
+            is proxy.get_connection('events').client
+
+    def test_tenant(self):
+        '''Выбор базы данных через контекстную переменную.'''
+        proxy = DBProxy()
+        proxy.configure('mongodb://localhost/main')
+
+        token = tenant.set('acme')
+        try:
+            assert proxy['address'].database.name == 'acme'
+            assert proxy.get_database(database='shared').name == 'shared'
+        finally:
+            tenant.reset(token)
+        assert proxy['address'].database.name == 'main'
+
+    def test_compressors(self):
+        '''Настройка сжатия трафика.'''
+        proxy = DBProxy()
+        proxy.compressors = ['zlib']
+        proxy.configure('mongodb://localhost/main')
+        proxy.configure('mongodb://localhost/events?compressors=zlib',
+                        connection='events', compressors=['snappy'])
+        proxy.configure('mongodb://localhost/logs', connection='logs',
+                        compressors=[])
+
+        assert proxy.get_compressors() == ['zlib']
+        assert proxy.get_compressors('events') == ['zlib']
+        assert proxy.get_compressors('logs') == []
+
+        proxy = DBProxy()
+        proxy.configure('mongodb://localhost/main')
+        assert proxy.get_compressors() == []
+
+
+class TestDecodingCursor:
+    '''Тесты декодирования пакетов вне цикла событий.'''
+
+    @mark.asyncio
+    async def test_decode(self):
+        '''Декодирование мелких пакетов на месте и крупных в пуле.'''
+        small = encode({'_id': 1})
+        large = b''.join(encode({
+            '_id': x,
+            '_class': 'bigur.store.test.test_unit_of_work.Address',
+            'street': 'Тверская'
+        }) for x in range(2, 5))
+        with ThreadPoolExecutor(1) as executor:
+            async with UnitOfWork() as uow:
+                cursor = DecodingCursor(RawCursor(small, large), executor,
+                                        len(small) + 1)
+                result = await cursor.to_list()
+        assert result[0] == {'_id': 1}
+        assert [x.street for x in result[1:]] == ['Тверская'] * 3
+        assert result[1].__unit_of_work__ is uow
+        assert uow.stats.loaded == 3
+
+    @mark.asyncio
+    async def test_decode_process(self):
+        '''Декодирование крупных пакетов в пуле процессов.'''
+        large = b''.join(encode({
+            '_id': x,
+            '_class': 'bigur.store.test.test_unit_of_work.Address',
+            'street': 'Тверская'
+        }) for x in range(3))
+        with ProcessPoolExecutor(1) as executor:
+            async with UnitOfWork() as uow:
+                cursor = DecodingCursor(RawCursor(large), executor, 1)
+                result = await cursor.to_list()
+        assert [x.street for x in result] == ['Тверская'] * 3
+        assert result[0].__unit_of_work__ is uow
+        assert uow.stats.loaded == 3
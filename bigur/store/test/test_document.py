@@ -4,10 +4,16 @@ __author__ = 'Gennady Kovalev <gik@bigur.ru>'
 __copyright__ = '(c) 2016-2018 Business group for development management'
 __licence__ = 'For license information see LICENSE'
 
+from datetime import datetime, timedelta, timezone
 from typing import Optional
 
-from pytest import mark
-from bigur.store import Stored, Embedded, EmbeddedList, EmbeddedDict
+from bson import DBRef
+from pytest import mark, raises
+
+from bigur.store import (Stored, Embedded, EmbeddedList, EmbeddedDict,
+                         LazyRef, UnitOfWork)
+from bigur.store.lazy_ref import IntegrityError, NotResolved
+from bigur.store.readonly import FrozenDict, FrozenList, ReadOnly
 
 
 class Flat(Embedded):
@@ -36,6 +42,70 @@ class Address(Stored):
         super().__init__()
 
 
+class Person(Stored):
+    '''Житель.'''
+
+    def __init__(self, name: str, phone: str) -> None:
+        self.name: str = name
+        self.phone: str = phone
+        super().__init__()
+
+
+class Registration(Stored):
+    '''Регистрация по адресу.'''
+
+    __metadata__ = {
+        'references': {
+            'person': ['name'],
+        }
+    }
+
+    def __init__(self, person: Person, address: Address) -> None:
+        self.person: Person = person
+        self.address: Address = address
+        super().__init__()
+
+
+class Measurement(Stored):
+    '''Показание датчика.'''
+
+    __metadata__ = {
+        'timeseries': {
+            'time_field': 'taken',
+            'meta_field': 'sensor',
+            'granularity': 'minutes',
+            'expire_after': 86400,
+        }
+    }
+
+    def __init__(self, taken: datetime, sensor: str, value: float) -> None:
+        self.taken: datetime = taken
+        self.sensor: str = sensor
+        self.value: float = value
+        super().__init__()
+
+
+class Shipment(Stored):
+    '''Отправление в шардированной коллекции.'''
+
+    __metadata__ = {
+        'shard_key': ['region', '_id'],
+    }
+
+    def __init__(self, region: str, weight: int) -> None:
+        self.region: str = region
+        self.weight: int = weight
+        super().__init__()
+
+
+class Delivery(Stored):
+    '''Доставка отправления.'''
+
+    def __init__(self, shipment: Shipment) -> None:
+        self.shipment: Shipment = shipment
+        super().__init__()
+
+
 class TestDocument(object):
     '''Тестирование документа БД.'''
     @mark.asyncio
@@ -118,3 +188,164 @@ class TestDocument(object):
         address = object.__new__(Address)
         address.__setstate__(state)
         assert isinstance(address.settings, EmbeddedDict)
+
+    @mark.asyncio
+    async def test_deferred_unpickle(self):
+        '''Отложенное восстановление вложенных документов.'''
+        house = {
+            '_class': 'store.test.test_document.House',
+            'number': 25,
+            'flat': {
+                '_class': 'store.test.test_document.Flat',
+                'number': 8
+            }
+        }
+        address = object.__new__(Address)
+        address.__setstate__({
+            '_class': 'store.test.test_document.Address',
+            'street': 'Никольская',
+            'house': house
+        })
+        assert 'house' not in address.__dict__
+        assert address.__getstate__()['house'] is house
+
+        assert isinstance(address.house, House)
+        assert address.house.__node_parent__ is address
+        assert address.house.__node_name__ == 'house'
+        assert address.house.flat.number == 8
+        assert address.__getstate__()['house'] == house
+
+    @mark.asyncio
+    @mark.db_configured
+    async def test_reference_snapshot(self, database):
+        '''Поля объекта, сохранённые в ссылке.'''
+        async with UnitOfWork():
+            person = Person('Иван', '123')
+            address = Address('Никольская')
+            registration = Registration(person, address)
+            state = registration.__getstate__()
+            assert state['person'] == DBRef('person', person.id,
+                                            name='Иван')
+            assert state['address'] == DBRef('address', address.id)
+
+        async with UnitOfWork():
+            loaded = await Registration.find_one({'_id': registration.id})
+            assert isinstance(loaded.person, LazyRef)
+            assert loaded.person.name == 'Иван'
+            with raises(NotResolved):
+                assert loaded.person.phone
+            person = await loaded.person.resolve()
+            person.name = 'Пётр'
+
+        async with UnitOfWork():
+            assert await Stored.refresh_snapshots(person) == 1
+            loaded = await Registration.find_one({'person.$id': person.id})
+            assert loaded.person.name == 'Пётр'
+            assert loaded.__getstate__()['person'].name == 'Пётр'
+
+    @mark.asyncio
+    @mark.db_configured
+    async def test_readonly(self, database):
+        '''Загрузка объектов только для чтения.'''
+        async with UnitOfWork():
+            address = Address('Никольская', House(25, Flat(8)))
+            address.letters = EmbeddedList(['а', 'б'])
+            address.settings = EmbeddedDict({'floor': 3})
+            person = Person('Иван', '123')
+            registration = Registration(person, address)
+
+        async with UnitOfWork() as uow:
+            loaded = await Address.find_one({'_id': address.id},
+                                            readonly=True)
+            assert loaded.house.flat.number == 8
+            assert isinstance(loaded.letters, FrozenList)
+            assert isinstance(loaded.settings, FrozenDict)
+            assert '__unit_of_work__' not in loaded.__dict__
+            assert '__node_parent__' not in loaded.house.__dict__
+            with raises(ReadOnly):
+                loaded.street = 'Тверская'
+            with raises(ReadOnly):
+                loaded.house.flat.number = 9
+            with raises(ReadOnly):
+                loaded.letters.append('в')
+            with raises(ReadOnly):
+                loaded.settings['floor'] = 4
+            with raises(ReadOnly):
+                await loaded.remove()
+
+            found = await Address.find({}, readonly=True).to_list(None)
+            assert [x.street for x in found] == ['Никольская']
+            assert uow.stats.loaded == 0
+
+            loaded = await Registration.find_one({'_id': registration.id},
+                                                 readonly=True)
+            frozen = await loaded.person.resolve(readonly=True)
+            with raises(ReadOnly):
+                frozen.name = 'Пётр'
+            person = await loaded.person.resolve()
+            person.name = 'Пётр'
+
+        async with UnitOfWork():
+            loaded = await Person.find_one({'_id': person.id})
+            assert loaded.name == 'Пётр'
+
+    @mark.asyncio
+    @mark.db_configured
+    async def test_timeseries(self, database):
+        '''Коллекция временных рядов.'''
+        assert Measurement.get_collection_options() == {
+            'timeseries': {
+                'timeField': 'taken',
+                'metaField': 'sensor',
+                'granularity': 'minutes',
+            },
+            'expireAfterSeconds': 86400,
+        }
+        await database.drop_collection('measurement')
+        assert await Measurement.create_collection()
+        assert not await Measurement.create_collection()
+
+        start = datetime(2019, 5, 1, tzinfo=timezone.utc)
+        async with UnitOfWork() as uow:
+            for minute in range(6):
+                for sensor in ('north', 'south'):
+                    Measurement(start + timedelta(minutes=minute), sensor,
+                                float(minute))
+        assert uow.stats.round_trips[('measurement', 'insert_many')] == 1
+        assert uow.stats.round_trips[('measurement', 'insert_one')] == 0
+
+        async with UnitOfWork():
+            found = await Measurement.find_range(
+                start + timedelta(minutes=1), start + timedelta(minutes=4),
+                meta='north', readonly=True).to_list(None)
+            assert [x.value for x in found] == [1.0, 2.0, 3.0]
+            assert all(x.sensor == 'north' for x in found)
+
+        with raises(ValueError):
+            Address.find_range(start, start)
+
+    @mark.asyncio
+    @mark.db_configured
+    async def test_shard_key(self, database):
+        '''Значения ключа шардирования в условиях поиска.'''
+        async with UnitOfWork():
+            shipment = Shipment('eu', 1)
+            delivery = Delivery(shipment)
+            assert Shipment.get_id_filter(shipment) == {
+                '_id': shipment.id, 'region': 'eu'}
+            assert delivery.__getstate__()['shipment'] == DBRef(
+                'shipment', shipment.id, region='eu')
+            operation = Shipment.delete_operation(shipment)
+            assert operation._filter == {'_id': shipment.id, 'region': 'eu'}
+
+        async with UnitOfWork():
+            loaded = await Delivery.find_one({'_id': delivery.id})
+            resolved = await loaded.shipment.resolve()
+            resolved.weight = 2
+
+        async with UnitOfWork():
+            loaded = await Shipment.find_one({'_id': shipment.id})
+            assert loaded.weight == 2
+            with raises(IntegrityError):
+                await LazyRef(DBRef('shipment', shipment.id,
+                                    region='us')).resolve()
@@ -0,0 +1,55 @@
+'''Тестирование времени импорта пакета.'''
+
+__author__ = 'Gennady Kovalev <gik@bigur.ru>'
+__copyright__ = '(c) 2016-2019 Development management business group'
+__licence__ = 'For license information see LICENSE'
+
+from os import environ
+from subprocess import run
+from sys import executable
+
+# Предельное время импорта классов документов, микросекунды
+IMPORT_BUDGET = int(environ.get('BIGUR_IMPORT_BUDGET', 500000))
+
+
+def run_python(code: str) -> str:
+    '''Выполняет код в отдельном интерпретаторе.'''
+    result = run([executable, '-c', code],
+                 capture_output=True, text=True, check=True)
+    return result.stdout + result.stderr
+
+
+class TestImport:
+    '''Тесты отложенной загрузки модулей.'''
+
+    def test_lazy_driver(self):
+        '''Драйвер загружается только при подключении.'''
+        output = run_python(
+            'import sys\n'
+            'from bigur.store import Stored, UnitOfWork, db\n'
+            'print(sorted(m for m in ("motor", "pymongo") '
+            'if m in sys.modules))\n'
+            'db.configure("mongodb://localhost/test")\n'
+            'print("motor" in sys.modules)\n')
+        assert output.split('\n')[:2] == ['[]', 'True']
+
+    def test_lazy_modules(self):
+        '''Выгрузка, параллельный просмотр и постраничный вывод
+        загружаются при первом использовании.'''
+        output = run_python(
+            'import sys\n'
+            'import bigur.store\n'
+            'from bigur.store import Stored, UnitOfWork\n'
+            'print(sorted(m for m in ("bigur.store.transfer", '
+            '"bigur.store.scan", "bigur.store.pagination", "bz2", "gzip", '
+            '"lzma", "mmap") if m in sys.modules))\n')
+        assert output.split('\n')[0] == '[]'
+
+    def test_import_time(self):
+        '''Время импорта классов документов.'''
+        output = run_python(
+            'from time import perf_counter\n'
+            'start = perf_counter()\n'
+            'from bigur.store import Stored, UnitOfWork\n'
+            'print(int((perf_counter() - start) * 1000000))\n')
+        assert 0 < int(output.split('\n')[0]) < IMPORT_BUDGET
@@ -0,0 +1,104 @@
+'''Тестирование хранилища в памяти.'''
+
+__author__ = 'Gennady Kovalev <gik@bigur.ru>'
+__copyright__ = '(c) 2016-2019 Development management business group'
+__licence__ = 'For license information see LICENSE'
+
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pytest import mark, raises
+
+from bigur.store import abc
+from bigur.store.database import get_backend
+from bigur.store.memory import (MemoryCollection, apply_update, match,
+                                project)
+
+
+class TestMemory:
+    '''Тесты хранилища в памяти.'''
+
+    def test_backend(self):
+        '''Выбор хранилища по схеме адреса.'''
+        collection = get_backend('memory://test')['test']['items']
+        assert isinstance(collection, MemoryCollection)
+        assert isinstance(collection, abc.Collection)
+        with raises(ValueError):
+            get_backend('unknown://test')
+
+    def test_match(self):
+        '''Операторы запросов.'''
+        document = {'a': 1, 'b': {'c': [1, 2, 3]}, 'd': [{'e': 'x'}]}
+        assert match(document, {'a': 1})
+        assert match(document, {'a': {'$gte': 1, '$lt': 2}})
+        assert not match(document, {'a': {'$gt': 1}})
+        assert match(document, {'b.c': 2})
+        assert match(document, {'b.c': {'$all': [1, 3], '$size': 3}})
+        assert match(document, {'d.e': {'$in': ['x', 'y']}})
+        assert match(document, {'d': {'$elemMatch': {'e': 'x'}}})
+        assert match(document, {'f': None, 'f.g': {'$exists': False}})
+        assert match(document, {'$or': [{'a': 2}, {'d.e': {'$regex': '^X',
+                                                           '$options': 'i'}}]})
+        assert not match(document, {'a': {'$not': {'$eq': 1}}})
+        assert not match(document, {'a': '1'})
+
+    def test_update(self):
+        '''Операторы обновления.'''
+        document = {'a': 1, 'l': [1, 2]}
+        apply_update(document, {
+            '$inc': {'a': 2},
+            '$set': {'b.c': 'x'},
+            '$push': {'l': {'$each': [3, 4]}},
+            '$addToSet': {'s': 1},
+            '$max': {'m': 5},
+        })
+        assert document == {'a': 3, 'b': {'c': 'x'}, 'l': [1, 2, 3, 4],
+                            's': [1], 'm': 5}
+        apply_update(document, {'$unset': {'b.c': ''}, '$pull': {'l': 2}})
+        assert document['b'] == {}
+        assert document['l'] == [1, 3, 4]
+
+    def test_project(self):
+        '''Проекции документов.'''
+        document = {'_id': 1, 'a': 1, 'b': {'c': 2, 'd': 3}}
+        assert project(document, {'_id': 1}) == {'_id': 1}
+        assert project(document, {'b.c': 1}) == {'_id': 1, 'b': {'c': 2}}
+        assert project(document, {'a': 1, '_id': 0}) == {'a': 1}
+        assert project(document, {'_id': 0}) == {'a': 1,
+                                                 'b': {'c': 2, 'd': 3}}
+        assert project(document, {'b': 0}) == {'_id': 1, 'a': 1}
+
+    @mark.asyncio
+    async def test_collection(self):
+        '''Запись и чтение коллекции.'''
+        collection = get_backend('memory://test')['test']['items']
+        await collection.insert_many([{'_id': i, 'n': i % 3}
+                                      for i in range(10)])
+        with raises(DuplicateKeyError):
+            await collection.insert_one({'_id': 1})
+
+        result = await collection.update_one({'_id': 100},
+                                             {'$set': {'n': 5}},
+                                             upsert=True)
+        assert result.upserted_id == 100
+        assert await collection.count_documents({'n': {'$gte': 2}}) == 4
+
+        documents = await collection.find({'n': 0}).sort(
+            '_id', -1).limit(2).to_list(None)
+        assert [x['_id'] for x in documents] == [9, 6]
+
+        with raises(BulkWriteError) as error:
+            await collection.bulk_write([
+                UpdateOne({'_id': 1}, {'$inc': {'n': 1}}),
+                ReplaceOne({'_id': 200}, {'n': 0}, upsert=True),
+                InsertOne({'_id': 2}),
+                InsertOne({'_id': 300}),
+            ], ordered=False)
+        details = error.value.details
+        assert details['nModified'] == 1
+        assert details['nUpserted'] == 1
+        assert details['nInserted'] == 1
+        assert [x['index'] for x in details['writeErrors']] == [2]
+
+        assert (await collection.delete_one({'_id': 300})).deleted_count == 1
+        assert await collection.find_one(300) is None
+        assert (await collection.find_one(1))['n'] == 2
@@ -0,0 +1,107 @@
+'''Тестирование постраничного вывода.'''
+
+__author__ = 'Gennady Kovalev <gik@bigur.ru>'
+__copyright__ = '(c) 2016-2019 Development management business group'
+__licence__ = 'For license information see LICENSE'
+
+from typing import Optional
+
+from bson import ObjectId
+from pytest import mark, raises
+
+from bigur.store import Stored, UnitOfWork
+from bigur.store.pagination import (InvalidToken, decode_token, encode_token,
+                                    keyset_filter, normalize_sort)
+
+
+class Street(Stored):
+    '''Улица.'''
+
+    def __init__(self, name: str, district: Optional[str] = None) -> None:
+        self.name: str = name
+        self.district: Optional[str] = district
+        super().__init__()
+
+
+class TestPagination:
+    '''Тесты постраничного вывода.'''
+
+    def test_normalize_sort(self):
+        '''Добавление `_id` в сортировку.'''
+        assert normalize_sort([('name', -1)]) == [('name', -1), ('_id', -1)]
+        assert normalize_sort([('_id', 1)]) == [('_id', 1)]
+
+    def test_keyset_filter(self):
+        '''Условие выборки следующей страницы.'''
+        id_ = ObjectId()
+        sort = [('name', 1), ('_id', -1)]
+        assert keyset_filter(sort, ['a', id_]) == {
+            '$or': [{
+                'name': {'$gt': 'a'}
+            }, {
+                'name': 'a',
+                '_id': {'$lt': id_}
+            }]
+        }
+        assert keyset_filter([('name', -1), ('_id', 1)], [None, id_]) == {
+            '$or': [{
+                'name': None,
+                '_id': {'$gt': id_}
+            }]
+        }
+        assert keyset_filter(sort, [None, id_])['$or'][0] == {
+            'name': {'$ne': None}
+        }
+        assert keyset_filter([('name', -1)], ['a'])['$or'][0] == {
+            '$or': [{'name': {'$lt': 'a'}}, {'name': None}]
+        }
+
+    def test_token(self):
+        '''Упаковка и распаковка маркера.'''
+        id_ = ObjectId()
+        assert decode_token(encode_token(['a', id_])) == ['a', id_]
+        with raises(InvalidToken):
+            decode_token('garbage')
+
+    @mark.db_configured
+    @mark.asyncio
+    async def test_paginate(self, database):
+        '''Перебор страниц.'''
+        async with UnitOfWork():
+            streets = [Street('Тверская') for _ in range(5)]
+        ids = {x.id for x in streets}
+
+        found = []
+        token = None
+        while True:
+            page = await Street.paginate({'_id': {'$in': list(ids)}},
+                                         [('name', 1)], 2, token)
+            found.extend(x.id for x in page.items)
+            token = page.token
+            if token is None:
+                break
+        assert len(found) == 5
+        assert set(found) == ids
+
+    @mark.db_configured
+    @mark.asyncio
+    async def test_paginate_missing(self, database):
+        '''Перебор страниц по ключу с пустыми значениями.'''
+        async with UnitOfWork():
+            streets = [Street('Арбат', x)
+                       for x in ['Центр', None, 'Север', None, None]]
+        ids = {x.id for x in streets}
+
+        for direction in (1, -1):
+            found = []
+            token = None
+            while True:
+                page = await Street.paginate({'_id': {'$in': list(ids)}},
+                                             [('district', direction)], 2,
+                                             token)
+                found.extend(x.id for x in page.items)
+                token = page.token
+                if token is None:
+                    break
+            assert len(found) == 5
+            assert set(found) == ids
@@ -0,0 +1,84 @@
+'''Тестирование параллельного просмотра коллекции.'''
+
+__author__ = 'Gennady Kovalev <gik@bigur.ru>'
+__copyright__ = '(c) 2016-2019 Development management business group'
+__licence__ = 'For license information see LICENSE'
+
+from asyncio import wait_for
+
+from pytest import mark, raises
+
+from bigur.store import Stored, UnitOfWork
+from bigur.store.scan import merge, range_query, split_ranges
+
+
+async def produce(*items):
+    '''Асинхронный источник документов.'''
+    for item in items:
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+class Item(Stored):
+    '''Элемент коллекции.'''
+
+    def __init__(self, number: int) -> None:
+        self.number: int = number
+        super().__init__()
+
+
+class TestScan:
+    '''Тесты параллельного просмотра.'''
+
+    def test_split_ranges(self):
+        '''Деление ИД на диапазоны.'''
+        assert split_ranges(list(range(8)), 4) == [(None, 2), (2, 4), (4, 6),
+                                                   (6, None)]
+        assert split_ranges([], 4) == [(None, None)]
+        assert split_ranges([1, 1, 1, 1], 2) == [(None, 1), (1, None)]
+
+    def test_range_query(self):
+        '''Ограничение запроса диапазоном.'''
+        assert range_query({'a': 1}, (None, None)) == {'a': 1}
+        assert range_query({'a': 1}, (1, None)) == {
+            '$and': [{'a': 1}, {'_id': {'$gte': 1}}]
+        }
+
+    @mark.asyncio
+    async def test_merge(self):
+        '''Объединение потоков.'''
+        result = [x async for x in merge([produce(1, 2), produce(3)], 1)]
+        assert sorted(result) == [1, 2, 3]
+
+        with raises(ValueError):
+            async for _ in merge([produce(1, ValueError()), produce(2)]):
+                pass
+
+    @mark.asyncio
+    async def test_merge_early_exit(self):
+        '''Прерывание перебора останавливает чтение курсоров.'''
+        stream = merge([produce(*range(10)), produce(*range(10))], buffer=2)
+        async for item in stream:
+            break
+        await wait_for(stream.aclose(), 3)
+
+    @mark.asyncio
+    @mark.db_configured
+    async def test_parallel_scan(self, database):
+        '''Просмотр коллекции по сегментам.'''
+        await database.drop_collection('item')
+        async with UnitOfWork():
+            items = [Item(x) for x in range(50)]
+
+        cursors = await Item.segment_cursors({}, 4, oversample=5)
+        assert len(cursors) > 1
+        numbers = []
+        for cursor in cursors:
+            numbers.extend([x.number async for x in cursor])
+        assert sorted(numbers) == list(range(50))
+
+        found = [x async for x in Item.parallel_scan(
+            {'number': {'$lt': 25}}, segments=3, buffer=4)]
+        assert all(isinstance(x, Item) for x in found)
+        assert sorted(x.id for x in found) == sorted(x.id for x in items[:25])
@@ -0,0 +1,148 @@
+'''Тестирование выгрузки и загрузки коллекций.'''
+
+__author__ = 'Gennady Kovalev <gik@bigur.ru>'
+__copyright__ = '(c) 2016-2019 Development management business group'
+__licence__ = 'For license information see LICENSE'
+
+from datetime import datetime, timezone
+from typing import Optional
+
+from bson import encode
+from bson.json_util import dumps
+from pytest import mark
+
+from bigur.store import LazyRef, Stored, UnitOfWork
+from bigur.store.codec import get_codec_options
+from bigur.store.transfer import load, open_file
+
+
+class FakeCollection:
+    '''Коллекция, запоминающая вставленные документы.'''
+
+    name = 'streets'
+    codec_options = get_codec_options()
+
+    def __init__(self) -> None:
+        self.documents = []
+        self.calls = 0
+
+    async def insert_many(self, documents, ordered=True):
+        self.calls += 1
+        self.documents.extend(dict(x) for x in documents)
+
+
+class Milestone(Stored):
+    '''Веха.'''
+
+    def __init__(self, title: str, due: datetime,
+                 previous: Optional['Milestone'] = None) -> None:
+        self.title: str = title
+        self.due: datetime = due
+        self.tags = ['road', title]
+        self.previous: Optional[Milestone] = previous
+        super().__init__()
+
+
+DOCUMENTS = [{'_id': x, 'name': 'street {}'.format(x)} for x in range(5)]
+
+
+class TestTransfer:
+    '''Тесты загрузки.'''
+
+    @mark.asyncio
+    @mark.parametrize('name,compression', [('dump.bson', None),
+                                           ('dump.bson.gz', 'gzip'),
+                                           ('dump.bson.xz', 'xz')])
+    async def test_load_bson(self, tmp_path, name, compression):
+        '''Загрузка BSON с пакетной вставкой.'''
+        path = str(tmp_path / name)
+        with open_file(path, 'w', compression) as stream:
+            for document in DOCUMENTS:
+                stream.write(encode(document))
+
+        collection = FakeCollection()
+        assert await load(collection, path, batch_size=2) == 5
+        assert collection.documents == DOCUMENTS
+        assert collection.calls == 3
+
+    @mark.asyncio
+    async def test_load_ndjson(self, tmp_path):
+        '''Загрузка NDJSON с преобразованием.'''
+        path = str(tmp_path / 'dump.ndjson')
+        with open(path, 'w') as stream:
+            for document in DOCUMENTS:
+                stream.write(dumps(document) + '\n')
+
+        collection = FakeCollection()
+        count = await load(collection, path, 'ndjson',
+                           transform=lambda x: x if x['_id'] % 2 else None)
+        assert count == 2
+        assert [x['_id'] for x in collection.documents] == [1, 3]
+
+    @mark.asyncio
+    @mark.db_configured
+    @mark.parametrize('name,format', [('milestones.bson', 'bson'),
+                                      ('milestones.bson.gz', 'bson'),
+                                      ('milestones.ndjson', 'ndjson')])
+    async def test_round_trip(self, database, tmp_path, name, format):
+        '''Выгрузка и обратная загрузка документов класса.'''
+        # pylint: disable=redefined-builtin
+        due = datetime(2019, 6, 1, 12, tzinfo=timezone.utc)
+        async with UnitOfWork():
+            milestones = [Milestone(x, due) for x in ('alpha', 'beta')]
+        ids = [x.id for x in milestones]
+        collection = Milestone.get_collection()
+        original = [x async for x in collection.find({'_id': {'$in': ids}},
+                                                     sort=[('_id', 1)])]
+
+        path = str(tmp_path / name)
+        query = {'_id': {'$in': ids}}
+        assert await Milestone.export(path, query, format) == 2
+        await collection.delete_many(query)
+        assert await Milestone.import_from(path, format) == 2
+
+        restored = [x async for x in collection.find({'_id': {'$in': ids}},
+                                                     sort=[('_id', 1)])]
+        assert restored == original
+
+        assert await Milestone.import_from(path, format, upsert=True) == 2
+        assert await collection.count_documents(query) == 2
+
+        async with UnitOfWork():
+            loaded = await Milestone.find_one({'_id': ids[0]})
+            assert loaded.title == 'alpha'
+            assert loaded.due == due
+            assert loaded.tags == ['road', 'alpha']
+
+    @mark.asyncio
+    @mark.db_configured
+    @mark.parametrize('format', ['bson', 'ndjson'])
+    async def test_transform_reference(self, database, tmp_path, format):
+        '''Преобразование документов со ссылками при выгрузке и
+        загрузке.'''
+        # pylint: disable=redefined-builtin
+        due = datetime(2019, 7, 1, tzinfo=timezone.utc)
+        async with UnitOfWork():
+            first = Milestone('first', due)
+            second = Milestone('second', due, first)
+        seen = []
+
+        def transform(document):
+            seen.append(document['previous'])
+            document['title'] = document['title'].upper()
+            return document
+
+        path = str(tmp_path / 'milestones.{}'.format(format))
+        query = {'_id': second.id}
+        assert await Milestone.export(path, query, format,
+                                      transform=transform) == 1
+        await Milestone.get_collection().delete_many(query)
+        assert await Milestone.import_from(path, format,
+                                           transform=transform) == 1
+        assert all(isinstance(x, LazyRef) for x in seen)
+        assert [x.id for x in seen] == [first.id, first.id]
+
+        async with UnitOfWork():
+            loaded = await Milestone.find_one(query)
+            assert loaded.title == 'SECOND'
+            assert (await loaded.previous.resolve()).id == first.id
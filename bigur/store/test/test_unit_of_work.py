@@ -9,10 +9,12 @@ __licence__ = 'For license information see LICENSE'
 
 from typing import Optional
 
-from pytest import mark
+from pymongo.read_preferences import ReadPreference
+from pytest import fixture, mark, raises
 
-from bigur.store.document import Embedded, Stored
-from bigur.store.unit_of_work import UnitOfWork, context
+from bigur.store.document import (Accumulator, Counter, Embedded, Maximum,
+                                  Minimum, Stored)
+from bigur.store.unit_of_work import IngestionProfile, UnitOfWork, context
 
 
 class Flat(Embedded):
@@ -50,6 +52,69 @@ class Address(Stored):
         return 'Address({})'.format(id(self))
 
 
+class Record(Stored):
+    '''Запись, получаемая из внешней системы.'''
+
+    __metadata__ = {
+        'create_only': ['created'],
+    }
+
+    def __init__(self, code: str, name: str, created: str) -> None:
+        self.name: str = name
+        self.created: str = created
+        super().__post_init__(code)
+
+
+class Page(Stored):
+    '''Страница со счётчиком просмотров.'''
+
+    __metadata__ = {
+        'accumulators': {
+            'views': Counter,
+            'fastest': Minimum,
+            'slowest': Maximum,
+        }
+    }
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        self.views: Counter = Counter()
+        self.fastest: Minimum = Minimum()
+        self.slowest: Maximum = Maximum()
+        super().__init__()
+
+
+class Report(Stored):
+    '''Отчёт, читаемый со вторичных узлов.'''
+
+    __metadata__ = {
+        'read_preference': 'secondaryPreferred',
+    }
+
+    def __init__(self, title: str, source: Optional['Report'] = None
+                 ) -> None:
+        self.title: str = title
+        self.source: Optional[Report] = source
+        super().__init__()
+
+
+@fixture
+def reads(monkeypatch):
+    '''Запоминает настройку чтения и сессию запросов `find_one`.'''
+    # pylint: disable=import-outside-toplevel
+    from bigur.store.memory import MemoryCollection
+    calls = []
+    find_one = MemoryCollection.find_one
+
+    async def spy(self, *args, **kwargs):
+        calls.append((self.read_preference,
+                      self.read_options(dict(kwargs)).get('session')))
+        return await find_one(self, *args, **kwargs)
+
+    monkeypatch.setattr(MemoryCollection, 'find_one', spy)
+    return calls
+
+
 class TestUnitOfWork:
     '''Тесты единицы работы.'''
 
@@ -211,3 +276,435 @@ class TestUnitOfWork:
 
         state = address.__getstate__()
         assert 'house' not in state
+
+    @mark.asyncio
+    async def test_n_plus_one(self, caplog):
+        '''Предупреждение о повторяющихся запросах к одной коллекции.'''
+        async with UnitOfWork(detect_n_plus_one=3) as uow:
+            uow.track_lookup('address')
+            uow.track_lookup('address')
+            uow.track_lookup('house')
+            assert 'N+1' not in caplog.text
+            uow.track_lookup('address')
+            assert 'N+1' in caplog.text
+
+    @mark.db_configured  # noqa: F811
+    @mark.asyncio
+    async def test_stats(self, database):
+        '''Статистика операций единицы работы.'''
+        async with UnitOfWork() as uow:
+            address = Address('Тверская')
+
+        assert uow.stats.new == 1
+        assert uow.stats.bytes_serialized == 0
+        assert uow.stats.round_trips[('address', 'insert_one')] == 1
+
+        async with UnitOfWork(measure_bytes=True) as uow:
+            address = Address('Тверская')
+
+        assert uow.stats.bytes_serialized > 0
+        assert uow.stats.round_trips[('address', 'insert_one')] == 1
+
+        async with UnitOfWork() as uow:
+            await Address.find_one({'_id': address.id})
+
+        assert uow.stats.loaded == 1
+        assert uow.stats.total_round_trips == 1
+
+    @mark.db_configured  # noqa: F811
+    @mark.asyncio
+    async def test_ingestion(self, database):
+        '''Пакетная вставка с профилем и сбором дубликатов.'''
+        async with UnitOfWork():
+            first = Address('Тверская')
+
+        profile = IngestionProfile(write_concern={'w': 1, 'j': False})
+        async with UnitOfWork(ingestion=profile) as uow:
+            duplicate = object.__new__(Address)
+            duplicate.__setstate__({'_id': first.id, 'street': 'Тверская'})
+            uow.register_new(duplicate)
+            second = Address('Никольская')
+
+        assert uow.duplicates == [duplicate]
+        assert uow.stats.round_trips[('address', 'insert_many')] == 1
+        document = await Address.find_one({'_id': second.id})
+        assert document.street == 'Никольская'
+
+        assert IngestionProfile(bypass_document_validation=True).acknowledged
+        with raises(ValueError):
+            IngestionProfile(write_concern={'w': 0},
+                             bypass_document_validation=True)
+
+    @mark.db_configured  # noqa: F811
+    @mark.asyncio
+    async def test_aggregate(self, database):
+        '''Агрегация с подгрузкой ссылок на сервере.'''
+        async with UnitOfWork():
+            owner = Address('Тверская')
+            address = Address('Никольская')
+            address.owner = owner
+
+        pipeline = [{'$match': {'_id': address.id}}]
+        pipeline.extend(Address.lookup('owner', Address))
+        result = [x async for x in Address.aggregate(pipeline)]
+        assert len(result) == 1
+        assert isinstance(result[0], Address)
+        assert result[0].owner.obj.street == 'Тверская'
+
+        rows = Address.aggregate([{
+            '$match': {'_id': {'$in': [owner.id, address.id]}}
+        }, {
+            '$group': {'_id': None, 'count': {'$sum': 1}}
+        }])
+        assert await rows.to_list(None) == [{'_id': None, 'count': 2}]
+
+    @mark.db_configured  # noqa: F811
+    @mark.asyncio
+    async def test_nested_scope(self, database):
+        '''Вложенная единица работы с откатом к точке сохранения.'''
+        async with UnitOfWork() as outer:
+            kept = Address('Тверская')
+
+            async with UnitOfWork() as inner:
+                assert inner.nested
+                assert inner.parent is outer
+                merged = Address('Никольская')
+                kept.street = 'Арбат'
+                assert list(inner._new) == [merged.id]
+            assert list(outer._new) == [kept.id, merged.id]
+            assert context.get() is outer
+
+            try:
+                async with UnitOfWork():
+                    dropped = Address('Ильинка')
+                    raise RuntimeError()
+            except RuntimeError:
+                pass
+            assert dropped.id not in outer._new
+
+            async with UnitOfWork(nested=False) as separate:
+                assert not separate.nested
+                own = Address('Варварка')
+
+            assert outer.stats.total_round_trips == 0
+
+        assert outer.stats.new == 2
+        assert outer.stats.total_round_trips == 2
+        assert (await Address.find_one({'_id': kept.id})).street == 'Арбат'
+        assert await Address.find_one({'_id': merged.id}) is not None
+        assert await Address.find_one({'_id': dropped.id}) is None
+        assert await Address.find_one({'_id': own.id}) is not None
+
+    @mark.db_configured  # noqa: F811
+    @mark.asyncio
+    async def test_nested_rollback(self, database):
+        '''Откат вложенной единицы работы восстанавливает документы
+        внешней.'''
+        async with UnitOfWork():
+            loaded = Address('Покровка', House(3, Flat(7)))
+
+        async with UnitOfWork():
+            created = Address('Тверская')
+            changed = await Address.find_one({'_id': loaded.id})
+            changed.street = 'Маросейка'
+            try:
+                async with UnitOfWork():
+                    created.street = 'Арбат'
+                    changed.street = 'Ильинка'
+                    changed.house.flat.number = 8
+                    raise RuntimeError()
+            except RuntimeError:
+                pass
+            assert created.street == 'Тверская'
+            assert changed.street == 'Маросейка'
+            assert changed.house.flat.number == 7
+            assert changed.house.flat.__node_parent__ is changed.house
+
+        found = await Address.find_one({'_id': created.id})
+        assert found.street == 'Тверская'
+        found = await Address.find_one({'_id': loaded.id})
+        assert found.street == 'Маросейка'
+        assert found.house.flat.number == 7
+
+    @mark.db_configured  # noqa: F811
+    @mark.asyncio
+    async def test_nested_rollback_references(self, database):
+        '''Ссылки на документы сохраняются при откате вложенной единицы
+        работы, состояние сохраняется только у изменённых документов.'''
+        async with UnitOfWork():
+            source = Report('Источник')
+            report = Report('Сводка', source)
+            report.related = {'sources': [source]}
+            try:
+                async with UnitOfWork() as inner:
+                    report.title = 'Черновик'
+                    report.source = None
+                    report.related['sources'].append(report)
+                    assert list(inner._savepoint) == [report.id]
+                    raise RuntimeError()
+            except RuntimeError:
+                pass
+            assert report.title == 'Сводка'
+            assert report.source is source
+            assert len(report.related['sources']) == 1
+            assert report.related['sources'][0] is source
+
+        found = await Report.find_one({'_id': report.id})
+        assert found.title == 'Сводка'
+        assert found.source.id == source.id
+
+    @mark.db_configured  # noqa: F811
+    @mark.asyncio
+    async def test_upsert(self, database):
+        '''Вставка или замена документов без чтения.'''
+        async with UnitOfWork():
+            Record('a', 'Первая', 'day 1')
+
+        async with UnitOfWork() as uow:
+            first = Record('a', 'Первая запись', 'day 2')
+            second = Record('b', 'Вторая', 'day 2')
+            await first.merge()
+            await second.merge()
+            second.name = 'Вторая запись'
+            assert list(uow._new) == []
+            assert list(uow._dirty) == []
+            assert list(uow._upserted) == ['a', 'b']
+
+        assert uow.stats.upserted == 2
+        assert uow.stats.total_round_trips == 1
+
+        first = await Record.find_one({'_id': 'a'})
+        assert first.name == 'Первая запись'
+        assert first.created == 'day 1'
+        second = await Record.find_one({'_id': 'b'})
+        assert second.name == 'Вторая запись'
+        assert second.created == 'day 2'
+
+    @mark.db_configured  # noqa: F811
+    @mark.asyncio
+    async def test_set_operations(self, database):
+        '''Обновление и удаление документов по запросу.'''
+        async with UnitOfWork():
+            for street in ('Тверская', 'Тверская', 'Арбат'):
+                Address(street)
+            Record('c', 'Старая', 'day 1')
+
+        async with UnitOfWork() as uow:
+            Address('Тверская')
+            renamed = await Address.update_where(
+                {'street': 'Тверская'}, {'$set': {'street': 'Новая'}})
+            removed = await Record.delete_where({'name': 'Старая'})
+            assert not renamed.done
+            assert await Address.find_one({'street': 'Новая'}) is None
+
+        assert uow.stats.set_operations == 2
+        assert renamed.done
+        assert renamed.matched_count == 3
+        assert renamed.modified_count == 3
+        assert removed.deleted_count == 1
+        assert await Record.find_one({'_id': 'c'}) is None
+
+        result = await Address.delete_where({'street': 'Новая'})
+        assert result.done
+        assert result.deleted_count == 3
+        with raises(ValueError):
+            await Address.update_where({}, {'street': 'Новая'})
+        with raises(ValueError):
+            await Address.update_where({}, [{'$set': {'street': 'Новая'}}])
+
+    @mark.db_configured
+    @mark.asyncio
+    async def test_operation_order(self, database):
+        '''Операции над множествами выполняются в порядке постановки в
+        очередь вместе с изменениями документов.'''
+        async with UnitOfWork():
+            before = Address('Временная')
+            await Address.delete_where({'street': 'Временная'})
+            after = Address('Временная')
+            async with UnitOfWork():
+                await Address.update_where({'street': 'Временная'},
+                                           {'$set': {'house': None}})
+                after.street = 'Постоянная'
+                nested = Address('Временная')
+
+        assert await Address.find_one({'_id': before.id}) is None
+        found = await Address.find_one({'_id': after.id})
+        assert found.street == 'Постоянная'
+        assert await Address.find_one({'_id': nested.id}) is not None
+        await Address.delete_where({'street': {'$in': ['Временная',
+                                                       'Постоянная']}})
+
+    @mark.db_configured
+    @mark.asyncio
+    async def test_accumulators(self, database):
+        '''Накопительные поля сохраняются операторами обновления.'''
+        async with UnitOfWork():
+            page = Page('/')
+            page.views += 1
+            page.fastest.record(40)
+            page.slowest.record(40)
+
+        async with UnitOfWork():
+            first = await Page.find_one({'_id': page.id})
+        async with UnitOfWork():
+            second = await Page.find_one({'_id': page.id})
+        assert first.views == 1
+
+        async with UnitOfWork():
+            second.views.add()
+            second.fastest.record(35)
+            second.slowest.record(60)
+
+        async with UnitOfWork():
+            first.views += 2
+            first.views += 3
+            first.fastest.record(30)
+            first.slowest.record(50)
+            first.path = '/index'
+            query = Page.get_update(first.__getstate__(), {'views', 'path'},
+                                    {'$inc': {'views': 5}})
+            assert query == {'$set': {'path': '/index'},
+                             '$inc': {'views': 5}}
+
+        async with UnitOfWork():
+            loaded = await Page.find_one({'_id': page.id})
+            assert loaded.path == '/index'
+            assert loaded.views == 7
+            assert isinstance(loaded.views, Counter)
+            assert loaded.fastest == 30
+            assert loaded.slowest == 60
+            loaded.views = Counter(100)
+
+        async with UnitOfWork():
+            loaded = await Page.find_one({'_id': page.id})
+            assert loaded.views == 100
+
+    def test_accumulator_values(self):
+        '''Накопительные поля сравниваются и участвуют в арифметике как
+        числа.'''
+        views = Counter(2)
+        assert views + 1 == 3 and 1 + views == 3
+        assert views - 1 == 1 and 10 - views == 8
+        assert views * 2 == 4 and views / 2 == 1
+        assert isinstance(views + 1, int)
+        assert views > 0 and views >= 2 and views < 3 and views <= 2
+        assert ['a', 'b', 'c'][views] == 'c'
+        assert not Counter() and views
+        assert '{:03d}'.format(views) == '002' and str(views) == '2'
+        assert Minimum(5) < Maximum(7)
+        latest = Accumulator('a')
+        latest.record('b')
+        latest.record('c')
+        assert latest.value == 'c' and latest.pending == 'c'
+        assert views.value == 2 and views.pending is None
+
+    @mark.db_configured
+    @mark.asyncio
+    async def test_accumulator_failure(self, database, monkeypatch):
+        '''Накопленные изменения сохраняются после ошибки записи и
+        сбрасываются после вставки или замены.'''
+        async with UnitOfWork():
+            page = Page('/failure')
+
+        async def fail(self, *args, **kwargs):
+            raise RuntimeError()
+
+        collection = type(Page.get_collection())
+        update_one = collection.update_one
+        monkeypatch.setattr(collection, 'update_one', fail)
+        with raises(RuntimeError):
+            async with UnitOfWork():
+                page.views += 2
+        monkeypatch.setattr(collection, 'update_one', update_one)
+
+        async with UnitOfWork():
+            page.views += 1
+        assert (await Page.find_one({'_id': page.id})).views == 3
+
+        async with UnitOfWork():
+            page.views += 4
+            await page.merge()
+        async with UnitOfWork():
+            page.views += 1
+        assert (await Page.find_one({'_id': page.id})).views == 8
+
+    @mark.db_configured
+    @mark.asyncio
+    async def test_accumulator_rollback(self, database):
+        '''Откат единицы работы отменяет накопленные изменения.'''
+        async with UnitOfWork():
+            page = Page('/rollback')
+
+        with raises(RuntimeError):
+            async with UnitOfWork():
+                page.views += 5
+                raise RuntimeError()
+        assert page.views == 0
+
+        async with UnitOfWork():
+            page.views += 1
+            with raises(RuntimeError):
+                async with UnitOfWork():
+                    page.views += 5
+                    raise RuntimeError()
+            assert page.views == 1
+
+        async with UnitOfWork():
+            page.path = '/rolled-back'
+            query = Page.get_update(page.__getstate__(), {'path'},
+                                    Page.get_operators(page, {'path'}))
+            assert query == {'$set': {'path': '/rolled-back'}}
+
+        loaded = await Page.find_one({'_id': page.id})
+        assert loaded.views == 1
+        assert loaded.path == '/rolled-back'
+
+    @mark.db_configured
+    @mark.asyncio
+    async def test_read_preference(self, database, reads):
+        '''Настройка чтения: вызов, затем единица работы, затем класс.'''
+        async with UnitOfWork():
+            source = Report('Источник')
+            report = Report('Сводка', source)
+
+        async with UnitOfWork():
+            loaded = await Report.find_one({'_id': report.id})
+            await loaded.source.resolve()
+            await Report.find_one({'_id': report.id}, 'primary')
+
+        async with UnitOfWork(read_preference='nearest'):
+            loaded = await Report.find_one({'_id': report.id})
+            await loaded.source.resolve()
+            loaded = await Report.find_one({'_id': report.id}, 'primary')
+            await loaded.source.resolve(read_preference='secondary')
+
+        assert [x[0] for x in reads] == [
+            ReadPreference.SECONDARY_PREFERRED,
+            ReadPreference.SECONDARY_PREFERRED,
+            ReadPreference.PRIMARY,
+            ReadPreference.NEAREST,
+            ReadPreference.NEAREST,
+            ReadPreference.PRIMARY,
+            ReadPreference.SECONDARY,
+        ]
+
+    @mark.db_configured
+    @mark.asyncio
+    async def test_causal_session(self, database, reads):
+        '''Чтение после явного сохранения идёт в сессии записи.'''
+        async with UnitOfWork() as uow:
+            await Report.find_one({'title': 'Сводка'})
+            report = Report('Сводка')
+            await uow.commit()
+            session = uow.get_session(database.client)
+            assert session is not None
+
+            loaded = await Report.find_one({'_id': report.id})
+            assert loaded.title == 'Сводка'
+            loaded.title = 'Итог'
+            await uow.commit()
+            assert uow.get_session(database.client) is session
+            await Report.find_one({'_id': report.id})
+
+        assert uow.get_session(database.client) is None
+        assert [x[1] for x in reads] == [None, session, session]
@@ -0,0 +1,97 @@
+'''Тестирование отложенной записи.'''
+
+__author__ = 'Gennady Kovalev <gik@bigur.ru>'
+__copyright__ = '(c) 2016-2019 Development management business group'
+__licence__ = 'For license information see LICENSE'
+
+from types import SimpleNamespace
+
+from pytest import mark
+
+from bigur.store import Stored, UnitOfWork
+from bigur.store.write_behind import WriteBehindQueue, shutdown
+
+journal = WriteBehindQueue(batch_size=100, interval=60)
+
+
+class Entry(Stored):
+    '''Запись журнала, сохраняемая через очередь.'''
+
+    __metadata__ = {
+        'write_behind': journal,
+    }
+
+    def __init__(self, text: str) -> None:
+        self.text: str = text
+        super().__init__()
+
+
+class FakeCollection:
+    '''Коллекция, запоминающая пакеты операций.'''
+
+    def __init__(self, fail: bool = False) -> None:
+        self.name = 'events'
+        self.database = SimpleNamespace(name='test')
+        self.batches = []
+        self.fail = fail
+
+    async def bulk_write(self, operations, ordered=True):
+        if self.fail:
+            raise RuntimeError('failed')
+        self.batches.append(list(operations))
+
+
+class TestWriteBehindQueue:
+    '''Тесты очереди отложенной записи.'''
+
+    @mark.asyncio
+    async def test_flush_by_size(self):
+        '''Запись пакета при заполнении.'''
+        collection = FakeCollection()
+        queue = WriteBehindQueue(batch_size=2, interval=60, max_size=4)
+        await queue.put(collection, 1)
+        await queue.put(collection, 2)
+        await queue.put(collection, 3)
+        await queue.close()
+        assert collection.batches[0] == [1, 2]
+        assert sum(len(x) for x in collection.batches) == 3
+        assert len(queue) == 0
+
+    @mark.asyncio
+    async def test_error_callback(self):
+        '''Передача неудавшихся операций обработчику ошибок.'''
+        failed = []
+        collection = FakeCollection(fail=True)
+        queue = WriteBehindQueue(
+            batch_size=10,
+            interval=60,
+            on_error=lambda exc, coll, ops: failed.extend(ops))
+        await queue.put(collection, 1)
+        await queue.close()
+        assert failed == [1]
+
+    @mark.asyncio
+    @mark.db_configured
+    async def test_unit_of_work(self, database):
+        '''Запись изменений единицы работы через очередь.'''
+        collection = Entry.get_collection()
+        async with UnitOfWork():
+            first = Entry('first')
+            second = Entry('second')
+        assert len(journal) == 2
+        assert await collection.count_documents({}) == 0
+
+        await shutdown()
+        assert len(journal) == 0
+        assert await collection.count_documents({}) == 2
+
+        async with UnitOfWork():
+            first = await Entry.find_one({'_id': first.id})
+            first.text = 'changed'
+            await (await Entry.find_one({'_id': second.id})).remove()
+        assert len(journal) == 2
+        assert (await Entry.find_one({'_id': first.id})).text == 'first'
+
+        await shutdown()
+        assert (await Entry.find_one({'_id': first.id})).text == 'changed'
+        assert await Entry.find_one({'_id': second.id}) is None
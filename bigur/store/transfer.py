@@ -0,0 +1,225 @@
+'''Потоковая выгрузка и загрузка коллекций.'''
+
+__author__ = 'Gennady Kovalev <gik@bigur.ru>'
+__copyright__ = '(c) 2016-2019 Development management business group'
+__licence__ = 'For license information see LICENSE'
+
+import bz2
+import gzip
+import lzma
+from mmap import ACCESS_READ, mmap
+from logging import getLogger
+from struct import unpack_from
+from typing import (IO, Any, Callable, Dict, Iterator, List, Optional,
+                    Union)
+
+from bson import decode, decode_all, encode
+from bson.json_util import RELAXED_JSON_OPTIONS, dumps, loads
+from bson.raw_bson import RawBSONDocument
+
+logger = getLogger(__name__)
+
+Transform = Callable[[Dict[str, Any]], Optional[Dict[str, Any]]]
+
+FORMATS = ('bson', 'ndjson')
+
+OPENERS = {
+    None: open,
+    'gzip': gzip.open,
+    'bz2': bz2.open,
+    'xz': lzma.open,
+}
+
+EXTENSIONS = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.xz': 'xz',
+}
+
+
+def guess_compression(path: str) -> Optional[str]:
+    '''Определяет сжатие файла по расширению.'''
+    for extension, compression in EXTENSIONS.items():
+        if path.endswith(extension):
+            return compression
+    return None
+
+
+def open_file(path: str, mode: str,
+              compression: Optional[str] = None) -> IO[bytes]:
+    '''Открывает файл выгрузки в двоичном режиме с учётом сжатия.'''
+    try:
+        opener = OPENERS[compression]
+    except KeyError:
+        raise ValueError('Unknown compression {}'.format(compression))
+    return opener(path, mode + 'b')
+
+
+def iter_bson(stream: IO[bytes]) -> Iterator[bytes]:
+    '''Читает документы BSON из потока по одному, не разбирая их.'''
+    while True:
+        header = stream.read(4)
+        if not header:
+            break
+        if len(header) < 4:
+            raise ValueError('Truncated BSON stream')
+        size = unpack_from('<i', header)[0]
+        body = stream.read(size - 4)
+        if len(body) < size - 4:
+            raise ValueError('Truncated BSON stream')
+        yield header + body
+
+
+def iter_bson_mmap(path: str) -> Iterator[bytes]:
+    '''Читает документы BSON из файла, отображённого в память.'''
+    with open(path, 'rb') as stream:
+        try:
+            data = mmap(stream.fileno(), 0, access=ACCESS_READ)
+        except ValueError:
+            # Empty files can not be mapped
+            return
+        with data:
+            offset = 0
+            end = len(data)
+            while offset < end:
+                size = unpack_from('<i', data, offset)[0]
+                if offset + size > end:
+                    raise ValueError('Truncated BSON stream')
+                yield data[offset:offset + size]
+                offset += size
+
+
+def iter_ndjson(stream: IO[bytes]) -> Iterator[bytes]:
+    '''Читает документы из потока NDJSON и возвращает их в BSON.'''
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield encode(loads(line.decode('utf-8')))
+
+
+async def export(collection: Any,
+                 stream: IO[bytes],
+                 query: Optional[Dict[str, Any]] = None,
+                 format: str = 'bson',  # pylint: disable=W0622
+                 transform: Optional[Transform] = None,
+                 batch_size: int = 1000) -> int:
+    '''Выгружает документы коллекции в поток и возвращает их количество.
+
+    Если преобразование `transform` не указано и формат `bson`, то пакеты
+    документов записываются в поток в том виде, в котором пришли с
+    сервера, без создания объектов python. Преобразование получает
+    документы, декодированные с настройками кодирования коллекции.'''
+    if format not in FORMATS:
+        raise ValueError('Unknown format {}'.format(format))
+
+    codec_options = collection.codec_options
+    count = 0
+    cursor = collection.find_raw_batches(query or {}, batch_size=batch_size)
+    async for batch in cursor:
+        if format == 'bson' and transform is None:
+            stream.write(batch)
+            count += _count_bson(batch)
+            continue
+        if transform is None:
+            documents = decode_all(batch)
+        else:
+            documents = [transform(x) for x in
+                         decode_all(batch, codec_options)]
+        for document in documents:
+            if document is None:
+                continue
+            if transform is not None:
+                data = encode(document, codec_options=codec_options)
+                if format == 'ndjson':
+                    # Extended JSON knows only BSON types
+                    document = decode(data)
+            if format == 'bson':
+                stream.write(data)
+            else:
+                stream.write(dumps(document,
+                                   json_options=RELAXED_JSON_OPTIONS)
+                             .encode('utf-8'))
+                stream.write(b'\n')
+            count += 1
+    logger.debug('Exported %d documents from %s', count, collection.name)
+    return count
+
+
+async def load(collection: Any,
+               source: Union[str, IO[bytes]],
+               format: str = 'bson',  # pylint: disable=W0622
+               compression: Optional[str] = None,
+               transform: Optional[Transform] = None,
+               upsert: bool = False,
+               batch_size: int = 1000) -> int:
+    '''Загружает документы в коллекцию из файла или потока и возвращает
+    их количество.
+
+    Документы отправляются пакетами по `batch_size` через `insert_many`
+    или, если указан `upsert`, через `bulk_write` с `ReplaceOne`. Без
+    преобразования `transform` документы передаются серверу в исходном
+    виде BSON, иначе декодируются и кодируются с настройками кодирования
+    коллекции. Несжатые файлы BSON читаются через отображение в память.'''
+    if format not in FORMATS:
+        raise ValueError('Unknown format {}'.format(format))
+
+    codec_options = collection.codec_options
+    stream: Optional[IO[bytes]] = None
+    if isinstance(source, str):
+        if compression is None:
+            compression = guess_compression(source)
+        if format == 'bson' and compression is None:
+            documents = iter_bson_mmap(source)
+        else:
+            stream = open_file(source, 'r', compression)
+    else:
+        stream = source
+
+    if stream is not None:
+        if format == 'bson':
+            documents = iter_bson(stream)
+        else:
+            documents = iter_ndjson(stream)
+
+    count = 0
+    batch: List[Any] = []
+    try:
+        for data in documents:
+            if transform is not None:
+                document = transform(decode(data, codec_options))
+                if document is None:
+                    continue
+                data = encode(document, codec_options=codec_options)
+            batch.append(RawBSONDocument(bytes(data)))
+            if len(batch) >= batch_size:
+                count += await _write(collection, batch, upsert)
+                batch = []
+        if batch:
+            count += await _write(collection, batch, upsert)
+    finally:
+        if stream is not None and stream is not source:
+            stream.close()
+
+    logger.debug('Imported %d documents into %s', count, collection.name)
+    return count
+
+
+async def _write(collection: Any, batch: List[RawBSONDocument],
+                 upsert: bool) -> int:
+    if upsert:
+        from pymongo import ReplaceOne  # pylint: disable=C0415
+        await collection.bulk_write([
+            ReplaceOne({'_id': x['_id']}, x, upsert=True) for x in batch
+        ], ordered=False)
+    else:
+        await collection.insert_many(batch, ordered=False)
+    return len(batch)
+
+
+def _count_bson(batch: bytes) -> int:
+    count = 0
+    offset = 0
+    while offset < len(batch):
+        offset += unpack_from('<i', batch, offset)[0]
+        count += 1
+    return count
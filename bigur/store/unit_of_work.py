@@ -4,8 +4,11 @@ __author__ = 'Gennady Kovalev <gik@bigur.ru>'
 __copyright__ = '(c) 2016-2018 Business group for development management'
 __licence__ = 'For license information see LICENSE'
 
+from collections import Counter
+from dataclasses import dataclass, field
 from logging import getLogger
-from typing import Dict, Union, Tuple, Set
+from time import perf_counter
+from typing import Any, Dict, List, Union, Tuple, Set, Optional
 from contextvars import ContextVar, Token  # pylint: disable=E0401
 
 from bson import ObjectId
@@ -17,18 +20,201 @@ logger = getLogger(__name__)
 context: ContextVar = ContextVar('uow', default=None)
 
 
+@dataclass
+class Statistics:
+    '''Статистика операций, выполненных единицей работы.'''
+
+    loaded: int = 0
+    new: int = 0
+    dirty: int = 0
+    upserted: int = 0
+    removed: int = 0
+    set_operations: int = 0
+    bytes_serialized: int = 0
+    commit_time: float = 0.0
+    round_trips: Counter = field(default_factory=Counter)
+    bytes_uncompressed: int = 0
+    bytes_compressed: int = 0
+    compress_time: float = 0.0
+    decompress_time: float = 0.0
+
+    def add_round_trip(self, collection: str, operation: str) -> None:
+        '''Учитывает обращение к серверу.'''
+        self.round_trips[(collection, operation)] += 1
+
+    @property
+    def total_round_trips(self) -> int:
+        '''Общее число обращений к серверу.'''
+        return sum(self.round_trips.values())
+
+    @property
+    def compression_ratio(self) -> float:
+        '''Отношение исходного размера сжатых полей к сжатому.'''
+        if not self.bytes_compressed:
+            return 1.0
+        return self.bytes_uncompressed / self.bytes_compressed
+
+
+@dataclass
+class IngestionProfile:
+    '''Параметры быстрой вставки новых документов.
+
+    `write_concern` передаётся в :class:`~pymongo.write_concern.WriteConcern`,
+    например `{'w': 1, 'j': False}` или `{'w': 0}` для записи без
+    подтверждения. Документы вставляются одним запросом `insert_many`.
+    Проверка документов (`bypass_document_validation`) отключается только
+    при записи с подтверждением: сервер не позволяет сочетать её с
+    `{'w': 0}`.'''
+
+    write_concern: Optional[Dict[str, Any]] = None
+    ordered: bool = False
+    bypass_document_validation: bool = False
+
+    def __post_init__(self) -> None:
+        if self.bypass_document_validation and not self.acknowledged:
+            raise ValueError('Cannot bypass document validation with '
+                             'unacknowledged write concern')
+
+    @property
+    def acknowledged(self) -> bool:
+        '''Подтверждается ли запись сервером.'''
+        return (self.write_concern or {}).get('w') != 0
+
+
+@dataclass
+class SetOperation:
+    '''Обновление или удаление всех документов класса `cls`,
+    удовлетворяющих запросу `query`, без загрузки документов. После
+    выполнения содержит число найденных, изменённых и удалённых
+    документов.'''
+
+    cls: type
+    query: Dict[str, Any]
+    update: Optional[Dict[str, Any]] = None
+    done: bool = False
+    matched_count: int = 0
+    modified_count: int = 0
+    deleted_count: int = 0
+
+    async def execute(self) -> 'SetOperation':
+        '''Выполняет операцию через `update_many` или `delete_many`.'''
+        collection = self.cls.get_collection()
+        if self.update is not None:
+            result = await collection.update_many(self.query, self.update)
+            self.matched_count = result.matched_count
+            self.modified_count = result.modified_count
+        else:
+            result = await collection.delete_many(self.query)
+            self.deleted_count = result.deleted_count
+        self.done = True
+        return self
+
+
 class UnitOfWork(object):
-    '''Единица работы. Определение логической транзакции БД.'''
+    '''Единица работы. Определение логической транзакции БД.
+
+    Если указан `detect_n_plus_one`, то при достижении указанного числа
+    запросов одного объекта по коллекции в рамках единицы работы в журнал
+    выводится предупреждение со стеком вызовов. С `measure_bytes`
+    размер записываемых документов учитывается в
+    :attr:`Statistics.bytes_serialized`, для этого каждый документ
+    кодируется в BSON ещё раз, поэтому по умолчанию размер не считается.
+
+    `read_preference` задаёт настройку чтения (например, `'secondary'`
+    или `'nearest'`) для запросов, выполняемых внутри единицы работы.
+    После первой записи чтение идёт через причинно-согласованную сессию,
+    поэтому запросы видят записанные изменения и на вторичных узлах.
+
+    `ingestion` задаёт :class:`IngestionProfile` для вставки новых
+    документов всех классов, иначе используется
+    `__metadata__['ingestion']` класса. Документы, не вставленные из-за
+    дубликата ключа, собираются в :attr:`duplicates`.
 
-    def __init__(self) -> None:
+    Единица работы, открытая внутри другой, по умолчанию становится
+    вложенной: при успешном выходе её изменения переносятся в
+    родительскую, а при ошибке отменяются только они, как при откате к
+    точке сохранения. Перед первым изменением документа во вложенной
+    единице работы сохраняется его состояние, и при откате оно
+    восстанавливается. В базу данных изменения записывает
+    внешняя единица работы одним сохранением. Вложенная единица работы
+    использует сессии, статистику и настройки родительской, если свои не
+    заданы. С `nested=False` единица работы сохраняет изменения
+    самостоятельно.'''
+
+    def __init__(self,
+                 detect_n_plus_one: Optional[int] = None,
+                 read_preference: Any = None,
+                 ingestion: Optional[IngestionProfile] = None,
+                 nested: bool = True,
+                 measure_bytes: bool = False) -> None:
         self._token: Union[Token, None] = None
+        self._nested: bool = nested
+        self.parent: Optional['UnitOfWork'] = None
+
+        self.ingestion: Optional[IngestionProfile] = ingestion
+        self.duplicates: List[Document] = []
+
+        self.read_preference: Any = read_preference
+        self._sessions: Dict[int, Any] = {}
 
         self._new: Dict[ObjectId, Document] = {}
         self._dirty: Dict[ObjectId, Tuple[Document, Set[str]]] = {}
+        self._upserted: Dict[ObjectId, Document] = {}
         self._removed: Dict[ObjectId, Document] = {}
+        self._operations: List[Tuple[Dict[ObjectId, Document],
+                                     Dict[ObjectId, Document],
+                                     Dict[ObjectId, Tuple[Document,
+                                                          Set[str]]],
+                                     Dict[ObjectId, Document],
+                                     SetOperation]] = []
+        self._savepoint: Dict[ObjectId,
+                              Tuple[Document, Dict[str, Any]]] = {}
+
+        self.stats: Statistics = Statistics()
+        self.measure_bytes: bool = measure_bytes
+
+        self._detect_n_plus_one: Optional[int] = detect_n_plus_one
+        self._lookups: Counter = Counter()
 
         super().__init__()
 
+    @property
+    def nested(self) -> bool:
+        '''Является ли единица работы вложенной.'''
+        return self.parent is not None
+
+    def attach(self, parent: 'UnitOfWork') -> None:
+        '''Делает единицу работы вложенной в `parent`.'''
+        self.parent = parent
+        if self.ingestion is None:
+            self.ingestion = parent.ingestion
+        if self.read_preference is None:
+            self.read_preference = parent.read_preference
+        if self._detect_n_plus_one is None:
+            self._detect_n_plus_one = parent._detect_n_plus_one
+        self.measure_bytes = self.measure_bytes or parent.measure_bytes
+        self._lookups = parent._lookups
+        self.stats = parent.stats
+        self.duplicates = parent.duplicates
+
+    def save_point(self, document: Document) -> None:
+        '''Сохраняет состояние документа перед его первым изменением во
+        вложенной единице работы для отката к точке сохранения.'''
+        if self.parent is not None and document.id not in self._savepoint:
+            self._savepoint[document.id] = (document, document.save_state())
+
+    # Диагностика
+    def track_lookup(self, collection: str) -> None:
+        '''Учитывает запрос одного объекта из коллекции для обнаружения
+        проблемы N+1 запросов.'''
+        if self._detect_n_plus_one is not None:
+            self._lookups[collection] += 1
+            if self._lookups[collection] == self._detect_n_plus_one:
+                logger.warning(
+                    'Possible N+1 query: %d lookups in collection %s '
+                    'inside one unit of work', self._lookups[collection],
+                    collection, stack_info=True)
+
     # Управление очередями
     def register_new(self, document: Document) -> None:
         '''Ставит документ в очередь для создания в БД.'''
@@ -51,13 +237,27 @@ class UnitOfWork(object):
             raise ValueError('Документ должен содержать ИД.')
         if id_ in self._removed:
             raise ValueError('Документ помечен на удаление.')
-        if id_ not in self._new:
+        if id_ not in self._new and id_ not in self._upserted:
             if id_ in self._dirty:
                 self._dirty[id_][1].update(keys)
             else:
                 self._dirty[id_] = (document, keys)
             logger.debug('Now dirty keys: %s', self._dirty[id_][1])
 
+    def register_upsert(self, document: Document) -> None:
+        '''Ставит документ в очередь для вставки или замены существующего
+        документа с тем же ИД. Последующие изменения документа входят в
+        эту же операцию.'''
+        logger.debug('Register document %s for upsert', document)
+        id_ = document.id
+        if id_ is None:
+            raise ValueError('Документ должен содержать ИД.')
+        if id_ in self._removed:
+            raise ValueError('Документ помечен на удаление.')
+        self._new.pop(id_, None)
+        self._dirty.pop(id_, None)
+        self._upserted[id_] = document
+
     def register_removed(self, document: Document) -> None:
         '''Ставит документ в очередь для удаления из БД.'''
         logger.debug('Mark document %s to remove')
@@ -67,46 +267,226 @@ class UnitOfWork(object):
         if id_ in self._new:
             del self._new[id_]
         else:
+            self._upserted.pop(id_, None)
             if id_ in self._dirty:
                 del self._dirty[id_]
             if id_ not in self._removed:
                 self._removed[id_] = document
 
+    def register_operation(self, operation: SetOperation) -> None:
+        '''Ставит операцию над множеством документов в очередь. Операции
+        выполняются в порядке постановки в очередь вместе с изменениями
+        отдельных документов: изменения, запланированные до операции,
+        записываются перед ней, а запланированные после — после неё.'''
+        logger.debug('Register set operation %s', operation)
+        self._operations.append((self._new, self._upserted, self._dirty,
+                                 self._removed, operation))
+        self._new = {}
+        self._upserted = {}
+        self._dirty = {}
+        self._removed = {}
+
+    # Сессии
+    def get_session(self, client: Any) -> Any:
+        '''Возвращает сессию для клиента, если она уже была открыта.'''
+        if self.parent is not None:
+            return self.parent.get_session(client)
+        return self._sessions.get(id(client))
+
+    async def start_session(self, client: Any) -> Any:
+        '''Возвращает причинно-согласованную сессию для клиента,
+        открывая её при необходимости.'''
+        if self.parent is not None:
+            return await self.parent.start_session(client)
+        session = self._sessions.get(id(client))
+        if session is None:
+            session = await client.start_session(causal_consistency=True)
+            self._sessions[id(client)] = session
+        return session
+
+    async def end_sessions(self) -> None:
+        '''Закрывает все сессии единицы работы.'''
+        sessions, self._sessions = self._sessions, {}
+        for session in sessions.values():
+            await session.end_session()
+
     # Сохранение изменений в БД
     async def insert_new(self) -> None:
         '''Создаёт новые документы в базе данных.'''
+        batches: Dict[type, List[Document]] = {}
         for document in self._new.values():
-            await type(document).insert_one(document)
+            cls = type(document)
+            queue = cls.__metadata__.get('write_behind')
+            if queue is not None:
+                await queue.put(cls.get_collection(),
+                                cls.insert_operation(document))
+                cls.reset_accumulators(document)
+            elif self.get_ingestion(cls) is not None:
+                batches.setdefault(cls, []).append(document)
+            else:
+                await cls.insert_one(document)
+        for cls, documents in batches.items():
+            self.duplicates.extend(
+                await cls.insert_many(documents, self.get_ingestion(cls)))
         self._new = {}
 
+    async def upsert_merged(self) -> None:
+        '''Вставляет или заменяет документы, отправляя по одному пакету
+        операций на класс.'''
+        batches: Dict[type, List[Document]] = {}
+        for document in self._upserted.values():
+            cls = type(document)
+            queue = cls.__metadata__.get('write_behind')
+            if queue is not None:
+                await queue.put(cls.get_collection(),
+                                cls.upsert_operation(document))
+                cls.reset_accumulators(document)
+            else:
+                batches.setdefault(cls, []).append(document)
+        for cls, documents in batches.items():
+            await cls.upsert_many(documents)
+        self._upserted = {}
+
+    async def execute_operations(self) -> None:
+        '''Выполняет операции над множествами документов, записывая перед
+        каждой изменения документов, запланированные до неё.'''
+        operations, self._operations = self._operations, []
+        queues = (self._new, self._upserted, self._dirty, self._removed)
+        try:
+            for new, upserted, dirty, removed, operation in operations:
+                self._new = new
+                self._upserted = upserted
+                self._dirty = dirty
+                self._removed = removed
+                await self.write_documents()
+                await operation.execute()
+        finally:
+            self._new, self._upserted, self._dirty, self._removed = queues
+
+    async def write_documents(self) -> None:
+        '''Записывает изменения отдельных документов.'''
+        await self.insert_new()
+        await self.upsert_merged()
+        await self.update_dirty()
+        await self.delete_removed()
+
+    def get_ingestion(self, cls: type) -> Optional[IngestionProfile]:
+        '''Возвращает профиль вставки документов класса `cls`.
+        Документы временных рядов всегда вставляются пакетами.'''
+        if self.ingestion is not None:
+            return self.ingestion
+        profile = cls.__metadata__.get('ingestion')
+        if profile is None and 'timeseries' in cls.__metadata__:
+            profile = IngestionProfile()
+        return profile
+
     async def update_dirty(self) -> None:
         '''Обновляет документы в базе данных.'''
         for document, keys in self._dirty.values():
-            await type(document).update_one(document, keys)
+            cls = type(document)
+            queue = cls.__metadata__.get('write_behind')
+            if queue is not None:
+                await queue.put(cls.get_collection(),
+                                cls.update_operation(document, keys))
+                cls.reset_accumulators(document)
+            else:
+                await cls.update_one(document, keys)
         self._dirty = {}
 
     async def delete_removed(self) -> None:
         '''Удаляет документы из базы данных.'''
         for document in self._removed.values():
-            await type(document).delete_one(document)
+            cls = type(document)
+            queue = cls.__metadata__.get('write_behind')
+            if queue is not None:
+                await queue.put(cls.get_collection(),
+                                cls.delete_operation(document))
+            else:
+                await cls.delete_one(document)
         self._removed = {}
 
     # Управление транзакцией
+    def merge(self) -> None:
+        '''Переносит изменения вложенной единицы работы в родительскую.'''
+        parent = self.parent
+        queues = self._operations + [(self._new, self._upserted,
+                                      self._dirty, self._removed, None)]
+        for new, upserted, dirty, removed, operation in queues:
+            for document in new.values():
+                parent.register_new(document)
+            for document in upserted.values():
+                parent.register_upsert(document)
+            for document, keys in dirty.values():
+                parent.register_dirty(document, keys)
+            for document in removed.values():
+                parent.register_removed(document)
+            if operation is not None:
+                parent.register_operation(operation)
+        self._new = {}
+        self._dirty = {}
+        self._upserted = {}
+        self._removed = {}
+        self._operations = []
+        if parent.parent is not None:
+            for id_, saved in self._savepoint.items():
+                parent._savepoint.setdefault(id_, saved)
+        self._savepoint = {}
+
     async def commit(self) -> None:
-        '''Сохраняет все запланированные изменения в БД.'''
-        await self.insert_new()
-        await self.update_dirty()
-        await self.delete_removed()
+        '''Сохраняет все запланированные изменения в БД. Изменения
+        документов классов с `__metadata__['write_behind']` ставятся в
+        очередь отложенной записи. Вложенная единица работы переносит
+        изменения в родительскую.'''
+        if self.parent is not None:
+            self.merge()
+            return
+
+        queues = self._operations + [(self._new, self._upserted,
+                                      self._dirty, self._removed, None)]
+        for new, upserted, dirty, removed, _ in queues:
+            self.stats.new += len(new)
+            self.stats.upserted += len(upserted)
+            self.stats.dirty += len(dirty)
+            self.stats.removed += len(removed)
+        self.stats.set_operations += len(self._operations)
+
+        started = perf_counter()
+        token = context.set(self)
+        try:
+            await self.execute_operations()
+            await self.write_documents()
+        finally:
+            context.reset(token)
+            self.stats.commit_time += perf_counter() - started
 
     async def rollback(self) -> None:
         '''Отменяет все изменения в текущей единице работы. Сами объекты
-        при этом не изменяются.'''
+        при этом не изменяются, кроме документов, изменённых во
+        вложенной единице работы: они возвращаются в состояние до её
+        начала. Незаписанные изменения накопительных полей документов
+        внешней единицы работы отменяются.'''
+        if self.parent is None:
+            queues = self._operations + [(self._new, self._upserted,
+                                          self._dirty, self._removed, None)]
+            for _, upserted, dirty, _, _ in queues:
+                for document in upserted.values():
+                    type(document).discard_accumulators(document)
+                for document, _ in dirty.values():
+                    type(document).discard_accumulators(document)
+        for document, state in self._savepoint.values():
+            document.restore_state(state)
         self._new = {}
         self._dirty = {}
+        self._upserted = {}
         self._removed = {}
+        self._operations = []
+        self._savepoint = {}
 
     # Поддержка контекста
     async def __aenter__(self):
+        parent = context.get()
+        if self._nested and parent is not None:
+            self.attach(parent)
         self._token = context.set(self)
         return self
 
@@ -114,7 +494,10 @@ class UnitOfWork(object):
         context.reset(self._token)
         self._token = None
 
-        if exc_type is not None:
-            await self.rollback()
-        else:
-            await self.commit()
+        try:
+            if exc_type is not None:
+                await self.rollback()
+            else:
+                await self.commit()
+        finally:
+            await self.end_sessions()
@@ -0,0 +1,134 @@
+'''Отложенная групповая запись.'''
+
+__author__ = 'Gennady Kovalev <gik@bigur.ru>'
+__copyright__ = '(c) 2016-2019 Development management business group'
+__licence__ = 'For license information see LICENSE'
+
+from asyncio import Event, Semaphore, Task, ensure_future, wait_for
+from asyncio import TimeoutError as WaitTimeoutError
+from contextvars import Context  # pylint: disable=E0401
+from logging import getLogger
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from weakref import WeakSet
+
+logger = getLogger(__name__)
+
+ErrorCallback = Callable[[Exception, Any, List[Any]], Any]
+
+queues: WeakSet = WeakSet()
+
+
+class WriteBehindQueue(object):
+    '''Очередь отложенной записи.
+
+    Операции, поставленные в очередь, группируются по коллекциям и
+    отправляются в базу данных через `bulk_write`, когда их набирается
+    `batch_size` или проходит `interval` секунд. Очередь хранит не более
+    `max_size` операций, при заполнении :meth:`put` ждёт освобождения
+    места. При ошибке записи вызываются обработчики `on_error` с
+    исключением, коллекцией и списком неудавшихся операций.
+
+    Чтобы класс использовал очередь, её нужно указать в
+    `__metadata__['write_behind']`.'''
+
+    def __init__(self,
+                 batch_size: int = 1000,
+                 interval: float = 1.0,
+                 max_size: int = 10000,
+                 on_error: Optional[ErrorCallback] = None) -> None:
+        if max_size < batch_size:
+            raise ValueError('max_size must not be less than batch_size')
+        self.batch_size: int = batch_size
+        self.interval: float = interval
+        self.max_size: int = max_size
+
+        self._callbacks: List[ErrorCallback] = []
+        if on_error is not None:
+            self._callbacks.append(on_error)
+
+        self._pending: Dict[str, Tuple[Any, List[Any]]] = {}
+        self._size: int = 0
+        self._slots: Optional[Semaphore] = None
+        self._wakeup: Optional[Event] = None
+        self._task: Optional[Task] = None
+
+        queues.add(self)
+
+        super().__init__()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add_error_callback(self, callback: ErrorCallback) -> None:
+        '''Добавляет обработчик ошибок записи.'''
+        self._callbacks.append(callback)
+
+    async def put(self, collection: Any, operation: Any) -> None:
+        '''Ставит операцию для коллекции `collection` в очередь.'''
+        if self._slots is None:
+            self._slots = Semaphore(self.max_size)
+            self._wakeup = Event()
+        await self._slots.acquire()
+
+        key = '{}.{}'.format(collection.database.name, collection.name)
+        if key not in self._pending:
+            self._pending[key] = (collection, [])
+        self._pending[key][1].append(operation)
+        self._size += 1
+
+        if self._task is None or self._task.done():
+            # Фоновая задача не должна наследовать единицу работы
+            self._task = Context().run(ensure_future, self._run())
+        if self._size >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        while self._size:
+            try:
+                await wait_for(self._wakeup.wait(), self.interval)
+            except WaitTimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        '''Отправляет все накопленные операции в базу данных.'''
+        pending, self._pending = self._pending, {}
+        for collection, operations in pending.values():
+            for start in range(0, len(operations), self.batch_size):
+                batch = operations[start:start + self.batch_size]
+                try:
+                    await collection.bulk_write(batch, ordered=True)
+                except Exception as exc:  # pylint: disable=broad-except
+                    logger.exception('Write behind to %s failed',
+                                     collection.name)
+                    await self._report(exc, collection, batch)
+                finally:
+                    self._size -= len(batch)
+                    for _ in batch:
+                        self._slots.release()
+
+    async def _report(self, exc: Exception, collection: Any,
+                      operations: List[Any]) -> None:
+        for callback in self._callbacks:
+            try:
+                result = callback(exc, collection, operations)
+                if hasattr(result, '__await__'):
+                    await result
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Write behind error callback failed')
+
+    async def close(self) -> None:
+        '''Останавливает фоновую задачу и записывает оставшиеся
+        операции. Вызывается при завершении работы приложения.'''
+        task, self._task = self._task, None
+        if task is not None and not task.done():
+            self._wakeup.set()
+            await task
+        await self.flush()
+
+
+async def shutdown() -> None:
+    '''Записывает операции из всех очередей отложенной записи.'''
+    for queue in list(queues):
+        await queue.close()